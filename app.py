@@ -1,22 +1,558 @@
 import os
-from datetime import datetime
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for
+import sys
+
+# Cooperative (greenlet) server modes have to patch the standard library before
+# anything else is imported so blocking socket calls, pymongo included, yield
+ASYNC_MODE = os.environ.get('CHATPRO_ASYNC_MODE', 'threading').strip().lower()
+if ASYNC_MODE == 'gevent':
+    from gevent import monkey
+    monkey.patch_all()
+elif ASYNC_MODE == 'eventlet':
+    import eventlet
+    eventlet.monkey_patch()
+
+import re
+import hmac
+import io
+import csv
+import time
+import json
+import ipaddress
+import argparse
+import queue
+import signal
+import socket
+import struct
+import pickle
+import zlib
+import gzip
+import heapq
+import bisect
+import calendar
+import tempfile
+import threading
+import functools
+import multiprocessing
+from itertools import chain, islice
+from concurrent.futures import ProcessPoolExecutor
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta, timezone
+from flask import Flask, render_template, request, jsonify, session, redirect, url_for, g
 from flask_socketio import SocketIO, emit, join_room, leave_room
-from pymongo import MongoClient
-from pymongo.errors import ConnectionFailure, ConfigurationError
+import socketio
+from pymongo import MongoClient, UpdateOne, ReturnDocument, monitoring
+from pymongo.read_preferences import Primary, PrimaryPreferred, Secondary, SecondaryPreferred, Nearest
+from pymongo.write_concern import WriteConcern
+from pymongo.errors import ConnectionFailure, ConfigurationError, BulkWriteError, DuplicateKeyError
 from bson.objectid import ObjectId
+from werkzeug.http import is_resource_modified
 from werkzeug.security import generate_password_hash, check_password_hash
 import logging
 
+try:
+    import orjson  # Optional fast JSON encoder
+except ImportError:
+    orjson = None
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+DUPLICATE_KEY_ERROR = 11000
+MESSAGE_SEARCH_INDEX = [("terms", 1), ("room_id", 1), ("timestamp", -1), ("_id", -1)]
+BUCKET_SEARCH_INDEX = [("messages.terms", 1), ("room_id", 1), ("last", -1), ("_id", -1)]
+
+def env_flag(name, default=False):
+    """Read a boolean setting from the environment"""
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+def env_int(name, default):
+    """Read an integer setting from the environment"""
+    try:
+        return int(os.environ.get(name, default))
+    except (TypeError, ValueError):
+        logger.warning(f"Invalid value for {name}, using {default}")
+        return default
+
+def env_float(name, default):
+    """Read a float setting from the environment"""
+    try:
+        return float(os.environ.get(name, default))
+    except (TypeError, ValueError):
+        logger.warning(f"Invalid value for {name}, using {default}")
+        return default
+
+def utcnow():
+    """Current UTC time truncated to the millisecond precision MongoDB stores"""
+    now = datetime.utcnow()
+    return now.replace(microsecond=now.microsecond // 1000 * 1000)
+
+def parse_timestamp(value):
+    """Parse an ISO 8601 date/time into a naive UTC datetime; raises ValueError"""
+    timestamp = datetime.fromisoformat(value.strip().replace('Z', '+00:00'))
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return timestamp
+
+SEARCH_TOKEN = re.compile(r'\w+')
+
+def tokenize(text, min_length=2, max_length=64):
+    """Normalized search terms of a text, in order of first appearance"""
+    seen = {}
+    for match in SEARCH_TOKEN.finditer(text.lower()):
+        term = match.group()
+        if min_length <= len(term) <= max_length:
+            seen.setdefault(term, None)
+    return list(seen)
+
+def highlight_offsets(text, terms):
+    """[start, end) character offsets of every word in ``text`` that is one of ``terms``"""
+    terms = set(terms)
+    return [[match.start(), match.end()]
+            for match in SEARCH_TOKEN.finditer(text)
+            if match.group().lower() in terms]
+
+def serialize_message(message):
+    """Convert a message document into the JSON shape sent to clients"""
+    return {
+        'id': str(message['_id']),
+        'user_id': str(message['user_id']),
+        'username': message['username'],
+        'message': message['message'],
+        'message_type': message.get('message_type', 'text'),
+        'timestamp': message['timestamp'].isoformat(),
+        'is_system': message.get('is_system', False),
+        'is_edited': message.get('is_edited', False)
+    }
+
+class JSONCodec:
+    """Pluggable JSON encoder for message payloads, REST responses and Socket.IO frames.
+
+    ``name`` is 'orjson', 'json' or 'auto' (orjson when installed). Exposes the
+    ``dumps``/``loads`` pair python-socketio expects from a json module.
+    """
+    def __init__(self, name='auto'):
+        if name == 'auto':
+            name = 'orjson' if orjson else 'json'
+        if name == 'orjson' and not orjson:
+            logger.warning("orjson is not installed, falling back to the standard json module")
+            name = 'json'
+        self.name = name
+
+    @staticmethod
+    def _default(value):
+        if isinstance(value, ObjectId):
+            return str(value)
+        if isinstance(value, datetime):
+            return value.isoformat()
+        raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+    def dumps_bytes(self, obj):
+        """Encode to UTF-8 JSON bytes"""
+        if self.name == 'orjson':
+            return orjson.dumps(obj, default=self._default, option=orjson.OPT_NON_STR_KEYS)
+        return json.dumps(obj, default=self._default, separators=(',', ':')).encode('utf-8')
+
+    def dumps(self, obj, **kwargs):
+        # Socket.IO passes separators=...; both encoders already emit compact JSON
+        if self.name == 'orjson':
+            return self.dumps_bytes(obj).decode('utf-8')
+        return json.dumps(obj, default=self._default, separators=(',', ':'))
+
+    def loads(self, data, **kwargs):
+        if self.name == 'orjson':
+            return orjson.loads(data)
+        return json.loads(data)
+
+class MessageSerializer:
+    """The single message -> wire JSON path for REST history and Socket.IO broadcasts.
+
+    Payload dicts and their encoded bytes are cached per message id (LRU), so
+    a message is converted and encoded once however many history pages or
+    broadcasts include it. Cached payloads are shared and must not be mutated.
+    """
+    # Projection for history reads: only what serialize_message and cursors need
+    FIELDS = {
+        'user_id': 1, 'username': 1, 'message': 1, 'message_type': 1,
+        'timestamp': 1, 'is_system': 1, 'is_edited': 1
+    }
+
+    def __init__(self, codec=None, cache_size=10000):
+        self.codec = codec or JSONCodec()
+        self.cache_size = cache_size
+        self._cache = OrderedDict()  # message id -> [payload, encoded bytes or None]
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'encoded': 0}
+
+    def payload(self, message):
+        """Client payload for a message document"""
+        message_id = str(message['_id'])
+        with self._lock:
+            entry = self._cache.get(message_id)
+            if entry:
+                self._cache.move_to_end(message_id)
+                self.stats['hits'] += 1
+                return entry[0]
+            self.stats['misses'] += 1
+        
+        payload = serialize_message(message)
+        self.remember(payload)
+        return payload
+
+    def remember(self, payload, encoded=None):
+        """Cache a payload built elsewhere (e.g. relayed by another worker)"""
+        if self.cache_size <= 0:
+            return
+        with self._lock:
+            entry = self._cache.get(payload['id'])
+            if entry:
+                self._cache.move_to_end(payload['id'])
+                return
+            self._cache[payload['id']] = [payload, encoded]
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def encode(self, payload):
+        """Encoded JSON bytes for one payload"""
+        with self._lock:
+            entry = self._cache.get(payload['id'])
+            if entry and entry[1] is not None:
+                return entry[1]
+        
+        encoded = self.codec.dumps_bytes(payload)
+        with self._lock:
+            self.stats['encoded'] += 1
+            entry = self._cache.get(payload['id'])
+            if entry:
+                entry[1] = encoded
+        return encoded
+
+    def encode_list(self, payloads):
+        """Encoded JSON array assembled from the per-message encodings"""
+        return b'[' + b','.join(self.encode(payload) for payload in payloads) + b']'
+
+    def forget(self, message_id):
+        with self._lock:
+            self._cache.pop(str(message_id), None)
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self.stats, encoder=self.codec.name, size=len(self._cache), max_size=self.cache_size)
+
+# Write concern, read preference and optional dedicated pool per class of operation.
+# Override with e.g. CHATPRO_MONGO_POLICY_HISTORY="read=secondaryPreferred,max_staleness=120,pool=20"
+OPERATION_POLICIES = {
+    'accounts': {'w': 'majority'},
+    'rooms': {},
+    'messages': {'w': 'majority'},
+    'system': {'w': 1},
+    'presence': {'w': 1},
+    'history': {'read': 'secondaryPreferred', 'max_staleness': 90}
+}
+
+READ_PREFERENCES = {
+    'primary': Primary,
+    'primarypreferred': PrimaryPreferred,
+    'secondary': Secondary,
+    'secondarypreferred': SecondaryPreferred,
+    'nearest': Nearest
+}
+
+def load_operation_policies():
+    """Default operation policies merged with CHATPRO_MONGO_POLICY_<CLASS> overrides"""
+    policies = {name: dict(policy) for name, policy in OPERATION_POLICIES.items()}
+    prefix = 'CHATPRO_MONGO_POLICY_'
+    for key, value in os.environ.items():
+        if not key.startswith(prefix):
+            continue
+        policy = policies.setdefault(key[len(prefix):].lower(), {})
+        for option in filter(None, (part.strip() for part in value.split(','))):
+            name, _, setting = option.partition('=')
+            name, setting = name.strip().lower(), setting.strip()
+            if name in ('max_staleness', 'pool') or (name == 'w' and setting.isdigit()):
+                setting = int(setting)
+            elif name == 'read' and setting.lower() not in READ_PREFERENCES:
+                logger.warning(f"Unknown read preference {setting!r} in {key}, ignoring it")
+                continue
+            policy[name] = setting
+    return policies
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _format_labels(labels):
+    """Prometheus label set, e.g. {event="send_message"}"""
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+class LatencyHistogram:
+    """Latency histogram per label set, rendered in the Prometheus text format"""
+    def __init__(self, name, description, label_names, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, seconds, *label_values):
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += seconds
+
+    def render(self):
+        with self._lock:
+            snapshot = sorted((labels, list(counts), total) for labels, (counts, total) in self._series.items())
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        for label_values, counts, total in snapshot:
+            labels = list(zip(self.label_names, label_values))
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(labels + [('le', bound)])} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {cumulative}")
+        return lines
+
+class MetricsRegistry:
+    """Histograms plus gauges and counters that are read when /metrics is scraped"""
+    def __init__(self):
+        self._histograms = []
+        self._collectors = []
+
+    def histogram(self, name, description, label_names=()):
+        return self.register(LatencyHistogram(name, description, label_names))
+
+    def register(self, histogram):
+        self._histograms.append(histogram)
+        return histogram
+
+    def gauge(self, name, description, collect, kind='gauge'):
+        """Add a metric whose value comes from ``collect()``: a number, or (labels, value) pairs"""
+        self._collectors.append((name, description, kind, collect))
+
+    def counter(self, name, description, collect):
+        self.gauge(name, description, collect, kind='counter')
+
+    def render(self):
+        lines = []
+        for histogram in self._histograms:
+            lines.extend(histogram.render())
+        for name, description, kind, collect in self._collectors:
+            try:
+                samples = collect()
+            except Exception as e:
+                logger.warning(f"Could not collect metric {name}: {e}")
+                continue
+            if samples is None:
+                continue
+            if isinstance(samples, (int, float)):
+                samples = [((), samples)]
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.extend(f"{name}{_format_labels(list(labels))} {value}" for labels, value in samples)
+        return '\n'.join(lines) + '\n'
+
+class MongoCommandMetrics(monitoring.CommandListener, monitoring.ConnectionPoolListener):
+    """pymongo listener timing every command and tracking connection pool usage"""
+    def __init__(self):
+        self.commands = LatencyHistogram(
+            'chatpro_mongo_command_duration_seconds', 'MongoDB command latency',
+            ('command', 'collection', 'status')
+        )
+        self._collections = {}
+        self._lock = threading.Lock()
+        self.connections = {'open': 0, 'checked_out': 0}
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        if not isinstance(collection, str):
+            # getMore names its collection separately; admin commands have none
+            collection = event.command.get('collection', '')
+        with self._lock:
+            self._collections[(event.connection_id, event.request_id)] = collection
+
+    def succeeded(self, event):
+        self._observe(event, 'ok')
+
+    def failed(self, event):
+        self._observe(event, 'error')
+
+    def _observe(self, event, status):
+        with self._lock:
+            collection = self._collections.pop((event.connection_id, event.request_id), '')
+        self.commands.observe(event.duration_micros / 1e6, event.command_name, collection, status)
+
+    def _count(self, state, delta):
+        with self._lock:
+            self.connections[state] += delta
+
+    def connection_created(self, event):
+        self._count('open', 1)
+
+    def connection_closed(self, event):
+        self._count('open', -1)
+
+    def connection_checked_out(self, event):
+        self._count('checked_out', 1)
+
+    def connection_checked_in(self, event):
+        self._count('checked_out', -1)
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        pass
+
+class OperationStats:
+    """Thread-safe latency counters per operation class"""
+    def __init__(self):
+        self._classes = {}
+        self._lock = threading.Lock()
+
+    def record(self, operation, seconds, error=False):
+        with self._lock:
+            stats = self._classes.get(operation)
+            if stats is None:
+                stats = self._classes[operation] = {'count': 0, 'errors': 0, 'total': 0.0, 'max': 0.0}
+            stats['count'] += 1
+            stats['total'] += seconds
+            stats['max'] = max(stats['max'], seconds)
+            if error:
+                stats['errors'] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                operation: {
+                    'count': stats['count'],
+                    'errors': stats['errors'],
+                    'mean_ms': round(stats['total'] / stats['count'] * 1000, 3) if stats['count'] else 0,
+                    'max_ms': round(stats['max'] * 1000, 3)
+                }
+                for operation, stats in self._classes.items()
+            }
+
+class TimedCursor:
+    """Cursor wrapper adding the time spent fetching results to the operation's latency"""
+    def __init__(self, cursor, record, elapsed=0.0):
+        self._cursor = cursor
+        self._record = record
+        self._elapsed = elapsed
+        self._recorded = False
+
+    def __getattr__(self, name):
+        attribute = getattr(self._cursor, name)
+        if not callable(attribute):
+            return attribute
+        
+        def chained(*args, **kwargs):
+            # Keep builder calls (sort, limit, hint...) returning the wrapper
+            result = attribute(*args, **kwargs)
+            return self if result is self._cursor else result
+        return chained
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        started = time.perf_counter()
+        try:
+            return next(self._cursor)
+        except StopIteration:
+            self._elapsed += time.perf_counter() - started
+            self._finish()
+            raise
+        except Exception:
+            self._elapsed += time.perf_counter() - started
+            self._finish(error=True)
+            raise
+        finally:
+            if not self._recorded:
+                self._elapsed += time.perf_counter() - started
+
+    def close(self):
+        self._finish()
+        self._cursor.close()
+
+    def _finish(self, error=False):
+        if not self._recorded:
+            self._recorded = True
+            self._record(self._elapsed, error)
+
+    def __del__(self):
+        try:
+            self._finish()
+        except Exception:
+            pass
+
+class TimedCollection:
+    """Collection proxy timing every operation under one operation class"""
+    CURSOR_METHODS = frozenset(('find', 'aggregate'))
+
+    def __init__(self, collection, operation, stats):
+        self._collection = collection
+        self._operation = operation
+        self._stats = stats
+
+    def __getattr__(self, name):
+        attribute = getattr(self._collection, name)
+        if name.startswith('_') or not callable(attribute):
+            return attribute
+        
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                result = attribute(*args, **kwargs)
+            except Exception:
+                self._stats.record(self._operation, time.perf_counter() - started, error=True)
+                raise
+            if name in self.CURSOR_METHODS:
+                return TimedCursor(result, self._record, time.perf_counter() - started)
+            self._stats.record(self._operation, time.perf_counter() - started)
+            return result
+        return timed
+
+    def _record(self, seconds, error=False):
+        self._stats.record(self._operation, seconds, error)
+
 class MongoDBManager:
     """Handles MongoDB connection and operations with your updated connection string"""
-    def __init__(self):
+    def __init__(self, policies=None):
         self.client = None
         self.db = None
+        self.policies = policies if policies is not None else load_operation_policies()
+        self.operation_stats = OperationStats()
+        self._pool_clients = {}
+        self._collections = {}
+        self._stats_running = False
+        # Command latency and pool usage for /metrics
+        self.command_metrics = MongoCommandMetrics()
         self.connect()
 
     def connect(self):
@@ -28,15 +564,18 @@ class MongoDBManager:
             "?replicaSet=atlas-kr0oed-shard-0&ssl=true&authSource=admin"
         )
         
+        self.connection_string = connection_string
+        self.client_options = dict(
+            connectTimeoutMS=30000,
+            socketTimeoutMS=30000,
+            serverSelectionTimeoutMS=30000,
+            retryWrites=True,
+            w="majority",
+            event_listeners=[self.command_metrics]
+        )
+        
         try:
-            self.client = MongoClient(
-                connection_string,
-                connectTimeoutMS=30000,
-                socketTimeoutMS=30000,
-                serverSelectionTimeoutMS=30000,
-                retryWrites=True,
-                w="majority"
-            )
+            self.client = MongoClient(connection_string, **self.client_options)
             # Verify connection
             self.client.admin.command('ping')
             self.db = self.client.get_database("chatpro_db")  # Updated database name
@@ -64,29 +603,254 @@ class MongoDBManager:
             self.db.rooms.create_index("created_by")
             self.db.rooms.create_index("is_private")
             self.db.rooms.create_index("last_activity")
+            # Room directory: public rooms ordered by activity, _id breaks ties for cursors
+            self.db.rooms.create_index([("is_active", 1), ("is_private", 1), ("last_activity", -1), ("_id", -1)])
+            
+            # Membership indexes: one document per (room, user)
+            self.db.memberships.create_index([("room_id", 1), ("user_id", 1)], unique=True)
+            self.db.memberships.create_index([("user_id", 1), ("room_id", 1)])
             
             # Message indexes
             self.db.messages.create_index("room_id")
-            self.db.messages.create_index([("room_id", 1), ("timestamp", -1)])
+            # _id breaks timestamp ties so history can be paged with keyset cursors
+            self.db.messages.create_index([("room_id", 1), ("timestamp", -1), ("_id", -1)])
             self.db.messages.create_index("timestamp")
+            # Inverted index for search: one key per (term, room), newest first
+            self.db.messages.create_index(MESSAGE_SEARCH_INDEX, name="message_search")
+            
+            # Bucketed message storage (CHATPRO_MESSAGE_BUCKET_SIZE)
+            self.db.message_buckets.create_index([("room_id", 1), ("last", -1), ("_id", -1)])
+            self.db.message_buckets.create_index([("room_id", 1), ("first", 1), ("_id", 1)])
+            self.db.message_buckets.create_index([("room_id", 1)], name="open_buckets", unique=True,
+                                                 partialFilterExpression={'open': True})
+            self.db.message_buckets.create_index(BUCKET_SEARCH_INDEX, name="bucket_search")
             
             logger.info("Database indexes created successfully")
         except Exception as e:
             logger.warning("Error creating indexes: %s", e)
 
-    def get_collection(self, collection_name):
-        """Get a collection from the database"""
+    def get_collection(self, collection_name, operation=None):
+        """Get a collection from the database.
+
+        With an ``operation`` class the collection carries that class's write
+        concern and read preference from ``self.policies``, runs on its own
+        connection pool if the policy sets ``pool``, and is timed into
+        ``operation_stats``.
+        """
         if self.db is None:
             self.connect()
-        return self.db[collection_name]
+        if operation is None:
+            return self.db[collection_name]
+        
+        key = (collection_name, operation)
+        if key not in self._collections:
+            policy = self.policies.get(operation, {})
+            options = {}
+            if 'w' in policy:
+                options['write_concern'] = WriteConcern(w=policy['w'])
+            if 'read' in policy:
+                preference = READ_PREFERENCES[policy['read'].lower()]
+                if preference is Primary:
+                    options['read_preference'] = Primary()
+                else:
+                    options['read_preference'] = preference(max_staleness=policy.get('max_staleness', -1))
+            database = self._pool_client(operation, policy['pool']).get_database(self.db.name) \
+                if policy.get('pool') else self.db
+            self._collections[key] = TimedCollection(
+                database.get_collection(collection_name, **options), operation, self.operation_stats
+            )
+        return self._collections[key]
+
+    def close(self):
+        """Close the per-class pools and the main client"""
+        self.stop_stats_log()
+        for client in self._pool_clients.values():
+            client.close()
+        self._pool_clients.clear()
+        self._collections.clear()
+        if self.client:
+            self.client.close()
+
+    def _pool_client(self, operation, pool_size):
+        """A separate client, sized for one operation class, so it cannot starve the others"""
+        if operation not in self._pool_clients:
+            logger.info(f"Using a dedicated pool of {pool_size} connections for {operation} operations")
+            self._pool_clients[operation] = MongoClient(
+                self.connection_string, **dict(self.client_options, maxPoolSize=pool_size)
+            )
+        return self._pool_clients[operation]
+
+    def start_stats_log(self, interval):
+        """Log per-class operation latency every ``interval`` seconds"""
+        if interval > 0 and not self._stats_running:
+            self._stats_running = True
+            threading.Thread(target=self._log_stats, args=(interval,),
+                             name='mongo-stats', daemon=True).start()
+
+    def stop_stats_log(self):
+        self._stats_running = False
+
+    def _log_stats(self, interval):
+        while self._stats_running:
+            time.sleep(interval)
+            for operation, stats in sorted(self.operation_stats.snapshot().items()):
+                logger.info(f"Mongo {operation}: {stats['count']} ops, mean {stats['mean_ms']} ms, "
+                            f"max {stats['max_ms']} ms, {stats['errors']} errors")
+
+    def get_stats(self):
+        return {
+            'policies': self.policies,
+            'operations': self.operation_stats.snapshot()
+        }
+
+def _hash_password(password, method):
+    """Process pool task: hash a password"""
+    return generate_password_hash(password, method=method)
+
+def _check_password(password_hash, password):
+    """Process pool task: verify a password against its hash"""
+    return check_password_hash(password_hash, password)
+
+class PasswordHasher:
+    """Runs password hashing and verification on a bounded process pool.
+
+    PBKDF2 holds the GIL for the whole computation, so doing it on the request
+    thread stalls every other handler in the process. With ``workers`` set to
+    0 the work runs inline.
+    """
+    def __init__(self, method='pbkdf2:sha256', workers=2, max_pending=64, timeout=30):
+        self.method = method
+        self.workers = workers
+        self.timeout = timeout
+        # Canonical prefix (e.g. pbkdf2:sha256:600000) used to spot outdated hashes
+        self.method_prefix = generate_password_hash('', method=method).split('$', 1)[0]
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._executor = None
+        if workers > 0:
+            self._executor = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+        self.stats = {'pending': 0, 'peak_pending': 0, 'completed': 0, 'rejected': 0, 'total_seconds': 0.0}
+
+    def hash(self, password):
+        return self._run(_hash_password, password, self.method)
+
+    def verify(self, password_hash, password):
+        return self._run(_check_password, password_hash, password)
+
+    def hash_many(self, passwords):
+        """Hash a batch of passwords through the bounded slots, ``workers`` jobs at a time"""
+        if not self._executor:
+            return [_hash_password(password, self.method) for password in passwords]
+        
+        hashes = []
+        in_flight = deque()
+        for password in passwords:
+            if len(in_flight) >= self.workers:
+                hashes.append(in_flight.popleft().result())
+            in_flight.append(self._submit(_hash_password, password, self.method))
+        hashes.extend(future.result() for future in in_flight)
+        return hashes
+
+    def needs_rehash(self, password_hash):
+        """True if the hash was made with different parameters than configured"""
+        return password_hash.split('$', 1)[0] != self.method_prefix
+
+    def _submit(self, func, *args):
+        if not self._slots.acquire(timeout=self.timeout):
+            with self._lock:
+                self.stats['rejected'] += 1
+            raise RuntimeError('Password hashing queue is full')
+        started = time.monotonic()
+        with self._lock:
+            self.stats['pending'] += 1
+            self.stats['peak_pending'] = max(self.stats['peak_pending'], self.stats['pending'])
+        
+        def done(future):
+            # The slot is held until the job finishes, even if the caller gave up waiting
+            with self._lock:
+                self.stats['pending'] -= 1
+                self.stats['completed'] += 1
+                self.stats['total_seconds'] += time.monotonic() - started
+            self._slots.release()
+        
+        try:
+            future = self._executor.submit(func, *args)
+        except Exception:
+            with self._lock:
+                self.stats['pending'] -= 1
+            self._slots.release()
+            raise
+        future.add_done_callback(done)
+        return future
+
+    def _run(self, func, *args):
+        if not self._executor:
+            return func(*args)
+        return self._submit(func, *args).result(timeout=self.timeout)
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats, workers=self.workers, method=self.method_prefix)
+        completed = stats.pop('total_seconds')
+        stats['avg_ms'] = round(completed / stats['completed'] * 1000, 2) if stats['completed'] else 0
+        return stats
+
+    def close(self):
+        if self._executor:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+
+def iter_user_rows(stream, fmt):
+    """Yield (row_number, fields) from a CSV (with header) or NDJSON text stream"""
+    if fmt == 'csv':
+        for row_number, fields in enumerate(csv.DictReader(stream), start=1):
+            yield row_number, fields
+        return
+    
+    for row_number, line in enumerate(stream, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            fields = json.loads(line)
+        except ValueError:
+            fields = {}
+        yield row_number, fields if isinstance(fields, dict) else {}
+
+def iter_ndjson(records, codec, compress=False, chunk_size=65536):
+    """Encode records as NDJSON (optionally gzip), yielding chunks of about ``chunk_size`` bytes"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+    buffer = []
+    size = 0
+    for record in records:
+        line = codec.dumps_bytes(record) + b'\n'
+        buffer.append(line)
+        size += len(line)
+        if size >= chunk_size:
+            chunk = b''.join(buffer)
+            buffer, size = [], 0
+            chunk = compressor.compress(chunk) if compressor else chunk
+            if chunk:
+                yield chunk
+    
+    chunk = b''.join(buffer)
+    if compressor:
+        chunk = compressor.compress(chunk) + compressor.flush()
+    if chunk:
+        yield chunk
 
 class UserManager:
     """Handles user-related operations with enhanced validation"""
-    def __init__(self, mongo_manager):
-        self.users = mongo_manager.get_collection("users")
+    def __init__(self, mongo_manager, hasher=None):
+        self.users = mongo_manager.get_collection("users", "accounts")
+        # Status and last_seen writes are frequent and cheap to lose
+        self.status_users = mongo_manager.get_collection("users", "presence")
+        self.hasher = hasher or PasswordHasher(workers=0)
 
-    def register_user(self, username, password, email):
-        """Register a new user with enhanced validation"""
+    def validate_registration(self, username, password, email):
+        """Check registration fields, raising ValueError with a user-facing message"""
         if not username or not password or not email:
             raise ValueError('All fields are required')
         
@@ -98,22 +862,13 @@ class UserManager:
             raise ValueError('Password must be at least 8 characters')
         
         # Check for valid email format
-        import re
         email_pattern = r'^[^\s@]+@[^\s@]+\.[^\s@]+$'
         if not re.match(email_pattern, email):
             raise ValueError('Please enter a valid email address')
-        
-        # Check if username already exists
-        if self.users.find_one({'username': username}):
-            raise ValueError('Username already exists')
-        
-        # Check if email already exists
-        if self.users.find_one({'email': email.lower()}):
-            raise ValueError('Email already registered')
-        
-        hashed_password = generate_password_hash(password, method='pbkdf2:sha256')
-        
-        user_data = {
+
+    def build_user_document(self, username, hashed_password, email, status='online'):
+        """Build the users collection document for a new account"""
+        return {
             'username': username,
             'password': hashed_password,
             'email': email.lower(),
@@ -124,15 +879,94 @@ class UserManager:
             'is_active': True,
             'profile': {
                 'avatar_color': self.generate_avatar_color(username),
-                'status': 'online',
+                'status': status,
                 'bio': ''
             }
         }
+
+    def register_user(self, username, password, email):
+        """Register a new user with enhanced validation"""
+        self.validate_registration(username, password, email)
+        
+        # Check if username already exists
+        if self.users.find_one({'username': username}):
+            raise ValueError('Username already exists')
+        
+        # Check if email already exists
+        if self.users.find_one({'email': email.lower()}):
+            raise ValueError('Email already registered')
+        
+        hashed_password = self.hasher.hash(password)
+        user_data = self.build_user_document(username, hashed_password, email)
         
         result = self.users.insert_one(user_data)
         logger.info(f"New user registered: {username}")
         return str(result.inserted_id)
 
+    def bulk_register(self, rows, batch_size=1000):
+        """Provision many users, yielding one result dict per input row.
+
+        ``rows`` is an iterable of (row_number, fields) pairs. Rows are
+        validated, their passwords hashed in parallel and inserted with
+        unordered ``insert_many`` batches; the unique username/email indexes
+        report duplicates, so no pre-check queries are made.
+        """
+        batch = []
+        for row_number, fields in rows:
+            username = str(fields.get('username') or '').strip()
+            password = str(fields.get('password') or '')
+            email = str(fields.get('email') or '').strip().lower()
+            try:
+                self.validate_registration(username, password, email)
+            except ValueError as e:
+                yield {'row': row_number, 'username': username, 'status': 'invalid', 'error': str(e)}
+                continue
+            
+            batch.append((row_number, username, password, email))
+            if len(batch) >= batch_size:
+                yield from self._insert_user_batch(batch)
+                batch = []
+        
+        if batch:
+            yield from self._insert_user_batch(batch)
+
+    def _insert_user_batch(self, batch):
+        hashes = self.hasher.hash_many([password for _, _, password, _ in batch])
+        documents = [
+            self.build_user_document(username, hashed_password, email, status='offline')
+            for (_, username, _, email), hashed_password in zip(batch, hashes)
+        ]
+        
+        failures = {}
+        try:
+            self.users.insert_many(documents, ordered=False)
+        except BulkWriteError as e:
+            for error in e.details.get('writeErrors', []):
+                failures[error['index']] = error
+        
+        for index, (row_number, username, _, _) in enumerate(batch):
+            error = failures.get(index)
+            if error is None:
+                yield {'row': row_number, 'username': username, 'status': 'created',
+                       'id': str(documents[index]['_id'])}
+            elif error.get('code') == DUPLICATE_KEY_ERROR:
+                field = self._duplicate_field(error)
+                yield {'row': row_number, 'username': username, 'status': 'duplicate',
+                       'error': f"{field.capitalize()} already exists"}
+            else:
+                yield {'row': row_number, 'username': username, 'status': 'error',
+                       'error': error.get('errmsg', 'Insert failed')}
+        logger.info(f"Provisioned batch of {len(batch) - len(failures)} users")
+
+    @staticmethod
+    def _duplicate_field(error):
+        """Name of the unique field a duplicate key error was raised for"""
+        key_pattern = error.get('keyPattern')
+        if key_pattern:
+            return next(iter(key_pattern))
+        match = re.search(r'index: (\w+?)_-?1', error.get('errmsg', ''))
+        return match.group(1) if match else 'username'
+
     def authenticate_user(self, username, password):
         """Authenticate user with secure password checking"""
         user = self.users.find_one({
@@ -140,18 +974,20 @@ class UserManager:
             'is_active': True
         })
         
-        if user and check_password_hash(user['password'], password):
+        if user and self.hasher.verify(user['password'], password):
+            updates = {
+                'last_login': datetime.utcnow(),
+                'last_seen': datetime.utcnow(),
+                'profile.status': 'online'
+            }
+            
+            # Upgrade the stored hash when the configured parameters changed
+            if self.hasher.needs_rehash(user['password']):
+                updates['password'] = self.hasher.hash(password)
+                logger.info(f"Password hash upgraded for {username}")
+            
             # Update last login and status
-            self.users.update_one(
-                {'_id': user['_id']},
-                {
-                    '$set': {
-                        'last_login': datetime.utcnow(),
-                        'last_seen': datetime.utcnow(),
-                        'profile.status': 'online'
-                    }
-                }
-            )
+            self.users.update_one({'_id': user['_id']}, {'$set': updates})
             user['_id'] = str(user['_id'])  # Convert ObjectId to string
             logger.info(f"User authenticated: {username}")
             return user
@@ -160,7 +996,7 @@ class UserManager:
     def update_user_status(self, user_id, status):
         """Update user online status"""
         try:
-            self.users.update_one(
+            self.status_users.update_one(
                 {'_id': ObjectId(user_id)},
                 {
                     '$set': {
@@ -184,166 +1020,2446 @@ class UserManager:
         hash_value = sum(ord(c) for c in username)
         return colors[hash_value % len(colors)]
 
-class RoomManager:
-    """Handles chat room operations with enhanced features"""
-    def __init__(self, mongo_manager):
-        self.rooms = mongo_manager.get_collection("rooms")
-        self.messages = mongo_manager.get_collection("messages")
+class MessageWriteBehind:
+    """Buffers message inserts and flushes them to MongoDB in batches.
 
-    def create_room(self, name, created_by, description="", is_private=False):
-        """Create a new chat room with enhanced validation"""
-        if not name or not created_by:
-            raise ValueError('Room name and creator are required')
-        
-        # Validate room name
-        if len(name) < 3 or len(name) > 50:
-            raise ValueError('Room name must be between 3 and 50 characters')
-        
-        # Check if room name already exists
-        existing_room = self.rooms.find_one({'name': name, 'is_active': True})
-        if existing_room:
-            raise ValueError('Room name already exists')
-        
-        room_data = {
-            'name': name,
-            'description': description,
-            'created_by': created_by,
-            'created_at': datetime.utcnow(),
-            'members': [created_by],
-            'is_active': True,
-            'is_private': is_private,
-            'last_activity': datetime.utcnow(),
-            'settings': {
-                'allow_file_upload': True,
-                'max_members': 100 if not is_private else 10
-            }
-        }
-        
-        result = self.rooms.insert_one(room_data)
-        logger.info(f"New room created: {name}")
-        return str(result.inserted_id)
+    Messages get their ``_id`` assigned locally so they can be broadcast before
+    they are persisted. A background thread flushes the buffer with
+    ``insert_many`` once ``max_batch`` messages are pending or ``flush_interval``
+    seconds have passed, and folds the ``last_activity`` updates of every room
+    touched by the batch into a single ``bulk_write``.
+    """
+    def __init__(self, messages, rooms, max_batch=500, flush_interval=0.05,
+                 max_pending=50000, max_retries=5, retry_backoff=0.1):
+        self.messages = messages
+        self.rooms = rooms
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
 
-    def get_all_public_rooms(self):
-        """Get all active public rooms"""
-        return list(self.rooms.find({
-            'is_active': True,
-            'is_private': False
-        }).sort('last_activity', -1))
+        self._cond = threading.Condition()
+        self._pending = []
+        self._flushing = False
+        self._closed = False
+        self.stats = {'enqueued': 0, 'flushed': 0, 'batches': 0, 'retries': 0, 'dropped': 0}
 
-    def get_user_rooms(self, user_id):
-        """Get rooms where user is a member"""
-        return list(self.rooms.find({
-            'is_active': True,
-            'members': user_id
-        }).sort('last_activity', -1))
+        self._thread = threading.Thread(target=self._run, name='message-write-behind', daemon=True)
+        self._thread.start()
 
-    def get_room_by_id(self, room_id):
-        """Get room by ID with member count"""
-        try:
-            room = self.rooms.find_one({'_id': ObjectId(room_id), 'is_active': True})
-            if room:
-                room['_id'] = str(room['_id'])
-                room['member_count'] = len(room.get('members', []))
-            return room
-        except Exception as e:
-            logger.error(f"Error getting room: {e}")
-            return None
+    def enqueue(self, message_data):
+        """Queue a message document for insertion and return its id"""
+        message_data.setdefault('_id', ObjectId())
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('Message writer is closed')
+            # Apply backpressure rather than growing without bound while Mongo is unavailable
+            while len(self._pending) >= self.max_pending and not self._closed:
+                self._cond.wait(self.flush_interval)
+            self._pending.append(message_data)
+            self.stats['enqueued'] += 1
+            if len(self._pending) >= self.max_batch:
+                self._cond.notify_all()
+        return message_data['_id']
 
-    def join_room(self, room_id, user_id):
-        """Add user to room members"""
-        try:
-            result = self.rooms.update_one(
-                {'_id': ObjectId(room_id), 'is_active': True},
-                {
-                    '$addToSet': {'members': user_id},
-                    '$set': {'last_activity': datetime.utcnow()}
-                }
-            )
-            return result.modified_count > 0
-        except Exception as e:
-            logger.error(f"Error joining room: {e}")
-            return False
+    def pending_count(self):
+        """Number of messages waiting to be written"""
+        with self._cond:
+            return len(self._pending)
 
-    def leave_room(self, room_id, user_id):
-        """Remove user from room members"""
-        try:
-            result = self.rooms.update_one(
-                {'_id': ObjectId(room_id)},
-                {
-                    '$pull': {'members': user_id},
-                    '$set': {'last_activity': datetime.utcnow()}
+    def flush(self, timeout=None):
+        """Block until everything queued so far has been written"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            self._cond.notify_all()
+            while self._pending or self._flushing:
+                wait = self.flush_interval
+                if deadline is not None:
+                    wait = min(wait, deadline - time.monotonic())
+                    if wait <= 0:
+                        return False
+                self._cond.wait(wait)
+        return True
+
+    def close(self, timeout=30):
+        """Stop accepting messages and drain the buffer"""
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            logger.error(f"Message writer did not drain in time, {self.pending_count()} messages unwritten")
+        else:
+            logger.info("Message writer drained")
+
+    def _run(self):
+        while True:
+            with self._cond:
+                deadline = time.monotonic() + self.flush_interval
+                while not self._closed and len(self._pending) < self.max_batch:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+
+                if not self._pending:
+                    if self._closed:
+                        return
+                    continue
+
+                batch = self._pending[:self.max_batch]
+                del self._pending[:self.max_batch]
+                self._flushing = True
+                self._cond.notify_all()
+
+            failed = self._write(batch)
+
+            with self._cond:
+                self._flushing = False
+                if failed and self._closed:
+                    self.stats['dropped'] += len(failed)
+                    logger.error(f"Dropping {len(failed)} messages after repeated write failures on shutdown")
+                elif failed:
+                    # Put unwritten messages back at the front so ordering is kept
+                    self._pending[:0] = failed
+                self._cond.notify_all()
+
+    def _write(self, batch):
+        """Write one batch with retries; returns the documents that are still unwritten"""
+        remaining = batch
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                self.stats['retries'] += 1
+                time.sleep(self.retry_backoff * (2 ** (attempt - 1)))
+            try:
+                self.messages.insert_many(remaining, ordered=False)
+                remaining = []
+                break
+            except BulkWriteError as e:
+                # Duplicate keys mean an earlier attempt already wrote the document
+                failed_indexes = {
+                    error['index'] for error in e.details.get('writeErrors', [])
+                    if error.get('code') != DUPLICATE_KEY_ERROR
                 }
-            )
-            return result.modified_count > 0
-        except Exception as e:
-            logger.error(f"Error leaving room: {e}")
-            return False
+                remaining = [doc for i, doc in enumerate(remaining) if i in failed_indexes]
+                if not remaining:
+                    break
+                logger.warning(f"Batch insert failed for {len(remaining)} messages, retrying")
+            except Exception as e:
+                logger.warning(f"Batch insert error: {e}")
+
+        self.stats['flushed'] += len(batch) - len(remaining)
+        self.stats['batches'] += 1
+        unwritten = {id(doc) for doc in remaining}
+        self._write_activity([doc for doc in batch if id(doc) not in unwritten])
+        return remaining
+
+    def _write_activity(self, batch):
+        """Merge last_activity updates per room into one bulk write"""
+        activity = {}
+        for message_data in batch:
+            if message_data.get('is_system'):
+                continue
+            room_id = message_data['room_id']
+            if message_data['timestamp'] > activity.get(room_id, datetime.min):
+                activity[room_id] = message_data['timestamp']
+
+        operations = []
+        for room_id, timestamp in activity.items():
+            if ObjectId.is_valid(room_id):
+                operations.append(UpdateOne({'_id': ObjectId(room_id)},
+                                            {'$max': {'last_activity': timestamp}}))
+        if not operations:
+            return
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.rooms.bulk_write(operations, ordered=False)
+                return
+            except Exception as e:
+                logger.warning(f"Room activity update failed: {e}")
+                time.sleep(self.retry_backoff * (2 ** attempt))
+        logger.error(f"Giving up on last_activity update for {len(operations)} rooms")
+
+class MessageBucketStore:
+    """Stores each room's messages packed into bucket documents.
+
+    A bucket holds up to ``bucket_size`` messages of one room plus the
+    ``first``/``last`` timestamps they span, so indexes grow with the number
+    of buckets instead of messages and a history page is usually read from
+    one or two documents. New messages are pushed into the room's open
+    bucket, which is closed once full. Concurrent writers and write retries
+    can leave buckets that overlap in time or repeat a message; reads merge
+    buckets in order and drop repeats, and ``compact`` rewrites them.
+    """
+    ENTRY_FIELDS = ('_id', 'user_id', 'username', 'message', 'message_type',
+                    'timestamp', 'is_system', 'is_edited', 'terms')
+
+    def __init__(self, buckets, bucket_size=200):
+        self.buckets = buckets
+        self.bucket_size = bucket_size
+
+    @classmethod
+    def _entry(cls, message_data):
+        return {field: message_data[field] for field in cls.ENTRY_FIELDS if field in message_data}
+
+    @staticmethod
+    def _key(message):
+        timestamp = message['timestamp']
+        millis = calendar.timegm(timestamp.utctimetuple()) * 1000 + timestamp.microsecond // 1000
+        return millis, int(str(message['_id']), 16)
+
+    @staticmethod
+    def _millis(timestamp):
+        return calendar.timegm(timestamp.utctimetuple()) * 1000 + timestamp.microsecond // 1000
+
+    def append(self, room_id, messages):
+        """Push messages into the room's open bucket, opening a new one when it is full.
+
+        Each push is one conditional find_one_and_update, and the unique
+        open_buckets index keeps concurrent writers from opening a second
+        bucket. A batch that does not fit tops the open bucket up first.
+        """
+        start = 0
+        while start < len(messages):
+            entries = [self._entry(message) for message in messages[start:start + self.bucket_size]]
+            try:
+                bucket = self._push({'room_id': room_id, 'open': True,
+                                     'count': {'$lte': self.bucket_size - len(entries)}},
+                                    entries, upsert=True)
+            except DuplicateKeyError:
+                # The open bucket has less room than this batch
+                open_bucket = self.buckets.find_one({'room_id': room_id, 'open': True}, {'count': 1})
+                if not open_bucket:
+                    continue
+                entries = entries[:self.bucket_size - open_bucket['count']]
+                bucket = open_bucket
+                if entries:
+                    bucket = self._push({'_id': open_bucket['_id'], 'open': True,
+                                         'count': open_bucket['count']}, entries)
+                    if not bucket:
+                        continue  # Another writer changed it first
+            start += len(entries)
+            if bucket['count'] >= self.bucket_size:
+                # Closed buckets drop out of the partial open_buckets index
+                self.buckets.update_one({'_id': bucket['_id']}, {'$unset': {'open': ''}})
+
+    def _push(self, query, entries, upsert=False):
+        timestamps = [entry['timestamp'] for entry in entries]
+        return self.buckets.find_one_and_update(
+            query,
+            {
+                '$push': {'messages': {'$each': entries}},
+                '$inc': {'count': len(entries)},
+                '$min': {'first': min(timestamps)},
+                '$max': {'last': max(timestamps)}
+            },
+            projection={'count': 1},
+            upsert=upsert,
+            return_document=ReturnDocument.AFTER
+        )
+
+    def insert_many(self, messages, ordered=False):
+        """Collection-style batch insert so MessageWriteBehind can write buckets"""
+        by_room = OrderedDict()
+        for message_data in messages:
+            by_room.setdefault(message_data['room_id'], []).append(message_data)
+        for room_id, room_messages in by_room.items():
+            self.append(room_id, room_messages)
+
+    BUCKET_FIELDS = {'room_id': 1, 'first': 1, 'last': 1, 'messages': 1}
+
+    def _scan(self, query, descending=True, match=None, hint=None, limit=0, head=()):
+        """Yield messages of the matching buckets in (timestamp, _id) order.
+
+        Buckets are read in order of their ``last`` (descending) or ``first``
+        (ascending) bound; a buffered message is released once no later
+        bucket can hold anything that sorts before it. ``head`` buckets, in
+        the same order and all ahead of the query's, are read first. Buckets
+        are fetched two at a time since a page rarely needs more than that.
+        """
+        sign = -1 if descending else 1
+        bound = 'last' if descending else 'first'
+        cursor = self.buckets.find(query, self.BUCKET_FIELDS) \
+            .sort([(bound, sign), ('_id', sign)]).batch_size(2)
+        if limit:
+            cursor = cursor.limit(limit)
+        if hint:
+            cursor = cursor.hint(hint)
+        heap = []
+        pushed = 0  # Tie-breaker so repeated messages never compare their dicts
+        previous = None
+        try:
+            for bucket in chain(head, cursor):
+                # Nothing in this or any later bucket sorts before its bound
+                release_before = sign * self._millis(bucket[bound])
+                while heap and heap[0][0][0] < release_before:
+                    key, _, message = heapq.heappop(heap)
+                    if key != previous:
+                        previous = key
+                        yield message
+                for entry in bucket.get('messages', []):
+                    if match is None or match(entry):
+                        millis, oid = self._key(entry)
+                        pushed += 1
+                        heapq.heappush(heap, ((sign * millis, sign * oid), pushed,
+                                              dict(entry, room_id=bucket['room_id'])))
+            while heap:
+                key, _, message = heapq.heappop(heap)
+                if key != previous:
+                    previous = key
+                    yield message
+        finally:
+            cursor.close()
+
+    def _seek(self, room_id, before=None, after=None):
+        """Bucket query, message filter and head buckets for a keyset page.
+
+        Cursors are (timestamp, ObjectId). Buckets wholly past the cursor are
+        found with a range on the bound the scan sorts by, so the index walk
+        starts at the cursor however deep it is. The bucket holding the
+        cursor is looked up on its own.
+        """
+        query = {'room_id': room_id}
+        if before:
+            key = self._key({'timestamp': before[0], '_id': before[1]})
+            query['last'] = {'$lt': before[0]}
+            head = self._containing(room_id, before[0], descending=True)
+            return query, lambda entry: self._key(entry) < key, head
+        if after:
+            key = self._key({'timestamp': after[0], '_id': after[1]})
+            query['first'] = {'$gt': after[0]}
+            head = self._containing(room_id, after[0], descending=False)
+            return query, lambda entry: self._key(entry) > key, head
+        return query, None, ()
+
+    def _containing(self, room_id, timestamp, descending):
+        """The buckets spanning ``timestamp``, ordered for a scan in that direction.
+
+        Buckets of a room rarely overlap, so the two whose opposite bound is
+        nearest the timestamp cover it; ``compact`` removes the overlaps.
+        """
+        if descending:
+            query = {'room_id': room_id, 'first': {'$lte': timestamp}}
+            order = [('first', -1), ('_id', -1)]
+        else:
+            query = {'room_id': room_id, 'last': {'$gte': timestamp}}
+            order = [('last', 1), ('_id', 1)]
+        buckets = [bucket for bucket in self.buckets.find(query, self.BUCKET_FIELDS).sort(order).limit(2)
+                   if bucket['first'] <= timestamp <= bucket['last']]
+        bound = 'last' if descending else 'first'
+        return sorted(buckets, key=lambda bucket: (bucket[bound], bucket['_id']), reverse=descending)
+
+    def get_page(self, room_id, page=1, per_page=50, before=None, after=None):
+        """Messages newest first, like RoomManager.get_room_messages"""
+        query, match, head = self._seek(room_id, before, after)
+        messages = self._scan(query, descending=not after, match=match, head=head)
+        skip = 0 if (before or after) else (page - 1) * per_page
+        try:
+            page_messages = list(islice(messages, skip, skip + per_page))
+        finally:
+            messages.close()
+        if after:
+            page_messages.reverse()
+        return page_messages
+
+    def count_after(self, room_id, after, limit):
+        """Messages newer than ``after`` (timestamp, ObjectId), counting at most ``limit``"""
+        query, match, head = self._seek(room_id, after=after)
+        messages = self._scan(query, descending=False, match=match, head=head)
+        try:
+            return sum(1 for _ in islice(messages, limit))
+        finally:
+            messages.close()
+
+    def latest(self, room_id):
+        """The room's newest message, or None"""
+        messages = self._scan({'room_id': room_id}, limit=2)
+        try:
+            return next(messages, None)
+        finally:
+            messages.close()
+
+    def search(self, room_ids, terms, limit=20, before=None):
+        """Newest messages containing every term, via the bucket_search index"""
+        query = {
+            '$and': [{'messages.terms': term} for term in terms],
+            'room_id': room_ids[0] if len(room_ids) == 1 else {'$in': room_ids}
+        }
+        wanted = set(terms)
+        key = None
+        if before:
+            key = self._key({'timestamp': before[0], '_id': before[1]})
+            query['first'] = {'$lte': before[0]}
+        
+        def match(entry):
+            return wanted.issubset(entry.get('terms', ())) and (key is None or self._key(entry) < key)
+        
+        messages = self._scan(query, match=match, hint=BUCKET_SEARCH_INDEX)
+        try:
+            return list(islice(messages, limit))
+        finally:
+            messages.close()
+
+    def iter_range(self, room_id, since=None, until=None):
+        """Every message of a room oldest first, optionally within [since, until)"""
+        query = {'room_id': room_id}
+        if since:
+            query['last'] = {'$gte': since}
+        if until:
+            query['first'] = {'$lt': until}
+        
+        def match(entry):
+            return (not since or entry['timestamp'] >= since) and (not until or entry['timestamp'] < until)
+        
+        return self._scan(query, descending=False, match=match)
+
+    def migrate(self, messages, batch_size=None):
+        """Pack per-message documents into closed buckets, deleting the originals.
+
+        Runs room by room in timestamp order. Each bucket is written before its
+        source documents are deleted, so an interrupted run can be repeated;
+        reads ignore the duplicates that leaves behind.
+        """
+        batch_size = batch_size or self.bucket_size
+        migrated = 0
+        for room_id in messages.distinct('room_id'):
+            cursor = messages.find({'room_id': room_id}).sort([('timestamp', 1), ('_id', 1)]).batch_size(batch_size)
+            chunk = []
+            for message in cursor:
+                if 'terms' not in message and not message.get('is_system'):
+                    message['terms'] = tokenize(message.get('message') or '')
+                chunk.append(message)
+                if len(chunk) >= batch_size:
+                    self._write_closed_bucket(room_id, chunk)
+                    messages.delete_many({'_id': {'$in': [message['_id'] for message in chunk]}})
+                    migrated += len(chunk)
+                    chunk = []
+            if chunk:
+                self._write_closed_bucket(room_id, chunk)
+                messages.delete_many({'_id': {'$in': [message['_id'] for message in chunk]}})
+                migrated += len(chunk)
+            logger.info(f"Migrated messages of room {room_id} into buckets ({migrated} so far)")
+        return migrated
+
+    def _write_closed_bucket(self, room_id, chunk):
+        entries = [self._entry(message) for message in chunk]
+        self.buckets.insert_one({
+            'room_id': room_id,
+            'first': min(entry['timestamp'] for entry in entries),
+            'last': max(entry['timestamp'] for entry in entries),
+            'count': len(entries),
+            'messages': entries
+        })
+
+    def compact(self, older_than=timedelta(hours=1)):
+        """Repack under-filled buckets whose newest message is older than ``older_than``.
+
+        Candidate buckets are closed first so writers move on to a new bucket,
+        then re-read, merged in order without repeats and written back full.
+        """
+        cutoff = utcnow() - older_than
+        candidates = {'last': {'$lt': cutoff}, 'count': {'$lt': self.bucket_size}}
+        compacted = 0
+        for room_id in self.buckets.distinct('room_id', candidates):
+            query = dict(candidates, room_id=room_id)
+            bucket_ids = [bucket['_id'] for bucket in self.buckets.find(query, {'_id': 1})]
+            if len(bucket_ids) < 2:
+                continue
+            self.buckets.update_many({'_id': {'$in': bucket_ids}}, {'$unset': {'open': ''}})
+            
+            merged = list(self._scan({'_id': {'$in': bucket_ids}}, descending=False))
+            for start in range(0, len(merged), self.bucket_size):
+                self._write_closed_bucket(room_id, merged[start:start + self.bucket_size])
+            self.buckets.delete_many({'_id': {'$in': bucket_ids}})
+            compacted += len(bucket_ids)
+            logger.info(f"Compacted {len(bucket_ids)} buckets of room {room_id}")
+        return compacted
+
+class RoomCache:
+    """Bounded LRU cache of room metadata with TTL expiry.
+
+    Alongside each room it keeps the set of users known to be members, so
+    repeated access checks by the same user need no database read. Only
+    positive answers are cached; join/leave update the set in place. The ids
+    of all public rooms, which every search needs, are cached with the same TTL.
+    """
+    def __init__(self, max_size=1024, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._public_ids = None  # (expires_at, frozenset of room ids)
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expired': 0, 'invalidations': 0,
+                      'member_hits': 0, 'public_ids_hits': 0}
+
+    def _live_entry(self, room_id):
+        entry = self._entries.get(room_id)
+        if entry is None:
+            return None
+        if entry['expires_at'] < time.monotonic():
+            del self._entries[room_id]
+            self.stats['expired'] += 1
+            return None
+        return entry
+
+    def get(self, room_id):
+        """Return a shallow copy of the cached room or None"""
+        with self._lock:
+            entry = self._live_entry(room_id)
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            self._entries.move_to_end(room_id)
+            self.stats['hits'] += 1
+            return dict(entry['room'])
+
+    def put(self, room_id, room):
+        """Cache a room document, keeping any members already known"""
+        with self._lock:
+            previous = self._entries.get(room_id)
+            self._entries[room_id] = {
+                'expires_at': time.monotonic() + self.ttl,
+                'room': dict(room),
+                'members': previous['members'] if previous else set()
+            }
+            self._entries.move_to_end(room_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def has_member(self, room_id, user_id):
+        """True if the user is known to be a member; False means unknown"""
+        with self._lock:
+            entry = self._live_entry(room_id)
+            if entry and user_id in entry['members']:
+                self.stats['member_hits'] += 1
+                return True
+            return False
+
+    def add_member(self, room_id, user_id, joined=False):
+        """Record a confirmed member; ``joined`` also bumps the cached member count"""
+        with self._lock:
+            entry = self._entries.get(room_id)
+            if entry:
+                entry['members'].add(user_id)
+                if joined:
+                    entry['room']['member_count'] = entry['room'].get('member_count', 0) + 1
+
+    def remove_member(self, room_id, user_id):
+        with self._lock:
+            entry = self._entries.get(room_id)
+            if entry:
+                entry['members'].discard(user_id)
+                entry['room']['member_count'] = max(entry['room'].get('member_count', 1) - 1, 0)
+
+    def invalidate(self, room_id):
+        with self._lock:
+            if self._entries.pop(room_id, None) is not None:
+                self.stats['invalidations'] += 1
+
+    def get_public_ids(self):
+        """Cached ids of every active public room, or None"""
+        with self._lock:
+            if self._public_ids and self._public_ids[0] >= time.monotonic():
+                self.stats['public_ids_hits'] += 1
+                return self._public_ids[1]
+            return None
+
+    def put_public_ids(self, room_ids):
+        with self._lock:
+            self._public_ids = (time.monotonic() + self.ttl, frozenset(room_ids))
+
+    def invalidate_public_ids(self):
+        with self._lock:
+            self._public_ids = None
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self.stats, size=len(self._entries), max_size=self.max_size)
+
+class RecentMessageBuffer:
+    """Per-room ring buffers of the most recent serialized messages.
+
+    A room's buffer only answers reads once it has been seeded from the
+    database, after which every new message is appended so it stays identical
+    to the newest page of history. Rooms are kept in LRU order and dropped
+    when idle for ``idle_ttl`` seconds or when the total number of buffered
+    messages exceeds ``max_messages``.
+    """
+    def __init__(self, per_room=100, max_messages=100000, idle_ttl=900):
+        self.per_room = per_room
+        self.max_messages = max_messages
+        self.idle_ttl = idle_ttl
+        self._rooms = OrderedDict()
+        self._total = 0
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def _entry(self, room_id):
+        entry = self._rooms.get(room_id)
+        if entry is None:
+            entry = {'items': deque(maxlen=self.per_room), 'seeded': False, 'exhaustive': False}
+            self._rooms[room_id] = entry
+        entry['last_used'] = time.monotonic()
+        self._rooms.move_to_end(room_id)
+        return entry
+
+    @staticmethod
+    def _order(item):
+        millis, _, message_id = item[0].partition('-')
+        return int(millis), message_id
+
+    def append(self, room_id, cursor, payload):
+        """Add a freshly written message to the room's buffer"""
+        item = (cursor, payload)
+        with self._lock:
+            entry = self._entry(room_id)
+            items = entry['items']
+            if len(items) == items.maxlen:
+                entry['exhaustive'] = False
+                self._total -= 1
+            if items and self._order(items[-1]) > self._order(item):
+                # Messages relayed from other workers can arrive slightly out of order
+                ordered = sorted(list(items) + [item], key=self._order)
+                items.clear()
+                items.extend(ordered)
+            else:
+                items.append(item)
+            self._total += 1
+            self._evict()
+
+    def seed(self, room_id, page, exhaustive, limit):
+        """Fill a room's buffer from a newest-first page read from the database.
+
+        Returns the newest ``limit`` buffered items, which include messages
+        appended while the page was being read.
+        """
+        with self._lock:
+            entry = self._entry(room_id)
+            seen = {payload['id'] for _, payload in page}
+            merged = sorted(list(page) + [item for item in entry['items'] if item[1]['id'] not in seen],
+                            key=self._order)
+            # A seeded buffer shorter than the page just read (a larger per_page) is refilled
+            short = len(entry['items']) < min(limit, self.per_room) and not entry['exhaustive']
+            if not entry['seeded'] or short:
+                self._fill(entry, page, exhaustive)
+            return merged[:-limit - 1:-1] if limit else []
+
+    def _fill(self, entry, page, exhaustive):
+        # Keep messages appended while the page was being read
+        seen = {payload['id'] for _, payload in page}
+        newer = [item for item in entry['items'] if item[1]['id'] not in seen]
+        self._total -= len(entry['items'])
+        entry['items'] = deque(sorted(list(page) + newer, key=self._order), maxlen=self.per_room)
+        entry['seeded'] = True
+        entry['exhaustive'] = exhaustive and len(page) + len(newer) <= self.per_room
+        self._total += len(entry['items'])
+        self._evict()
+
+    def latest_cursor(self, room_id):
+        """Cursor of the newest buffered message in a room, or None if nothing is buffered"""
+        with self._lock:
+            entry = self._rooms.get(room_id)
+            if entry is None or not entry['items']:
+                return None
+            return entry['items'][-1][0]
+
+    def get_page(self, room_id, limit):
+        """Return up to ``limit`` newest (cursor, payload) pairs, newest first, or None"""
+        with self._lock:
+            entry = self._rooms.get(room_id)
+            if (entry is None or not entry['seeded']
+                    or (len(entry['items']) < limit and not entry['exhaustive'])):
+                self.stats['misses'] += 1
+                return None
+            entry['last_used'] = time.monotonic()
+            self._rooms.move_to_end(room_id)
+            self.stats['hits'] += 1
+            items = entry['items']
+            return [items[i] for i in range(len(items) - 1, max(len(items) - limit, 0) - 1, -1)]
+
+    def since(self, room_id, message_id):
+        """(cursor, payload) pairs newer than a buffered message, oldest first, or None if it is not buffered"""
+        with self._lock:
+            entry = self._rooms.get(room_id)
+            items = entry['items'] if entry else ()
+            for index in range(len(items) - 1, -1, -1):
+                if items[index][1]['id'] == message_id:
+                    self.stats['hits'] += 1
+                    return [items[i] for i in range(index + 1, len(items))]
+            self.stats['misses'] += 1
+            return None
+
+    def discard(self, room_id):
+        with self._lock:
+            entry = self._rooms.pop(room_id, None)
+            if entry:
+                self._total -= len(entry['items'])
+
+    def _evict(self):
+        now = time.monotonic()
+        while self._rooms:
+            room_id, entry = next(iter(self._rooms.items()))
+            if self._total <= self.max_messages and now - entry['last_used'] < self.idle_ttl:
+                break
+            del self._rooms[room_id]
+            self._total -= len(entry['items'])
+            self.stats['evictions'] += 1
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self.stats, rooms=len(self._rooms), messages=self._total)
+
+class RoomManager:
+    """Handles chat room operations with enhanced features"""
+    # Fields needed by the room lists (sidebar and /api/rooms)
+    DIRECTORY_FIELDS = {
+        'name': 1, 'description': 1, 'created_by': 1,
+        'is_private': 1, 'member_count': 1, 'last_activity': 1
+    }
+
+    def __init__(self, mongo_manager, write_behind=None, room_cache=None, recent_messages=None,
+                 serializer=None, buckets=None):
+        self.rooms = mongo_manager.get_collection("rooms", "rooms")
+        self.messages = mongo_manager.get_collection("messages", "messages")
+        self.memberships = mongo_manager.get_collection("memberships", "rooms")
+        # System messages and read-mostly history use their own operation policies.
+        # ``history`` may lag behind the primary, so it only serves deep pages and
+        # search; the newest page, sync seeks, exports and unread counts read
+        # ``messages`` so they agree with ETags and in-memory buffers
+        self.system_messages = mongo_manager.get_collection("messages", "system")
+        self.history = mongo_manager.get_collection("messages", "history")
+        # Optional MessageWriteBehind; when set, messages are persisted asynchronously
+        self.write_behind = write_behind
+        # Optional RoomCache serving get_room_by_id without a database read
+        self.room_cache = room_cache
+        # Optional RecentMessageBuffer serving the newest history page from memory
+        self.recent_messages = recent_messages
+        # Optional MessageBucketStore; when set, messages live in per-room buckets
+        self.buckets = buckets
+        # Shared message -> client payload conversion and encoding cache
+        self.serializer = serializer or MessageSerializer()
+        # Optional publish(event, payload) callable keeping other workers' caches in sync
+        self.publish = None
+
+    def create_room(self, name, created_by, description="", is_private=False):
+        """Create a new chat room with enhanced validation"""
+        if not name or not created_by:
+            raise ValueError('Room name and creator are required')
+        
+        # Validate room name
+        if len(name) < 3 or len(name) > 50:
+            raise ValueError('Room name must be between 3 and 50 characters')
+        
+        # Check if room name already exists
+        existing_room = self.rooms.find_one({'name': name, 'is_active': True})
+        if existing_room:
+            raise ValueError('Room name already exists')
+        
+        room_data = {
+            'name': name,
+            'description': description,
+            'created_by': created_by,
+            'created_at': datetime.utcnow(),
+            'member_count': 1,
+            'is_active': True,
+            'is_private': is_private,
+            'last_activity': datetime.utcnow(),
+            'settings': {
+                'allow_file_upload': True,
+                'max_members': 100 if not is_private else 10
+            }
+        }
+        
+        result = self.rooms.insert_one(room_data)
+        room_id = str(result.inserted_id)
+        self.memberships.insert_one({
+            'room_id': room_id,
+            'user_id': created_by,
+            'joined_at': room_data['created_at']
+        })
+        if self.room_cache:
+            self.room_cache.put(room_id, dict(room_data, _id=room_id))
+            self.room_cache.add_member(room_id, created_by)
+            if not is_private:
+                self.room_cache.invalidate_public_ids()
+        if not is_private:
+            self._publish('public_room_created', {'room_id': room_id})
+        logger.info(f"New room created: {name}")
+        return room_id
+
+    def get_all_public_rooms(self):
+        """Get all active public rooms"""
+        return list(self.rooms.find({
+            'is_active': True,
+            'is_private': False
+        }, {'members': 0}).sort('last_activity', -1))
+
+    def get_member_room_ids(self, user_id):
+        """ObjectIds of the rooms a user belongs to, read from the memberships index"""
+        return [
+            ObjectId(membership['room_id'])
+            for membership in self.memberships.find({'user_id': user_id}, {'room_id': 1, '_id': 0})
+            if ObjectId.is_valid(membership['room_id'])
+        ]
+
+    @staticmethod
+    def _directory_query(member_room_ids):
+        return {
+            'is_active': True,
+            '$or': [{'is_private': False}, {'_id': {'$in': member_room_ids}}]
+        }
+
+    def get_directory_version(self, user_id):
+        """Validator for a user's room directory: (version, last_modified).
+
+        Every change shown in the directory (new room, join, leave, message)
+        bumps a room's last_activity, so the newest last_activity plus the set
+        of rooms the user belongs to identifies the directory's state.
+        """
+        member_room_ids = self.get_member_room_ids(user_id)
+        newest = self.rooms.find_one(
+            self._directory_query(member_room_ids),
+            {'last_activity': 1},
+            sort=[('last_activity', -1), ('_id', -1)]
+        )
+        memberships = zlib.crc32(','.join(sorted(map(str, member_room_ids))).encode())
+        if not newest or not newest.get('last_activity'):
+            return f"empty-{memberships:08x}", None
+        return f"{self.make_cursor(newest, 'last_activity')}-{memberships:08x}", newest['last_activity']
+
+    def get_room_directory(self, user_id, limit=100, cursor=None):
+        """List public rooms plus the user's private rooms, newest activity first.
+
+        One projected query over rooms; the user's memberships are read from the
+        (user_id, room_id) index only. Returns (rooms, next_cursor).
+        """
+        query = self._directory_query(self.get_member_room_ids(user_id))
+        if cursor:
+            last_activity, room_id = self.decode_cursor(cursor)
+            if last_activity is None:
+                raise ValueError('Invalid cursor')
+            query['$and'] = [{'$or': [
+                {'last_activity': {'$lt': last_activity}},
+                {'last_activity': last_activity, '_id': {'$lt': room_id}}
+            ]}]
+        
+        rooms = list(self.rooms.find(query, self.DIRECTORY_FIELDS)
+                     .sort([('last_activity', -1), ('_id', -1)])
+                     .limit(limit + 1))
+        next_cursor = None
+        if len(rooms) > limit:
+            rooms = rooms[:limit]
+            next_cursor = self.make_cursor(rooms[-1], 'last_activity')
+        return rooms, next_cursor
+
+    def get_user_rooms(self, user_id):
+        """Get rooms where user is a member"""
+        room_ids = self.get_member_room_ids(user_id)
+        if not room_ids:
+            return []
+        return list(self.rooms.find({
+            '_id': {'$in': room_ids},
+            'is_active': True
+        }, {'members': 0}).sort('last_activity', -1))
+
+    def get_room_by_id(self, room_id):
+        """Get room by ID with member count"""
+        if self.room_cache:
+            room = self.room_cache.get(room_id)
+            if room:
+                return room
+        
+        try:
+            # Rooms not migrated yet may still carry a members array; never load it
+            room = self.rooms.find_one({'_id': ObjectId(room_id), 'is_active': True}, {'members': 0})
+            if room:
+                room['_id'] = str(room['_id'])
+                room.setdefault('member_count', 0)
+                if self.room_cache:
+                    self.room_cache.put(room_id, room)
+            return room
+        except Exception as e:
+            logger.error(f"Error getting room: {e}")
+            return None
+
+    def is_member(self, room_id, user_id):
+        """Check membership with an indexed point lookup (cached once confirmed)"""
+        if self.room_cache and self.room_cache.has_member(room_id, user_id):
+            return True
+        
+        found = self.memberships.find_one({'room_id': room_id, 'user_id': user_id}, {'_id': 1})
+        if found and self.room_cache:
+            self.room_cache.add_member(room_id, user_id)
+        return found is not None
+
+    def join_room(self, room_id, user_id):
+        """Add user to room members; raises ValueError when the room is full"""
+        try:
+            room = self.get_room_by_id(room_id)
+            if not room:
+                return False
+            # Rejoins (every page load) are answered from the cache, without a majority write
+            if self.is_member(room_id, user_id):
+                return False
+            
+            try:
+                self.memberships.insert_one({
+                    'room_id': room_id,
+                    'user_id': user_id,
+                    'joined_at': datetime.utcnow()
+                })
+            except DuplicateKeyError:
+                return False  # Already a member
+            
+            # Reserve a seat atomically so concurrent joins cannot exceed the cap.
+            # Only private rooms are capped: anyone may read and post in a public
+            # room, so turning away its socket join would only hide broadcasts.
+            query = {'_id': ObjectId(room_id), 'is_active': True}
+            max_members = room.get('settings', {}).get('max_members')
+            if max_members and room.get('is_private'):
+                query['member_count'] = {'$lt': max_members}
+            result = self.rooms.update_one(query, {
+                '$inc': {'member_count': 1},
+                '$set': {'last_activity': datetime.utcnow()}
+            })
+            if result.matched_count == 0:
+                self.memberships.delete_one({'room_id': room_id, 'user_id': user_id})
+                raise ValueError('Room is full')
+            
+            if self.room_cache:
+                self.room_cache.add_member(room_id, user_id, joined=True)
+            self._publish('member_added', {'room_id': room_id, 'user_id': user_id})
+            return True
+        except ValueError:
+            raise
+        except Exception as e:
+            logger.error(f"Error joining room: {e}")
+            return False
+
+    def leave_room(self, room_id, user_id):
+        """Remove user from room members"""
+        try:
+            result = self.memberships.delete_one({'room_id': room_id, 'user_id': user_id})
+            if result.deleted_count == 0:
+                return False
+            
+            self.rooms.update_one(
+                {'_id': ObjectId(room_id)},
+                {
+                    '$inc': {'member_count': -1},
+                    '$set': {'last_activity': datetime.utcnow()}
+                }
+            )
+            if self.room_cache:
+                self.room_cache.remove_member(room_id, user_id)
+            self._publish('member_removed', {'room_id': room_id, 'user_id': user_id})
+            return True
+        except Exception as e:
+            logger.error(f"Error leaving room: {e}")
+            return False
+
+    def migrate_memberships(self, batch_size=1000):
+        """Move embedded members arrays into the memberships collection.
+
+        Idempotent: memberships are upserted and member_count is recomputed
+        from the collection before the array is removed, so an interrupted
+        run can simply be repeated.
+        """
+        migrated = 0
+        for room in self.rooms.find({'members': {'$exists': True}}, {'members': 1, 'created_at': 1}):
+            room_id = str(room['_id'])
+            joined_at = room.get('created_at') or datetime.utcnow()
+            members = room.get('members') or []
+            for start in range(0, len(members), batch_size):
+                operations = [
+                    UpdateOne(
+                        {'room_id': room_id, 'user_id': str(user_id)},
+                        {'$setOnInsert': {'joined_at': joined_at}},
+                        upsert=True
+                    )
+                    for user_id in members[start:start + batch_size]
+                ]
+                self.memberships.bulk_write(operations, ordered=False)
+            
+            member_count = self.memberships.count_documents({'room_id': room_id})
+            self.rooms.update_one(
+                {'_id': room['_id']},
+                {'$set': {'member_count': member_count}, '$unset': {'members': ''}}
+            )
+            if self.room_cache:
+                self.room_cache.invalidate(room_id)
+            migrated += 1
+            logger.info(f"Migrated {len(members)} members of room {room_id}")
+        return migrated
+
+    def needs_membership_migration(self):
+        return self.rooms.find_one({'members': {'$exists': True}}, {'_id': 1}) is not None
+
+    def get_room_messages(self, room_id, page=1, per_page=50, before=None, after=None):
+        """Get messages for a room, newest first.
+
+        ``before``/``after`` are cursors from ``make_cursor`` (or plain message
+        ids) and seek on the ``(room_id, timestamp, _id)`` index, so every page
+        costs the same however far back it is. Without a cursor the legacy
+        ``page`` offset is used.
+        """
+        if before and after:
+            raise ValueError('Use either before or after, not both')
+        cursor = self.parse_cursor(before or after) if (before or after) else None
+        
+        try:
+            if self.buckets:
+                messages = self.buckets.get_page(
+                    room_id, page, per_page,
+                    before=cursor if before else None,
+                    after=cursor if after else None
+                )
+                for message in messages:
+                    message['_id'] = str(message['_id'])
+                return messages
+            
+            query = {'room_id': room_id}
+            sort_order = -1
+            if cursor:
+                timestamp, message_id = cursor
+                if before:
+                    query['timestamp'] = {'$lte': timestamp}
+                    query['$nor'] = [{'timestamp': timestamp, '_id': {'$gte': message_id}}]
+                else:
+                    query['timestamp'] = {'$gte': timestamp}
+                    query['$nor'] = [{'timestamp': timestamp, '_id': {'$lte': message_id}}]
+                    sort_order = 1
+            
+            # Older pages (before cursor or page offset) tolerate a lagging secondary
+            source = self.history if before or (not cursor and page > 1) else self.messages
+            results = source.find(query, MessageSerializer.FIELDS).sort([('timestamp', sort_order), ('_id', sort_order)])
+            if not cursor:
+                results = results.skip((page - 1) * per_page)
+            messages = list(results.limit(per_page))
+            if sort_order == 1:
+                messages.reverse()
+            
+            # Convert ObjectIds to strings
+            for message in messages:
+                message['_id'] = str(message['_id'])
+            
+            return messages
+        except Exception as e:
+            logger.error(f"Error getting messages: {e}")
+            return []
+
+    @staticmethod
+    def make_cursor(document, field='timestamp'):
+        """Build an opaque pagination cursor from a document's timestamp field and id"""
+        timestamp = document[field]
+        millis = calendar.timegm(timestamp.utctimetuple()) * 1000 + timestamp.microsecond // 1000
+        return f"{millis}-{document['_id']}"
+
+    @staticmethod
+    def decode_cursor(cursor):
+        """Split a cursor into (timestamp or None, ObjectId)"""
+        millis, _, document_id = str(cursor).rpartition('-')
+        if not ObjectId.is_valid(document_id):
+            raise ValueError('Invalid cursor')
+        
+        if not millis:
+            return None, ObjectId(document_id)
+        try:
+            return datetime(1970, 1, 1) + timedelta(milliseconds=int(millis)), ObjectId(document_id)
+        except (ValueError, OverflowError):
+            raise ValueError('Invalid cursor')
+
+    def parse_cursor(self, cursor):
+        """Decode a cursor into (timestamp, ObjectId); plain message ids are looked up"""
+        timestamp, message_id = self.decode_cursor(cursor)
+        if timestamp is not None:
+            return timestamp, message_id
+        if self.buckets:
+            # Bucketed messages are not indexed by id; only full cursors can seek
+            raise ValueError('Invalid cursor')
+        
+        message = self.messages.find_one({'_id': message_id}, {'timestamp': 1})
+        if not message:
+            raise ValueError('Cursor message not found')
+        return message['timestamp'], message_id
+
+    def add_message(self, room_id, user_id, username, message, message_type="text"):
+        """Add message and update room activity; returns the message id"""
+        return self.create_message(room_id, user_id, username, message, message_type)['id']
+
+    def create_message(self, room_id, user_id, username, message, message_type="text"):
+        """Add message and update room activity; returns the client payload"""
+        if not room_id or not user_id or not message:
+            raise ValueError('Missing required fields')
+        
+        message_data = {
+            'room_id': room_id,
+            'user_id': user_id,
+            'username': username,
+            'message': message,
+            'message_type': message_type,
+            'timestamp': utcnow(),
+            'is_system': False,
+            'is_edited': False,
+            'reactions': {}
+        }
+        
+        payload = self._store_message(message_data, update_activity=True)
+        logger.info(f"Message added to room {room_id}")
+        return payload
+
+    def add_system_message(self, room_id, message):
+        """Add a system message to the room; returns the message id"""
+        return self.create_system_message(room_id, message)['id']
+
+    def create_system_message(self, room_id, message):
+        """Add a system message to the room; returns the client payload"""
+        message_data = {
+            'room_id': room_id,
+            'user_id': 'system',
+            'username': 'System',
+            'message': message,
+            'message_type': 'system',
+            'timestamp': utcnow(),
+            'is_system': True,
+            'is_edited': False,
+            'reactions': {}
+        }
+        
+        return self._store_message(message_data)
+
+    def _store_message(self, message_data, update_activity=False):
+        """Persist a message (directly or via the write-behind buffer) and return its payload"""
+        if not message_data.get('is_system'):
+            message_data['terms'] = tokenize(message_data['message'])
+        if self.write_behind:
+            # Room activity is folded into the writer's per-flush bulk update
+            self.write_behind.enqueue(message_data)
+        else:
+            if update_activity:
+                self.rooms.update_one(
+                    {'_id': ObjectId(message_data['room_id'])},
+                    {'$set': {'last_activity': message_data['timestamp']}}
+                )
+            if self.buckets:
+                message_data.setdefault('_id', ObjectId())
+                self.buckets.append(message_data['room_id'], [message_data])
+            elif message_data.get('is_system'):
+                self.system_messages.insert_one(message_data)
+            else:
+                self.messages.insert_one(message_data)
+        
+        cursor = self.make_cursor(message_data)
+        payload = self.serializer.payload(message_data)
+        if self.recent_messages:
+            self.recent_messages.append(message_data['room_id'], cursor, payload)
+        self._publish('message_stored', {
+            'room_id': message_data['room_id'],
+            'cursor': cursor,
+            'message': payload
+        })
+        return payload
+
+    def _publish(self, event, payload):
+        if self.publish:
+            try:
+                self.publish(event, payload)
+            except Exception as e:
+                logger.warning(f"Could not publish {event}: {e}")
+
+    def apply_remote_change(self, event, payload):
+        """Apply a change made by another worker to this process's caches"""
+        if event == 'message_stored':
+            self.serializer.remember(payload['message'])
+            if self.recent_messages:
+                self.recent_messages.append(payload['room_id'], payload['cursor'], payload['message'])
+        elif event == 'member_added' and self.room_cache:
+            self.room_cache.add_member(payload['room_id'], payload['user_id'], joined=True)
+        elif event == 'member_removed' and self.room_cache:
+            self.room_cache.remove_member(payload['room_id'], payload['user_id'])
+        elif event == 'public_room_created' and self.room_cache:
+            self.room_cache.invalidate_public_ids()
+
+    def get_accessible_room_ids(self, user_id):
+        """Ids of every active public room plus the user's private rooms"""
+        public_ids = self.room_cache.get_public_ids() if self.room_cache else None
+        if public_ids is None:
+            public_ids = {str(room['_id']) for room in self.rooms.find(
+                {'is_active': True, 'is_private': False}, {'_id': 1}
+            )}
+            if self.room_cache:
+                self.room_cache.put_public_ids(public_ids)
+        room_ids = set(public_ids)
+        room_ids.update(str(room_id) for room_id in self.get_member_room_ids(user_id))
+        return sorted(room_ids)
+
+    def search_messages(self, room_ids, query, limit=20, before=None):
+        """Find messages containing every term of ``query``, newest first.
+
+        Runs on the ``terms`` multikey index (``messages.terms`` in bucket
+        mode), hinted so it can never turn into a collection scan: the longest
+        term bounds the index scan, the others are checked on the fetched
+        documents. ``before`` is a cursor from the previous page. Returns
+        (messages, terms, ignored, next_cursor); ``ignored`` are the words
+        too short or too long to be indexed, which play no part in the match.
+        """
+        terms = sorted(tokenize(query), key=len, reverse=True)
+        ignored = [word for word in tokenize(query, min_length=1, max_length=len(query))
+                   if word not in terms]
+        if not terms:
+            if ignored:
+                raise ValueError('Search words must be 2 to 64 characters long')
+            raise ValueError('Search query must contain at least one word')
+        
+        if self.buckets:
+            messages = self.buckets.search(
+                room_ids, terms, limit + 1, before=self.parse_cursor(before) if before else None
+            )
+        else:
+            messages = self._search_documents(room_ids, terms, limit, before)
+        next_cursor = None
+        if len(messages) > limit:
+            messages = messages[:limit]
+            next_cursor = self.make_cursor(messages[-1])
+        return messages, terms, ignored, next_cursor
+
+    def _search_documents(self, room_ids, terms, limit, before):
+        conditions = {'terms': terms[0] if len(terms) == 1 else {'$all': terms}}
+        conditions['room_id'] = room_ids[0] if len(room_ids) == 1 else {'$in': room_ids}
+        if before:
+            timestamp, message_id = self.parse_cursor(before)
+            conditions['timestamp'] = {'$lte': timestamp}
+            conditions['$nor'] = [{'timestamp': timestamp, '_id': {'$gte': message_id}}]
+        
+        fields = dict(MessageSerializer.FIELDS, room_id=1)
+        return list(self.history.find(conditions, fields)
+                    .sort([('timestamp', -1), ('_id', -1)])
+                    .hint(MESSAGE_SEARCH_INDEX)
+                    .limit(limit + 1))
+
+    def index_message_terms(self, batch_size=1000):
+        """Backfill search terms on messages stored before search existed"""
+        indexed = 0
+        operations = []
+        for message in self.messages.find({'terms': {'$exists': False}, 'is_system': {'$ne': True}},
+                                          {'message': 1}):
+            operations.append(UpdateOne(
+                {'_id': message['_id']},
+                {'$set': {'terms': tokenize(message.get('message') or '')}}
+            ))
+            if len(operations) >= batch_size:
+                self.messages.bulk_write(operations, ordered=False)
+                indexed += len(operations)
+                operations = []
+                logger.info(f"Indexed {indexed} messages")
+        if operations:
+            self.messages.bulk_write(operations, ordered=False)
+            indexed += len(operations)
+        return indexed
+
+    def export_messages(self, room_id, since=None, until=None, batch_size=1000):
+        """Yield every message of a room oldest first, for exports.
+
+        Streams from one server-side cursor over the (room_id, timestamp, _id)
+        index, so memory stays constant however long the history is.
+        ``since`` is inclusive and ``until`` exclusive.
+        """
+        if self.write_behind:
+            # Include messages that were broadcast but not persisted yet
+            self.write_behind.flush(timeout=10)
+        
+        if self.buckets:
+            messages = self.buckets.iter_range(room_id, since, until)
+            try:
+                for message in messages:
+                    yield dict(serialize_message(message), room_id=room_id)
+            finally:
+                messages.close()
+            return
+        
+        query = {'room_id': room_id}
+        if since or until:
+            query['timestamp'] = {}
+            if since:
+                query['timestamp']['$gte'] = since
+            if until:
+                query['timestamp']['$lt'] = until
+        
+        cursor = (self.messages.find(query, MessageSerializer.FIELDS)
+                  .sort([('timestamp', 1), ('_id', 1)])
+                  .batch_size(batch_size))
+        try:
+            for message in cursor:
+                yield dict(serialize_message(message), room_id=room_id)
+        finally:
+            cursor.close()
+
+    def count_messages_after(self, room_id, after, limit=100):
+        """Messages newer than ``after`` (timestamp, ObjectId), counting at most ``limit``.
+
+        Answered from the (room_id, timestamp, _id) index alone, and bounded,
+        so a long-unread room costs no more than ``limit`` index keys.
+        """
+        if self.buckets:
+            return self.buckets.count_after(room_id, after, limit)
+        timestamp, message_id = after
+        return self.messages.count_documents(
+            {
+                'room_id': room_id,
+                'timestamp': {'$gte': timestamp},
+                '$nor': [{'timestamp': timestamp, '_id': {'$lte': message_id}}]
+            },
+            limit=limit,
+            hint=[("room_id", 1), ("timestamp", -1), ("_id", -1)]
+        )
+
+    def get_unread_counts(self, user_id, pending=None, limit=100):
+        """Unread message counts for every room the user belongs to.
+
+        The read position is the furthest of the stored cursor and ``pending``
+        (not yet flushed) positions; rooms never read count from joining.
+        Counts are capped at ``limit``.
+        """
+        pending = pending or {}
+        counts = {}
+        for membership in self.memberships.find(
+                {'user_id': user_id}, {'room_id': 1, 'read_at': 1, 'read_id': 1, 'joined_at': 1}):
+            room_id = membership['room_id']
+            if membership.get('read_at'):
+                position = (membership['read_at'], membership['read_id'])
+            else:
+                position = (membership.get('joined_at') or datetime.min, ObjectId('0' * 24))
+            if room_id in pending and pending[room_id] > position:
+                position = pending[room_id]
+            counts[room_id] = self.count_messages_after(room_id, position, limit)
+        return counts
+
+    def get_history_version(self, room_id):
+        """Validator for a room's history: (cursor of the newest message, its timestamp).
+
+        Answered from the recent-message buffer when it holds the room,
+        otherwise from a single index lookup.
+        """
+        cursor = self.recent_messages.latest_cursor(room_id) if self.recent_messages else None
+        if cursor is None:
+            newest = self.buckets.latest(room_id) if self.buckets else self.messages.find_one(
+                {'room_id': room_id},
+                {'timestamp': 1},
+                sort=[('timestamp', -1), ('_id', -1)]
+            )
+            if not newest:
+                return None, None
+            cursor = self.make_cursor(newest)
+        timestamp, _ = self.decode_cursor(cursor)
+        return cursor, timestamp
+
+    def get_recent_page(self, room_id, per_page):
+        """Newest page of (cursor, serialized message) pairs from memory, or None on a miss"""
+        if not self.recent_messages:
+            return None
+        return self.recent_messages.get_page(room_id, per_page)
+
+    def get_missed_messages(self, room_id, last_seen=None, limit=100):
+        """Messages newer than ``last_seen`` (a message id or cursor), oldest first.
+
+        Returns ``(payloads, complete)``. ``complete`` is False when more than
+        ``limit`` messages were missed or ``last_seen`` cannot be located, in
+        which case no messages are returned and the caller should reload
+        history instead. Positions still in the recent-message buffer are
+        answered from memory.
+        """
+        if last_seen and self.recent_messages:
+            items = self.recent_messages.since(room_id, str(last_seen).rpartition('-')[2])
+            if items is not None:
+                if len(items) > limit:
+                    return [], False
+                return [payload for _, payload in items], True
+        
+        try:
+            messages = self.get_room_messages(room_id, per_page=limit + 1, after=last_seen or None)
+        except ValueError:
+            return [], False
+        if len(messages) > limit:
+            return [], False
+        return [self.serializer.payload(message) for message in reversed(messages)], True
+
+    def remember_recent_page(self, room_id, messages, per_page):
+        """Seed the recent-message buffer from the newest page read from the database.
+
+        Returns the page as (cursor, serialized message) pairs, including any
+        messages written since the read that are not persisted yet.
+        """
+        page = [(self.make_cursor(message), self.serializer.payload(message)) for message in messages]
+        if not self.recent_messages:
+            return page
+        return self.recent_messages.seed(room_id, page, len(messages) < per_page, per_page)
+
+    def close(self):
+        """Flush any buffered writes"""
+        if self.write_behind:
+            self.write_behind.close()
+
+class TypingAggregator:
+    """Tracks who is typing per room and broadcasts coalesced snapshots.
+
+    Instead of relaying every typing_start/typing_stop to the whole room, the
+    state is kept here with an expiry per typist and a ``typing_state``
+    snapshot is emitted at most once per ``interval`` for each room whose
+    set of typists changed.
+    """
+    def __init__(self, socketio_server, interval=0.5, ttl=6.0):
+        self.socketio = socketio_server
+        self.interval = interval
+        self.ttl = ttl
+        self._rooms = {}
+        self._sent = {}
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._running = False
+        # Optional publish(event, payload) callable sharing state with other workers
+        self.publish = None
+        self.stats = {'updates': 0, 'snapshots': 0}
+
+    def start(self):
+        if not self._running:
+            self._running = True
+            threading.Thread(target=self._run, name='typing-aggregator', daemon=True).start()
+
+    def stop(self):
+        self._running = False
+
+    def typing_start(self, room_id, username, remote=False):
+        with self._lock:
+            typists = self._rooms.setdefault(room_id, {})
+            if username not in typists:
+                self._dirty.add(room_id)
+            typists[username] = time.monotonic() + self.ttl
+            self.stats['updates'] += 1
+        if not remote:
+            self._publish('typing_start', room_id, username)
+
+    def typing_stop(self, room_id, username, remote=False):
+        with self._lock:
+            typists = self._rooms.get(room_id)
+            if typists and typists.pop(username, None) is not None:
+                self._dirty.add(room_id)
+            self.stats['updates'] += 1
+        if not remote:
+            self._publish('typing_stop', room_id, username)
+
+    def clear_user(self, username, remote=False):
+        """Drop a user from every room, e.g. when their connection closes"""
+        with self._lock:
+            for room_id, typists in self._rooms.items():
+                if typists.pop(username, None) is not None:
+                    self._dirty.add(room_id)
+        if not remote:
+            self._publish('typing_clear', None, username)
+
+    def apply_remote_change(self, event, payload):
+        if event == 'typing_start':
+            self.typing_start(payload['room_id'], payload['username'], remote=True)
+        elif event == 'typing_stop':
+            self.typing_stop(payload['room_id'], payload['username'], remote=True)
+        elif event == 'typing_clear':
+            self.clear_user(payload['username'], remote=True)
+
+    def _publish(self, event, room_id, username):
+        if self.publish:
+            try:
+                self.publish(event, {'room_id': room_id, 'username': username})
+            except Exception as e:
+                logger.warning(f"Could not publish {event}: {e}")
+
+    def _collect(self):
+        """Expire stale typists and return the snapshots that need sending"""
+        now = time.monotonic()
+        snapshots = []
+        with self._lock:
+            for room_id, typists in list(self._rooms.items()):
+                expired = [username for username, expires_at in typists.items() if expires_at <= now]
+                for username in expired:
+                    del typists[username]
+                if expired:
+                    self._dirty.add(room_id)
+                if not typists:
+                    del self._rooms[room_id]
+
+            for room_id in self._dirty:
+                typing = sorted(self._rooms.get(room_id, ()))
+                if self._sent.get(room_id, []) != typing:
+                    snapshots.append((room_id, typing))
+                    if typing:
+                        self._sent[room_id] = typing
+                    else:
+                        self._sent.pop(room_id, None)
+            self._dirty.clear()
+        return snapshots
+
+    def _run(self):
+        while self._running:
+            time.sleep(self.interval)
+            try:
+                for room_id, typing in self._collect():
+                    # Every worker holds the full state, so each one only
+                    # notifies its own clients
+                    self.socketio.emit('typing_state', {'room_id': room_id, 'typing': typing},
+                                       to=room_id, ignore_queue=True)
+                    self.stats['snapshots'] += 1
+            except Exception as e:
+                logger.error(f"Typing snapshot error: {e}")
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self.stats, rooms=len(self._rooms))
+
+class RoomBroadcastBatcher:
+    """Switches hot rooms from one ``message`` frame per message to ``messages`` batches.
+
+    A room's send rate is measured in one-second windows. Below
+    ``rate_threshold`` messages per second each message is emitted at once;
+    above it, messages are gathered for up to ``window`` seconds (or
+    ``max_batch`` messages) and emitted as a single ``messages`` frame, which
+    cuts the number of frames by the batch size for every member.
+    """
+    def __init__(self, socketio_server, window=0.03, rate_threshold=20, max_batch=100):
+        self.socketio = socketio_server
+        self.window = window
+        self.rate_threshold = rate_threshold
+        self.max_batch = max_batch
+        self._rates = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._running = False
+        self.stats = {'immediate': 0, 'batched': 0, 'batches': 0, 'max_batch_size': 0,
+                      'delay_total': 0.0, 'max_delay': 0.0}
+
+    def start(self):
+        if not self._running:
+            self._running = True
+            threading.Thread(target=self._run, name='broadcast-batcher', daemon=True).start()
+
+    def stop(self):
+        self._running = False
+        self.flush()
+
+    def send(self, room_id, payload):
+        """Broadcast a message payload to a room, batched while the room is hot"""
+        now = time.monotonic()
+        full = None
+        with self._lock:
+            started, count, rate = self._rates.get(room_id, (now, 0, 0.0))
+            if now - started >= 1.0:
+                started, count, rate = now, 0, count / (now - started)
+            count += 1
+            self._rates[room_id] = (started, count, rate)
+            
+            pending = self._pending.get(room_id)
+            if pending is None and max(rate, count) < self.rate_threshold:
+                self.stats['immediate'] += 1
+            else:
+                if pending is None:
+                    pending = self._pending[room_id] = []
+                pending.append((now, payload))
+                if len(pending) >= self.max_batch:
+                    full = self._pending.pop(room_id)
+                payload = None
+        
+        if payload is not None:
+            self.socketio.emit('message', dict(payload, room_id=room_id), to=room_id)
+        elif full:
+            self._emit_batch(room_id, full)
+
+    def flush(self, older_than=0.0):
+        """Emit pending batches whose first message has waited at least ``older_than`` seconds"""
+        now = time.monotonic()
+        with self._lock:
+            due = [room_id for room_id, pending in self._pending.items() if now - pending[0][0] >= older_than]
+            batches = [(room_id, self._pending.pop(room_id)) for room_id in due]
+            # Forget rooms that have gone quiet
+            for room_id in [room_id for room_id, (started, _, _) in self._rates.items() if now - started > 60]:
+                del self._rates[room_id]
+        for room_id, pending in batches:
+            self._emit_batch(room_id, pending)
+
+    def _emit_batch(self, room_id, pending):
+        now = time.monotonic()
+        delay = now - pending[0][0]
+        self.socketio.emit('messages', {
+            'room_id': room_id,
+            'messages': [payload for _, payload in pending]
+        }, to=room_id)
+        with self._lock:
+            self.stats['batches'] += 1
+            self.stats['batched'] += len(pending)
+            self.stats['max_batch_size'] = max(self.stats['max_batch_size'], len(pending))
+            self.stats['delay_total'] += sum(now - queued_at for queued_at, _ in pending)
+            self.stats['max_delay'] = max(self.stats['max_delay'], delay)
+
+    def _run(self):
+        while self._running:
+            time.sleep(self.window / 2)
+            try:
+                self.flush(older_than=self.window)
+            except Exception as e:
+                logger.error(f"Broadcast batch error: {e}")
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats, pending_rooms=len(self._pending), hot_rooms=sum(
+                1 for _, count, rate in self._rates.values() if max(rate, count) >= self.rate_threshold
+            ))
+        delay_total = stats.pop('delay_total')
+        stats['mean_batch_size'] = round(stats['batched'] / stats['batches'], 2) if stats['batches'] else 0
+        stats['mean_delay_ms'] = round(delay_total / stats['batched'] * 1000, 3) if stats['batched'] else 0
+        stats['max_delay_ms'] = round(stats.pop('max_delay') * 1000, 3)
+        return stats
+
+class RoomNoticeAggregator:
+    """Coalesces join/leave notices into one ephemeral summary per room and interval.
+
+    Joins and leaves are collected per room and broadcast as a single
+    ``room_notice`` ("alice and bob joined") every ``interval`` seconds. A
+    leave followed by a join of the same user within the window (a room
+    switch or network blip) cancels out. With ``persist`` set, each summary is
+    stored as one system message and broadcast as a regular ``message``.
+    """
+    MAX_NAMES = 10
+
+    def __init__(self, socketio_server, interval=2.0, persist=None):
+        self.socketio = socketio_server
+        self.interval = interval
+        # Optional persist(room_id, text) returning the stored message payload
+        self.persist = persist
+        self._rooms = {}
+        self._lock = threading.Lock()
+        self._running = False
+        self.stats = {'events': 0, 'cancelled': 0, 'notices': 0, 'persisted': 0, 'failed': 0}
+
+    def start(self):
+        if not self._running:
+            self._running = True
+            threading.Thread(target=self._run, name='room-notices', daemon=True).start()
+
+    def stop(self):
+        self._running = False
+
+    def joined(self, room_id, username):
+        self._record(room_id, username, 'joined', 'left')
+
+    def left(self, room_id, username):
+        self._record(room_id, username, 'left', 'joined')
+
+    def _record(self, room_id, username, kind, opposite):
+        with self._lock:
+            pending = self._rooms.setdefault(room_id, {'joined': {}, 'left': {}})
+            self.stats['events'] += 1
+            if username in pending[opposite]:
+                del pending[opposite][username]
+                self.stats['cancelled'] += 1
+            else:
+                pending[kind][username] = None
+            if not pending['joined'] and not pending['left']:
+                del self._rooms[room_id]
+
+    @staticmethod
+    def describe(joined, left):
+        """Human-readable summary such as: alice and bob joined, 5 people left"""
+        parts = []
+        for names, verb in ((joined, 'joined'), (left, 'left')):
+            if len(names) == 1:
+                parts.append(f"{names[0]} {verb} the room")
+            elif 1 < len(names) <= 3:
+                parts.append(f"{', '.join(names[:-1])} and {names[-1]} {verb}")
+            elif names:
+                parts.append(f"{len(names)} people {verb}")
+        return ', '.join(parts)
+
+    def _collect(self):
+        with self._lock:
+            rooms, self._rooms = self._rooms, {}
+        return [(room_id, list(pending['joined']), list(pending['left']))
+                for room_id, pending in rooms.items()]
+
+    def flush(self):
+        for room_id, joined, left in self._collect():
+            # One room failing to store or send its notice must not drop the others
+            try:
+                self._send(room_id, joined, left)
+            except Exception as e:
+                self.stats['failed'] += 1
+                logger.error(f"Room notice error for {room_id}: {e}")
+
+    def _send(self, room_id, joined, left):
+        text = self.describe(joined, left)
+        if self.persist:
+            message = self.persist(room_id, text)
+            self.socketio.emit('message', dict(message, room_id=room_id), to=room_id)
+            self.stats['persisted'] += 1
+        else:
+            self.socketio.emit('room_notice', {
+                'room_id': room_id,
+                'message': text,
+                'joined': joined[:self.MAX_NAMES],
+                'left': left[:self.MAX_NAMES],
+                'joined_count': len(joined),
+                'left_count': len(left),
+                'timestamp': utcnow().isoformat()
+            }, to=room_id)
+        self.stats['notices'] += 1
+
+    def _run(self):
+        while self._running:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Room notice error: {e}")
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self.stats, pending_rooms=len(self._rooms))
+
+class PresenceRegistry:
+    """In-memory presence: reference-counted connections per user and per room.
+
+    A user is online while at least one of their connections is open, so
+    several tabs no longer flip the status back and forth. Status changes are
+    written to the users collection in periodic bulk batches instead of one
+    majority write per connect/disconnect.
+    """
+    def __init__(self, users, flush_interval=5.0):
+        self.users = users
+        self.flush_interval = flush_interval
+        self._connections = {}
+        self._user_connections = {}
+        self._room_connections = {}
+        self._usernames = {}
+        self._dirty = {}
+        self._lock = threading.Lock()
+        self._running = False
+        # Optional publish(event, payload) callable sharing presence with other workers
+        self.publish = None
+        self.stats = {'flushes': 0, 'writes': 0, 'errors': 0}
+
+    def start(self):
+        if not self._running:
+            self._running = True
+            threading.Thread(target=self._run, name='presence-flush', daemon=True).start()
+
+    def connect(self, sid, user_id, username, remote=False):
+        with self._lock:
+            self._connections[sid] = {'user_id': user_id, 'rooms': set()}
+            self._usernames[user_id] = username
+            sids = self._user_connections.setdefault(user_id, set())
+            sids.add(sid)
+            if len(sids) == 1 and not remote:
+                self._dirty[user_id] = ('online', utcnow())
+        if not remote:
+            self._publish('presence_connect', {'sid': sid, 'user_id': user_id, 'username': username})
+
+    def disconnect(self, sid, remote=False):
+        with self._lock:
+            connection = self._connections.pop(sid, None)
+            if not connection:
+                return
+            user_id = connection['user_id']
+            for room_id in connection['rooms']:
+                self._leave_locked(room_id, user_id)
+            sids = self._user_connections.get(user_id, set())
+            sids.discard(sid)
+            if not sids:
+                self._user_connections.pop(user_id, None)
+                self._usernames.pop(user_id, None)
+                if not remote:
+                    self._dirty[user_id] = ('offline', utcnow())
+        if not remote:
+            self._publish('presence_disconnect', {'sid': sid})
+
+    def join(self, sid, room_id, remote=False):
+        with self._lock:
+            connection = self._connections.get(sid)
+            if not connection or room_id in connection['rooms']:
+                return
+            connection['rooms'].add(room_id)
+            members = self._room_connections.setdefault(room_id, {})
+            members[connection['user_id']] = members.get(connection['user_id'], 0) + 1
+        if not remote:
+            self._publish('presence_join', {'sid': sid, 'room_id': room_id})
+
+    def leave(self, sid, room_id, remote=False):
+        with self._lock:
+            connection = self._connections.get(sid)
+            if not connection or room_id not in connection['rooms']:
+                return
+            connection['rooms'].discard(room_id)
+            self._leave_locked(room_id, connection['user_id'])
+        if not remote:
+            self._publish('presence_leave', {'sid': sid, 'room_id': room_id})
+
+    def _leave_locked(self, room_id, user_id):
+        members = self._room_connections.get(room_id)
+        if not members:
+            return
+        members[user_id] = members.get(user_id, 1) - 1
+        if members[user_id] <= 0:
+            del members[user_id]
+        if not members:
+            del self._room_connections[room_id]
+
+    def set_offline(self, user_id):
+        """Record an explicit logout"""
+        with self._lock:
+            self._dirty[user_id] = ('offline', utcnow())
+
+    def is_online(self, user_id):
+        with self._lock:
+            return user_id in self._user_connections
+
+    def online_in_room(self, room_id):
+        """Users with at least one connection in the room, as (user_id, username) pairs"""
+        with self._lock:
+            members = self._room_connections.get(room_id, {})
+            return [(user_id, self._usernames.get(user_id)) for user_id in members]
+
+    def online_count(self):
+        with self._lock:
+            return len(self._user_connections)
+
+    def apply_remote_change(self, event, payload):
+        if event == 'presence_connect':
+            self.connect(payload['sid'], payload['user_id'], payload['username'], remote=True)
+        elif event == 'presence_disconnect':
+            self.disconnect(payload['sid'], remote=True)
+        elif event == 'presence_join':
+            self.join(payload['sid'], payload['room_id'], remote=True)
+        elif event == 'presence_leave':
+            self.leave(payload['sid'], payload['room_id'], remote=True)
+
+    def _publish(self, event, payload):
+        if self.publish:
+            try:
+                self.publish(event, payload)
+            except Exception as e:
+                logger.warning(f"Could not publish {event}: {e}")
+
+    def flush(self):
+        """Write pending status changes in one bulk operation"""
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+        if not dirty:
+            return
+        
+        operations = []
+        for user_id, (status, last_seen) in dirty.items():
+            if ObjectId.is_valid(user_id):
+                operations.append(UpdateOne(
+                    {'_id': ObjectId(user_id)},
+                    {'$set': {'profile.status': status, 'last_seen': last_seen}}
+                ))
+        if not operations:
+            return
+        
+        try:
+            self.users.bulk_write(operations, ordered=False)
+            self.stats['flushes'] += 1
+            self.stats['writes'] += len(operations)
+        except Exception as e:
+            self.stats['errors'] += 1
+            logger.error(f"Presence flush failed: {e}")
+            with self._lock:
+                # Keep newer changes made while the write was in flight
+                for user_id, change in dirty.items():
+                    self._dirty.setdefault(user_id, change)
+
+    def close(self):
+        self._running = False
+        self.flush()
+
+    def _run(self):
+        while self._running:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self.stats, online_users=len(self._user_connections),
+                        connections=len(self._connections), pending=len(self._dirty))
+
+class ReadCursorTracker:
+    """Per-user, per-room read positions with debounced, monotonic writes.
+
+    Clients report the newest message they have seen as often as they like;
+    only the furthest position per (user, room) is kept in memory and written
+    to the membership documents in one bulk operation per flush interval. The
+    write is conditional, so a stale position never moves a cursor backwards.
+    """
+    def __init__(self, memberships, flush_interval=2.0):
+        self.memberships = memberships
+        self.flush_interval = flush_interval
+        self._dirty = {}
+        self._lock = threading.Lock()
+        self._running = False
+        self.stats = {'updates': 0, 'flushes': 0, 'writes': 0, 'errors': 0}
+
+    def start(self):
+        if not self._running and self.flush_interval > 0:
+            self._running = True
+            threading.Thread(target=self._run, name='read-cursor-flush', daemon=True).start()
+
+    def advance(self, user_id, room_id, timestamp, message_id):
+        """Record that the user has read the room up to (timestamp, message_id)"""
+        position = (timestamp, ObjectId(message_id))
+        with self._lock:
+            self.stats['updates'] += 1
+            current = self._dirty.get((user_id, room_id))
+            if current is None or position > current:
+                self._dirty[(user_id, room_id)] = position
+        if self.flush_interval <= 0:
+            self.flush()
+
+    def pending_for(self, user_id):
+        """Positions of a user not written yet, as {room_id: (timestamp, ObjectId)}"""
+        with self._lock:
+            return {room_id: position for (owner, room_id), position in self._dirty.items() if owner == user_id}
+
+    def flush(self):
+        """Write pending positions in one bulk operation"""
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+        if not dirty:
+            return
+        
+        operations = [
+            UpdateOne(
+                {
+                    'room_id': room_id,
+                    'user_id': user_id,
+                    '$or': [
+                        {'read_at': {'$exists': False}},
+                        {'read_at': {'$lt': timestamp}},
+                        {'read_at': timestamp, 'read_id': {'$lt': message_id}}
+                    ]
+                },
+                {'$set': {'read_at': timestamp, 'read_id': message_id}}
+            )
+            for (user_id, room_id), (timestamp, message_id) in dirty.items()
+        ]
+        try:
+            self.memberships.bulk_write(operations, ordered=False)
+            self.stats['flushes'] += 1
+            self.stats['writes'] += len(operations)
+        except Exception as e:
+            self.stats['errors'] += 1
+            logger.error(f"Read cursor flush failed: {e}")
+            with self._lock:
+                for key, position in dirty.items():
+                    current = self._dirty.get(key)
+                    if current is None or position > current:
+                        self._dirty[key] = position
+
+    def close(self):
+        self._running = False
+        self.flush()
+
+    def _run(self):
+        while self._running:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self.stats, pending=len(self._dirty))
+
+# Token buckets per Socket.IO event as (messages per second, burst), for each
+# connection and for each user across all their connections. Override with
+# e.g. CHATPRO_RATE_LIMIT_SEND_MESSAGE="5/10" or CHATPRO_USER_RATE_LIMIT_SEND_MESSAGE="10/20"
+SOCKET_RATE_LIMITS = {
+    'send_message': {'connection': (10, 20), 'user': (20, 40)},
+    'typing_start': {'connection': (2, 5), 'user': (5, 10)},
+    'typing_stop': {'connection': (2, 5), 'user': (5, 10)},
+    'join_room': {'connection': (2, 10), 'user': (5, 20)},
+    'leave_room': {'connection': (2, 10), 'user': (5, 20)},
+    'mark_read': {'connection': (5, 20), 'user': (10, 40)},
+    'sync': {'connection': (1, 3), 'user': (2, 6)}
+}
+
+def load_rate_limits():
+    """Default socket rate limits merged with CHATPRO_[USER_]RATE_LIMIT_<EVENT> overrides"""
+    limits = {event: dict(scopes) for event, scopes in SOCKET_RATE_LIMITS.items()}
+    for prefix, scope in (('CHATPRO_RATE_LIMIT_', 'connection'), ('CHATPRO_USER_RATE_LIMIT_', 'user')):
+        for key, value in os.environ.items():
+            if not key.startswith(prefix):
+                continue
+            event = key[len(prefix):].lower()
+            if value.strip() in ('', '0', 'off'):
+                limits.setdefault(event, {}).pop(scope, None)
+                continue
+            rate, _, burst = value.partition('/')
+            try:
+                rate = float(rate)
+                limits.setdefault(event, {})[scope] = (rate, float(burst) if burst else max(rate, 1))
+            except ValueError:
+                logger.warning(f"Invalid value for {key}, expected <per second>/<burst>")
+    return limits
+
+class RateLimiter:
+    """Token-bucket limits on Socket.IO events per connection and per user.
+
+    An event is allowed only when both the connection's and the user's
+    bucket for it hold a token. Callers are told about the first denial of
+    a streak, so a flooding client gets one error instead of one per event.
+    """
+    def __init__(self, limits, max_buckets=100000):
+        self.limits = limits
+        self.max_buckets = max_buckets
+        self._buckets = {}
+        self._denied = set()
+        self._lock = threading.Lock()
+        self.stats = {'allowed': 0, 'throttled': {}}
+
+    def check(self, event, sid, user_id):
+        """Return (allowed, notify); ``notify`` is True on the first denial of a streak"""
+        scopes = self.limits.get(event)
+        if not scopes:
+            return True, False
+        
+        now = time.monotonic()
+        keys = [((scope, sid if scope == 'connection' else user_id, event), limit)
+                for scope, limit in scopes.items()]
+        with self._lock:
+            buckets = []
+            for key, (rate, burst) in keys:
+                tokens, updated = self._buckets.get(key, (burst, now))
+                buckets.append((key, min(burst, tokens + (now - updated) * rate)))
+            
+            if all(tokens >= 1 for _, tokens in buckets):
+                for key, tokens in buckets:
+                    self._buckets[key] = (tokens - 1, now)
+                self._denied.discard((sid, event))
+                self.stats['allowed'] += 1
+                if len(self._buckets) > self.max_buckets:
+                    self._prune(now)
+                return True, False
+            
+            for key, tokens in buckets:
+                self._buckets[key] = (tokens, now)
+            self.stats['throttled'][event] = self.stats['throttled'].get(event, 0) + 1
+            notify = (sid, event) not in self._denied
+            self._denied.add((sid, event))
+            return False, notify
+
+    def forget(self, sid):
+        """Drop a closed connection's buckets"""
+        with self._lock:
+            for key in [key for key in self._buckets if key[0] == 'connection' and key[1] == sid]:
+                del self._buckets[key]
+            self._denied = {entry for entry in self._denied if entry[0] != sid}
+
+    def _prune(self, now):
+        # Buckets that have refilled completely behave like new ones
+        for key, (tokens, updated) in list(self._buckets.items()):
+            rate, burst = self.limits[key[2]][key[0]]
+            if tokens + (now - updated) * rate >= burst:
+                del self._buckets[key]
+
+    def get_stats(self):
+        with self._lock:
+            return {'allowed': self.stats['allowed'], 'throttled': dict(self.stats['throttled']),
+                    'buckets': len(self._buckets)}
+
+class OutboundQueueGuard:
+    """Bounds the per-connection send queue of the Engine.IO server.
+
+    Engine.IO queues every outgoing packet per connection without limit, so
+    a client that reads slower than its rooms produce makes the server hold
+    an ever-growing backlog. Once a connection has ``max_queue`` packets
+    waiting, further packets are dropped (``policy='drop'``) or the
+    connection is closed (``policy='disconnect'``) so the client reconnects
+    and catches up with a ``sync`` request.
+    """
+    def __init__(self, eio_server, max_queue=1000, policy='disconnect'):
+        self.eio = eio_server
+        self.max_queue = max_queue
+        self.policy = policy
+        self._send = eio_server.send
+        self._closing = set()
+        self._lock = threading.Lock()
+        self.stats = {'dropped': 0, 'disconnected': 0, 'max_backlog': 0}
+
+    def install(self):
+        self.eio.send = self.send
+        return self
+
+    def send(self, sid, data):
+        eio_socket = self.eio.sockets.get(sid)
+        backlog = eio_socket.queue.qsize() if eio_socket is not None else 0
+        if backlog < self.max_queue:
+            if backlog > self.stats['max_backlog']:
+                with self._lock:
+                    self.stats['max_backlog'] = max(self.stats['max_backlog'], backlog)
+            return self._send(sid, data)
+        
+        with self._lock:
+            self.stats['dropped'] += 1
+            if self.policy != 'disconnect' or sid in self._closing:
+                return
+            self._closing.add(sid)
+            self.stats['disconnected'] += 1
+        logger.warning(f"Disconnecting slow client {sid} with {backlog} queued packets")
+        self.eio.start_background_task(self._disconnect, sid)
+
+    def _disconnect(self, sid):
+        try:
+            self.eio.disconnect(sid)
+        finally:
+            with self._lock:
+                self._closing.discard(sid)
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self.stats, max_queue=self.max_queue, policy=self.policy)
+
+class ClusterEventsMixin:
+    """Carries application-level cluster events over a Socket.IO pub/sub manager.
+
+    Socket.IO traffic (room broadcasts, presence) already fans out through
+    the manager. Cluster events reuse the same channel for state the workers
+    keep in memory, e.g. recent-message buffers, cached membership and who
+    is typing. Frames are JSON so a peer on the backplane can send bad data
+    but never code.
+    """
+    cluster_method = 'chatpro'
+
+    @staticmethod
+    def _encode_frame(data):
+        return json.dumps(data, default=JSONCodec._default, separators=(',', ':')).encode('utf-8')
+
+    @staticmethod
+    def _decode_frame(frame):
+        return json.loads(frame)
+
+    def on_cluster_event(self, handler):
+        """Register ``handler(event, payload)`` for events published by other workers"""
+        self._cluster_handlers = getattr(self, '_cluster_handlers', []) + [handler]
+
+    def publish_cluster_event(self, event, payload):
+        self._publish({'method': self.cluster_method, 'event': event,
+                       'payload': payload, 'host_id': self.host_id})
+
+    def _filter_cluster_events(self, messages):
+        for message in messages:
+            if isinstance(message, bytes):
+                try:
+                    message = self._decode_frame(message)
+                except Exception as e:
+                    logger.warning(f"Dropped malformed backplane frame: {e}")
+                    continue
+            if isinstance(message, dict) and message.get('method') == self.cluster_method:
+                if message.get('host_id') != self.host_id:
+                    for handler in getattr(self, '_cluster_handlers', []):
+                        try:
+                            handler(message['event'], message['payload'])
+                        except Exception as e:
+                            logger.error(f"Cluster event {message['event']} failed: {e}")
+                continue
+            yield message
+
+class InProcessPubSubManager(ClusterEventsMixin, socketio.PubSubManager):
+    """Backplane connecting Socket.IO servers that live in the same process"""
+    name = 'inprocess'
+    _subscribers = {}
+    _subscribers_lock = threading.Lock()
+
+    def __init__(self, channel='socketio', write_only=False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self._queue = queue.Queue()
+        if not write_only:
+            with self._subscribers_lock:
+                self._subscribers.setdefault(channel, []).append(self._queue)
+
+    def _publish(self, data):
+        # Encode so every subscriber gets its own copy, as with a real broker
+        frame = self._encode_frame(data)
+        with self._subscribers_lock:
+            subscribers = list(self._subscribers.get(self.channel, []))
+        for subscriber in subscribers:
+            subscriber.put(frame)
+
+    def _listen(self):
+        def frames():
+            while True:
+                yield self._queue.get()
+        return self._filter_cluster_events(frames())
+
+def is_loopback(host):
+    """Whether ``host`` (an IP address or 'localhost') is on this machine"""
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+def parse_backplane_address(address):
+    """Split ``tcp://host:port`` or ``unix:///path`` into (family, address).
+
+    The hub does not authenticate peers, so TCP addresses must be loopback;
+    use a ``redis://`` or ``amqp://`` backplane across hosts.
+    """
+    if address.startswith('unix://'):
+        return socket.AF_UNIX, address[len('unix://'):]
+    if address.startswith('tcp://'):
+        host, _, port = address[len('tcp://'):].rpartition(':')
+        host = host or '127.0.0.1'
+        if not is_loopback(host):
+            raise ValueError(f"Backplane hub address must be loopback, got {host}")
+        return socket.AF_INET, (host, int(port))
+    raise ValueError(f"Unsupported backplane address: {address}")
+
+def read_frame(sock):
+    """Read one length-prefixed frame, or None when the peer closed the connection"""
+    header = b''
+    while len(header) < 4:
+        chunk = sock.recv(4 - len(header))
+        if not chunk:
+            return None
+        header += chunk
+    size = struct.unpack('!I', header)[0]
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(min(size - len(data), 65536))
+        if not chunk:
+            return None
+        data += chunk
+    return bytes(data)
+
+def write_frame(sock, data):
+    sock.sendall(struct.pack('!I', len(data)) + data)
+
+class LocalSocketPubSubManager(ClusterEventsMixin, socketio.PubSubManager):
+    """Backplane client for a BackplaneHub on a local TCP or Unix socket.
+
+    Connecting gives up after ``connect_timeout`` seconds. While the hub is
+    unreachable, broadcasts are dropped with an error instead of blocking the
+    handler that emitted them.
+    """
+    name = 'localsocket'
+
+    def __init__(self, address, channel='socketio', write_only=False, logger=None, connect_timeout=5):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.family, self.address = parse_backplane_address(address)
+        self.connect_timeout = connect_timeout
+        self._publisher = None
+        self._publish_lock = threading.Lock()
+        self._retry_at = 0
+
+    def _connect(self, role):
+        deadline = time.monotonic() + self.connect_timeout
+        delay = 0.1
+        while True:
+            sock = socket.socket(self.family, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.address)
+                sock.sendall(role)
+                return sock
+            except OSError as e:
+                sock.close()
+                if time.monotonic() + delay > deadline:
+                    raise RuntimeError(f"No backplane hub at {self.address} ({e}); "
+                                       f"run with CHATPRO_WORKERS to start one") from e
+                logger.warning(f"Backplane connection failed ({e}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+                delay = min(delay * 2, 5)
+
+    def _publish(self, data):
+        frame = self._encode_frame(data)
+        with self._publish_lock:
+            if self._publisher is None and time.monotonic() < self._retry_at:
+                logger.error("Dropped backplane message, hub unreachable")
+                return
+            for attempt in range(2):
+                try:
+                    if self._publisher is None:
+                        self._publisher = self._connect(BackplaneHub.PUBLISHER)
+                except RuntimeError as e:
+                    # Back off so a missing hub does not stall every broadcast
+                    self._retry_at = time.monotonic() + self.connect_timeout
+                    logger.error(f"Dropped backplane message: {e}")
+                    return
+                try:
+                    write_frame(self._publisher, frame)
+                    return
+                except OSError:
+                    self._publisher.close()
+                    self._publisher = None
+            logger.error("Dropped backplane message after reconnect failed")
+
+    def _listen(self):
+        def frames():
+            while True:
+                try:
+                    sock = self._connect(BackplaneHub.SUBSCRIBER)
+                except RuntimeError as e:
+                    logger.error(f"Backplane subscription failed: {e}")
+                    time.sleep(self.connect_timeout)
+                    continue
+                try:
+                    while True:
+                        frame = read_frame(sock)
+                        if frame is None:
+                            break
+                        yield frame
+                except OSError as e:
+                    logger.warning(f"Backplane subscription lost: {e}")
+                finally:
+                    sock.close()
+        return self._filter_cluster_events(frames())
+
+class RedisClusterManager(ClusterEventsMixin, socketio.RedisManager):
+    """Redis message queue that also carries cluster events"""
+    name = 'redis-cluster'
+    # python-socketio pickles everything it publishes on these brokers
+    _decode_frame = staticmethod(pickle.loads)
+
+    def _listen(self):
+        return self._filter_cluster_events(super()._listen())
+
+class KombuClusterManager(ClusterEventsMixin, socketio.KombuManager):
+    """Kombu (AMQP, ...) message queue that also carries cluster events"""
+    name = 'kombu-cluster'
+    _decode_frame = staticmethod(pickle.loads)
+
+    def _listen(self):
+        return self._filter_cluster_events(super()._listen())
 
-    def get_room_messages(self, room_id, page=1, per_page=50):
-        """Get paginated messages for a room"""
+class BackplaneHub:
+    """Relays frames from every connected worker to every subscribed worker.
+
+    A minimal local broker so a multi-worker deployment needs no external
+    service. Connections announce themselves with a one-byte role.
+    """
+    PUBLISHER = b'P'
+    SUBSCRIBER = b'S'
+
+    def __init__(self, address):
+        self.family, self.address = parse_backplane_address(address)
+        self._subscribers = {}
+        self._lock = threading.Lock()
+        self._listener = None
+
+    @staticmethod
+    def running(address):
+        """True if a hub already accepts connections at ``address``"""
+        family, address = parse_backplane_address(address)
+        with socket.socket(family, socket.SOCK_STREAM) as sock:
+            sock.settimeout(1)
+            try:
+                sock.connect(address)
+                return True
+            except OSError:
+                return False
+
+    def start(self):
+        if self.family == socket.AF_UNIX and os.path.exists(self.address):
+            os.unlink(self.address)
+        self._listener = socket.socket(self.family, socket.SOCK_STREAM)
+        if self.family == socket.AF_INET:
+            self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listener.bind(self.address)
+        if self.family == socket.AF_UNIX:
+            os.chmod(self.address, 0o600)
+        self._listener.listen(128)
+        threading.Thread(target=self._accept_loop, name='backplane-hub', daemon=True).start()
+        logger.info(f"Backplane hub listening on {self.address}")
+
+    def _accept_loop(self):
+        while True:
+            try:
+                conn, _ = self._listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
         try:
-            skip = (page - 1) * per_page
-            messages = list(self.messages.find({'room_id': room_id})
-                          .sort('timestamp', -1)
-                          .skip(skip)
-                          .limit(per_page))
-            
-            # Convert ObjectIds to strings
-            for message in messages:
-                message['_id'] = str(message['_id'])
-            
-            return messages
-        except Exception as e:
-            logger.error(f"Error getting messages: {e}")
-            return []
+            role = conn.recv(1)
+            if role == self.SUBSCRIBER:
+                with self._lock:
+                    self._subscribers[conn] = threading.Lock()
+            while True:
+                frame = read_frame(conn)
+                if frame is None:
+                    break
+                self._relay(frame)
+        except OSError:
+            pass
+        finally:
+            with self._lock:
+                self._subscribers.pop(conn, None)
+            conn.close()
 
-    def add_message(self, room_id, user_id, username, message, message_type="text"):
-        """Add message and update room activity"""
-        if not room_id or not user_id or not message:
-            raise ValueError('Missing required fields')
-        
-        message_data = {
-            'room_id': room_id,
-            'user_id': user_id,
-            'username': username,
-            'message': message,
-            'message_type': message_type,
-            'timestamp': datetime.utcnow(),
-            'is_system': False,
-            'is_edited': False,
-            'reactions': {}
-        }
-        
-        # Update room's last activity
-        self.rooms.update_one(
-            {'_id': ObjectId(room_id)},
-            {'$set': {'last_activity': datetime.utcnow()}}
-        )
-        
-        result = self.messages.insert_one(message_data)
-        logger.info(f"Message added to room {room_id}")
-        return str(result.inserted_id)
+    def _relay(self, frame):
+        with self._lock:
+            subscribers = list(self._subscribers.items())
+        for conn, send_lock in subscribers:
+            try:
+                with send_lock:
+                    write_frame(conn, frame)
+            except OSError:
+                with self._lock:
+                    self._subscribers.pop(conn, None)
 
-    def add_system_message(self, room_id, message):
-        """Add a system message to the room"""
-        message_data = {
-            'room_id': room_id,
-            'user_id': 'system',
-            'username': 'System',
-            'message': message,
-            'message_type': 'system',
-            'timestamp': datetime.utcnow(),
-            'is_system': True,
-            'is_edited': False,
-            'reactions': {}
-        }
-        
-        result = self.messages.insert_one(message_data)
-        return str(result.inserted_id)
+    def close(self):
+        if self._listener:
+            self._listener.close()
+        if self.family == socket.AF_UNIX and os.path.exists(self.address):
+            os.unlink(self.address)
+
+class StickyDispatcher:
+    """Accepts connections on the public port and hands each one to a worker.
+
+    The worker is chosen from a hash of the client IP, so every HTTP request
+    and Socket.IO transport of a client (polling included) lands on the same
+    process. Sockets are passed with SCM_RIGHTS, so no bytes are proxied.
+    """
+    def __init__(self, host, port, channels):
+        self.host = host
+        self.port = port
+        self.channels = channels
+
+    def worker_for(self, client_ip):
+        return zlib.crc32(client_ip.encode()) % len(self.channels)
+
+    def serve_forever(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((self.host, self.port))
+        listener.listen(1024)
+        logger.info(f"Dispatching connections on {self.host}:{self.port} to {len(self.channels)} workers")
+        try:
+            while True:
+                conn, address = listener.accept()
+                try:
+                    channel = self.channels[self.worker_for(address[0])]
+                    socket.send_fds(channel, [json.dumps(address[:2]).encode()], [conn.fileno()])
+                except OSError as e:
+                    logger.error(f"Could not hand connection to worker: {e}")
+                finally:
+                    conn.close()
+        finally:
+            listener.close()
 
 class ChatApplication:
     """Enhanced main application class"""
     def __init__(self):
+        self._shut_down = False
+        
         # Initialize Flask app with correct template structure for your project
         self.app = Flask(__name__, 
                         template_folder='static/templates', 
@@ -360,20 +3476,187 @@ class ChatApplication:
             MAX_CONTENT_LENGTH=16 * 1024 * 1024  # 16MB max file upload
         )
         
+        # Performance settings, overridable from the environment
+        self.app.config.update(
+            MESSAGE_WRITE_BEHIND=env_flag('CHATPRO_WRITE_BEHIND'),
+            MESSAGE_BUCKET_SIZE=env_int('CHATPRO_MESSAGE_BUCKET_SIZE', 0),
+            MESSAGE_WRITE_BATCH_SIZE=env_int('CHATPRO_WRITE_BATCH_SIZE', 500),
+            MESSAGE_WRITE_INTERVAL=env_float('CHATPRO_WRITE_INTERVAL', 0.05),
+            MESSAGE_WRITE_MAX_PENDING=env_int('CHATPRO_WRITE_MAX_PENDING', 50000),
+            BACKPLANE=os.environ.get('CHATPRO_BACKPLANE', ''),
+            ROOM_CACHE_SIZE=env_int('CHATPRO_ROOM_CACHE_SIZE', 1024),
+            ROOM_CACHE_TTL=env_float('CHATPRO_ROOM_CACHE_TTL', 60),
+            HTTP_COMPRESSION_MIN_SIZE=env_int('CHATPRO_HTTP_COMPRESSION_MIN_SIZE', 1024),
+            HTTP_COMPRESSION_LEVEL=env_int('CHATPRO_HTTP_COMPRESSION_LEVEL', 6),
+            SOCKET_COMPRESSION=env_flag('CHATPRO_SOCKET_COMPRESSION', True),
+            SOCKET_COMPRESSION_THRESHOLD=env_int('CHATPRO_SOCKET_COMPRESSION_THRESHOLD', 1024),
+            JSON_ENCODER=os.environ.get('CHATPRO_JSON_ENCODER', 'auto').strip().lower(),
+            MESSAGE_CACHE_SIZE=env_int('CHATPRO_MESSAGE_CACHE_SIZE', 10000),
+            EXPORT_BATCH_SIZE=env_int('CHATPRO_EXPORT_BATCH_SIZE', 1000),
+            ROOM_DIRECTORY_LIMIT=env_int('CHATPRO_ROOM_DIRECTORY_LIMIT', 100),
+            RECENT_MESSAGES_PER_ROOM=env_int('CHATPRO_RECENT_MESSAGES_PER_ROOM', 100),
+            RECENT_MESSAGES_MAX_TOTAL=env_int('CHATPRO_RECENT_MESSAGES_MAX_TOTAL', 100000),
+            RECENT_MESSAGES_IDLE_TTL=env_float('CHATPRO_RECENT_MESSAGES_IDLE_TTL', 900),
+            TYPING_INTERVAL=env_float('CHATPRO_TYPING_INTERVAL', 0.5),
+            TYPING_TTL=env_float('CHATPRO_TYPING_TTL', 6),
+            PRESENCE_FLUSH_INTERVAL=env_float('CHATPRO_PRESENCE_FLUSH_INTERVAL', 5),
+            BROADCAST_BATCH_WINDOW=env_float('CHATPRO_BROADCAST_BATCH_WINDOW', 0),
+            BROADCAST_BATCH_RATE=env_float('CHATPRO_BROADCAST_BATCH_RATE', 20),
+            BROADCAST_BATCH_MAX=env_int('CHATPRO_BROADCAST_BATCH_MAX', 100),
+            METRICS=env_flag('CHATPRO_METRICS', True),
+            METRICS_TOKEN=os.environ.get('CHATPRO_METRICS_TOKEN', ''),
+            RATE_LIMITS=env_flag('CHATPRO_RATE_LIMITS', True),
+            OUTBOUND_QUEUE_LIMIT=env_int('CHATPRO_OUTBOUND_QUEUE_LIMIT', 1000),
+            OUTBOUND_QUEUE_POLICY=os.environ.get('CHATPRO_OUTBOUND_QUEUE_POLICY', 'disconnect').strip().lower(),
+            ROOM_NOTICE_INTERVAL=env_float('CHATPRO_ROOM_NOTICE_INTERVAL', 0),
+            ROOM_NOTICE_PERSIST=env_flag('CHATPRO_ROOM_NOTICE_PERSIST'),
+            READ_CURSOR_FLUSH_INTERVAL=env_float('CHATPRO_READ_CURSOR_FLUSH_INTERVAL', 2),
+            MONGO_STATS_LOG_INTERVAL=env_float('CHATPRO_MONGO_STATS_LOG_INTERVAL', 60),
+            UNREAD_COUNT_LIMIT=env_int('CHATPRO_UNREAD_COUNT_LIMIT', 99),
+            SYNC_MESSAGE_LIMIT=env_int('CHATPRO_SYNC_MESSAGE_LIMIT', 100),
+            SYNC_MAX_ROOMS=env_int('CHATPRO_SYNC_MAX_ROOMS', 50),
+            PASSWORD_HASH_METHOD=os.environ.get('CHATPRO_PASSWORD_HASH_METHOD', 'pbkdf2:sha256'),
+            PASSWORD_HASH_WORKERS=env_int('CHATPRO_PASSWORD_HASH_WORKERS', 2),
+            PASSWORD_HASH_MAX_PENDING=env_int('CHATPRO_PASSWORD_HASH_MAX_PENDING', 64),
+            BULK_HASH_WORKERS=env_int('CHATPRO_BULK_HASH_WORKERS', max(1, (os.cpu_count() or 2) // 2)),
+            BULK_MAX_ROWS=env_int('CHATPRO_BULK_MAX_ROWS', 10000),
+            BULK_MAX_FAILURES=env_int('CHATPRO_BULK_MAX_FAILURES', 1000),
+            ADMIN_USERS={name.strip() for name in os.environ.get('CHATPRO_ADMIN_USERS', '').split(',') if name.strip()}
+        )
+        
+        # One encoder for history responses and Socket.IO frames
+        self.codec = JSONCodec(self.app.config['JSON_ENCODER'])
+        
         # Initialize Socket.IO with enhanced configuration
         self.socketio = SocketIO(
             self.app, 
             cors_allowed_origins="*", 
             logger=False,  # Disable Socket.IO logging for cleaner output
             engineio_logger=False,
-            async_mode='threading'
+            async_mode=ASYNC_MODE,
+            json=self.codec,
+            # Long-polling payloads; websocket frames use permessage-deflate when the client offers it
+            http_compression=self.app.config['SOCKET_COMPRESSION'],
+            compression_threshold=self.app.config['SOCKET_COMPRESSION_THRESHOLD'],
+            **self._backplane_options()
         )
         
         # Initialize MongoDB and managers
         try:
             self.mongo_manager = MongoDBManager()
-            self.user_manager = UserManager(self.mongo_manager)
-            self.room_manager = RoomManager(self.mongo_manager)
+            self.mongo_manager.start_stats_log(self.app.config['MONGO_STATS_LOG_INTERVAL'])
+            self.user_manager = UserManager(
+                self.mongo_manager,
+                PasswordHasher(
+                    method=self.app.config['PASSWORD_HASH_METHOD'],
+                    workers=self.app.config['PASSWORD_HASH_WORKERS'],
+                    max_pending=self.app.config['PASSWORD_HASH_MAX_PENDING']
+                )
+            )
+            # Bulk provisioning hashes on its own pool so an import never queues ahead of logins
+            self.bulk_user_manager = UserManager(
+                self.mongo_manager,
+                PasswordHasher(
+                    method=self.app.config['PASSWORD_HASH_METHOD'],
+                    workers=self.app.config['BULK_HASH_WORKERS']
+                )
+            )
+            self.message_buckets = self._create_message_buckets()
+            self.room_manager = RoomManager(
+                self.mongo_manager,
+                write_behind=self._create_write_behind(),
+                room_cache=self._create_room_cache(),
+                recent_messages=self._create_recent_messages(),
+                serializer=MessageSerializer(self.codec, self.app.config['MESSAGE_CACHE_SIZE']),
+                buckets=self.message_buckets
+            )
+            if self.room_manager.needs_membership_migration():
+                logger.warning("Some rooms still embed a members array; run 'python app.py migrate-memberships'")
+            if self.message_buckets and self.mongo_manager.get_collection("messages").find_one({}, {'_id': 1}):
+                logger.warning("Bucket storage is enabled but unbucketed messages remain; "
+                               "run 'python app.py migrate-message-buckets'")
+            
+            # Coalesced typing indicators (interval 0 keeps per-event broadcasts)
+            self.typing = None
+            if self.app.config['TYPING_INTERVAL'] > 0:
+                self.typing = TypingAggregator(
+                    self.socketio,
+                    interval=self.app.config['TYPING_INTERVAL'],
+                    ttl=self.app.config['TYPING_TTL']
+                )
+                self.typing.start()
+            
+            # Micro-batched message frames for hot rooms (window 0 emits every message at once)
+            self.broadcast_batcher = None
+            if self.app.config['BROADCAST_BATCH_WINDOW'] > 0:
+                self.broadcast_batcher = RoomBroadcastBatcher(
+                    self.socketio,
+                    window=self.app.config['BROADCAST_BATCH_WINDOW'],
+                    rate_threshold=self.app.config['BROADCAST_BATCH_RATE'],
+                    max_batch=self.app.config['BROADCAST_BATCH_MAX']
+                )
+                self.broadcast_batcher.start()
+            
+            # Coalesced, ephemeral join/leave notices (interval 0 stores a system message per event)
+            self.room_notices = None
+            if self.app.config['ROOM_NOTICE_INTERVAL'] > 0:
+                self.room_notices = RoomNoticeAggregator(
+                    self.socketio,
+                    interval=self.app.config['ROOM_NOTICE_INTERVAL'],
+                    persist=self.room_manager.create_system_message if self.app.config['ROOM_NOTICE_PERSIST'] else None
+                )
+                self.room_notices.start()
+            
+            # Presence registry (interval 0 keeps per-event status writes)
+            self.presence = None
+            if self.app.config['PRESENCE_FLUSH_INTERVAL'] > 0:
+                self.presence = PresenceRegistry(
+                    self.user_manager.status_users,
+                    flush_interval=self.app.config['PRESENCE_FLUSH_INTERVAL']
+                )
+                self.presence.start()
+            
+            # Read positions (interval 0 writes every update through)
+            self.read_cursors = ReadCursorTracker(
+                self.mongo_manager.get_collection("memberships", "presence"),
+                flush_interval=self.app.config['READ_CURSOR_FLUSH_INTERVAL']
+            )
+            self.read_cursors.start()
+            
+            # Token-bucket limits per connection and per user on client events
+            self.rate_limiter = RateLimiter(load_rate_limits()) if self.app.config['RATE_LIMITS'] else None
+            
+            # Bounded per-connection send queues for slow consumers
+            self.outbound_guard = None
+            if self.app.config['OUTBOUND_QUEUE_LIMIT'] > 0:
+                self.outbound_guard = OutboundQueueGuard(
+                    self.socketio.server.eio,
+                    max_queue=self.app.config['OUTBOUND_QUEUE_LIMIT'],
+                    policy=self.app.config['OUTBOUND_QUEUE_POLICY']
+                ).install()
+            
+            # Keep in-memory room state consistent across workers
+            server = self.socketio.server
+            if isinstance(server.manager, ClusterEventsMixin):
+                self.room_manager.publish = server.manager.publish_cluster_event
+                server.manager.on_cluster_event(self.room_manager.apply_remote_change)
+                if self.typing:
+                    self.typing.publish = server.manager.publish_cluster_event
+                    server.manager.on_cluster_event(self.typing.apply_remote_change)
+                if self.presence:
+                    self.presence.publish = server.manager.publish_cluster_event
+                    server.manager.on_cluster_event(self.presence.apply_remote_change)
+                # Subscribe now rather than on the first socket connection, so
+                # workers without clients yet still receive cache updates
+                if not server.manager_initialized:
+                    server.manager_initialized = True
+                    server.manager.initialize()
+            elif self.app.config['BACKPLANE']:
+                # Other workers would never hear about new messages or members
+                logger.warning(f"Backplane {type(server.manager).__name__} cannot carry cluster "
+                               f"events; disabling the recent message buffer and room cache")
+                self.room_manager.recent_messages = None
+                self.room_manager.room_cache = None
             
             # Create default general room if it doesn't exist
             self.create_default_room()
@@ -382,11 +3665,80 @@ class ChatApplication:
             logger.critical("Failed to initialize database: %s", e)
             raise
         
+        self.metrics = self._create_metrics() if self.app.config['METRICS'] else None
+        
         # Register routes and socket events
         self._register_routes()
         self._register_socket_events()
         self._register_error_handlers()
 
+    def _backplane_options(self):
+        """SocketIO arguments for the configured pub/sub backplane.
+
+        ``memory`` connects servers in one process, ``tcp://`` and ``unix://``
+        use a BackplaneHub, and ``redis://``/``amqp://`` use a message queue
+        that also carries cluster events. ``kafka://`` and ``zmq+...`` go to
+        Flask-SocketIO's own message queue support, without cluster events.
+        Any other scheme is rejected.
+        """
+        backplane = self.app.config['BACKPLANE']
+        if not backplane:
+            return {}
+        logger.info(f"Using pub/sub backplane: {backplane}")
+        if backplane == 'memory':
+            return {'client_manager': InProcessPubSubManager()}
+        if backplane.startswith(('tcp://', 'unix://')):
+            return {'client_manager': LocalSocketPubSubManager(backplane)}
+        if backplane.startswith(('redis://', 'rediss://')):
+            return {'client_manager': RedisClusterManager(backplane, channel='flask-socketio')}
+        if backplane.startswith(('amqp://', 'amqps://')):
+            return {'client_manager': KombuClusterManager(backplane, channel='flask-socketio')}
+        if backplane.startswith(('kafka://', 'zmq+')):
+            return {'message_queue': backplane}
+        raise ValueError(f"Unsupported CHATPRO_BACKPLANE: {backplane}")
+
+    def _create_write_behind(self):
+        """Build the batched message writer if it is enabled"""
+        config = self.app.config
+        if not config['MESSAGE_WRITE_BEHIND']:
+            return None
+        
+        logger.info("Write-behind message persistence enabled")
+        return MessageWriteBehind(
+            self.message_buckets or self.mongo_manager.get_collection("messages", "messages"),
+            self.mongo_manager.get_collection("rooms", "rooms"),
+            max_batch=config['MESSAGE_WRITE_BATCH_SIZE'],
+            flush_interval=config['MESSAGE_WRITE_INTERVAL'],
+            max_pending=config['MESSAGE_WRITE_MAX_PENDING']
+        )
+
+    def _create_message_buckets(self):
+        """Build the bucketed message store if a bucket size is configured"""
+        if self.app.config['MESSAGE_BUCKET_SIZE'] <= 0:
+            return None
+        logger.info(f"Storing messages in buckets of {self.app.config['MESSAGE_BUCKET_SIZE']}")
+        return MessageBucketStore(
+            self.mongo_manager.get_collection("message_buckets", "messages"),
+            self.app.config['MESSAGE_BUCKET_SIZE']
+        )
+
+    def _create_room_cache(self):
+        """Build the room metadata cache unless its size is set to 0"""
+        if self.app.config['ROOM_CACHE_SIZE'] <= 0:
+            return None
+        return RoomCache(self.app.config['ROOM_CACHE_SIZE'], self.app.config['ROOM_CACHE_TTL'])
+
+    def _create_recent_messages(self):
+        """Build the per-room recent message buffer unless it is set to 0"""
+        config = self.app.config
+        if config['RECENT_MESSAGES_PER_ROOM'] <= 0:
+            return None
+        return RecentMessageBuffer(
+            per_room=config['RECENT_MESSAGES_PER_ROOM'],
+            max_messages=config['RECENT_MESSAGES_MAX_TOTAL'],
+            idle_ttl=config['RECENT_MESSAGES_IDLE_TTL']
+        )
+
     def create_default_room(self):
         """Create a default 'General' room if it doesn't exist"""
         try:
@@ -410,9 +3762,74 @@ class ChatApplication:
         except Exception as e:
             logger.warning(f"Could not create default room: {e}")
 
+    def _create_metrics(self):
+        """Latency histograms and scrape-time gauges served at /metrics"""
+        metrics = MetricsRegistry()
+        self.socket_latency = metrics.histogram(
+            'chatpro_socket_event_duration_seconds', 'Socket.IO handler latency', ('event',))
+        self.http_latency = metrics.histogram(
+            'chatpro_http_request_duration_seconds', 'HTTP request latency', ('method', 'route', 'status'))
+        metrics.register(self.mongo_manager.command_metrics.commands)
+        
+        server = self.socketio.server
+        
+        def socket_rooms():
+            # Each connection is also in a room named after its sid; skip those
+            rooms = list(server.manager.rooms.get('/', {}).items())
+            return [len(members) for room, members in rooms if room is not None and room not in members]
+        
+        metrics.gauge('chatpro_connected_sockets', 'Open Engine.IO connections in this process',
+                      lambda: len(server.eio.sockets))
+        metrics.gauge('chatpro_active_rooms', 'Rooms with at least one subscribed connection',
+                      lambda: len(socket_rooms()))
+        metrics.gauge('chatpro_room_members', 'Connections subscribed to rooms, summed and largest room',
+                      lambda: [((('stat', 'total'),), sum(socket_rooms())),
+                               ((('stat', 'max'),), max(socket_rooms(), default=0))])
+        metrics.gauge('chatpro_outbound_queued_packets', 'Packets waiting in per-connection send queues',
+                      lambda: sum(socket.queue.qsize() for socket in list(server.eio.sockets.values())))
+        metrics.gauge('chatpro_threads', 'Live threads in this process', threading.active_count)
+        metrics.gauge('chatpro_mongo_connections', 'MongoDB connections by state',
+                      lambda: [((('state', state),), count)
+                               for state, count in self.mongo_manager.command_metrics.connections.items()])
+        metrics.gauge('chatpro_password_hash_pending', 'Password hashes queued or running',
+                      lambda: self.user_manager.hasher.stats['pending'])
+        if self.presence:
+            metrics.gauge('chatpro_online_users', 'Users with at least one open connection',
+                          self.presence.online_count)
+        if self.room_manager.write_behind:
+            metrics.gauge('chatpro_message_write_pending', 'Messages waiting for the write-behind flush',
+                          self.room_manager.write_behind.pending_count)
+        if self.rate_limiter:
+            metrics.counter('chatpro_socket_events_throttled_total', 'Socket.IO events dropped by rate limits',
+                            lambda: [((('event', event),), count) for event, count
+                                     in self.rate_limiter.get_stats()['throttled'].items()])
+        if self.outbound_guard:
+            metrics.counter('chatpro_outbound_packets_dropped_total', 'Packets over the send queue limit',
+                            lambda: self.outbound_guard.stats['dropped'])
+            metrics.counter('chatpro_slow_clients_disconnected_total', 'Connections closed for a full send queue',
+                            lambda: self.outbound_guard.stats['disconnected'])
+        return metrics
+
+    def _start_request_timer(self):
+        g.request_started = time.perf_counter()
+
+    def _observe_request(self, response):
+        started = g.pop('request_started', None)
+        if started is not None:
+            # Route templates, not raw paths, keep the label set bounded
+            route = request.url_rule.rule if request.url_rule else 'unmatched'
+            self.http_latency.observe(time.perf_counter() - started, request.method, route, str(response.status_code))
+        return response
+
     def _register_routes(self):
         """Register all Flask routes with enhanced functionality"""
         
+        if self.metrics:
+            # Registered first so it runs last and includes compression time
+            self.app.before_request(self._start_request_timer)
+            self.app.after_request(self._observe_request)
+        self.app.after_request(self._compress_response)
+        
         @self.app.route('/')
         def home():
             if 'user_id' in session:
@@ -480,15 +3897,18 @@ class ChatApplication:
                 return redirect(url_for('login'))
             
             try:
-                # Get user's rooms
-                public_rooms = self.room_manager.get_all_public_rooms()
-                user_rooms = self.room_manager.get_user_rooms(session['user_id'])
+                # Get the most active rooms the user can see
+                rooms, _ = self.room_manager.get_room_directory(
+                    session['user_id'], limit=self.app.config['ROOM_DIRECTORY_LIMIT']
+                )
                 
-                # Convert ObjectIds to strings and add member counts
-                for room in public_rooms + user_rooms:
+                # Convert ObjectIds to strings
+                for room in rooms:
                     room['_id'] = str(room['_id'])
                     room['created_by'] = str(room['created_by'])
-                    room['member_count'] = len(room.get('members', []))
+                    room.setdefault('member_count', 0)
+                public_rooms = [room for room in rooms if not room.get('is_private')]
+                user_rooms = [room for room in rooms if room.get('is_private')]
                 
                 return render_template('chat.html',
                                    username=session['username'],
@@ -504,7 +3924,10 @@ class ChatApplication:
         def logout():
             if 'user_id' in session:
                 # Update user status to offline
-                self.user_manager.update_user_status(session['user_id'], 'offline')
+                if self.presence:
+                    self.presence.set_offline(session['user_id'])
+                else:
+                    self.user_manager.update_user_status(session['user_id'], 'offline')
             
             session.clear()
             return redirect(url_for('home'))
@@ -545,24 +3968,36 @@ class ChatApplication:
                     logger.error("Room creation error: %s", e)
                     return jsonify({'error': 'Could not create room'}), 500
             
-            # GET all rooms user can access
+            # GET rooms user can access, one page at a time
             try:
-                public_rooms = self.room_manager.get_all_public_rooms()
-                user_rooms = self.room_manager.get_user_rooms(session['user_id'])
+                version, last_modified = self.room_manager.get_directory_version(session['user_id'])
+                if not self._is_modified(version, last_modified):
+                    return self._not_modified(version, last_modified)
+                
+                limit = min(int(request.args.get('limit', self.app.config['ROOM_DIRECTORY_LIMIT'])), 500)
+                try:
+                    directory, next_cursor = self.room_manager.get_room_directory(
+                        session['user_id'], limit=max(limit, 1), cursor=request.args.get('cursor')
+                    )
+                except ValueError as e:
+                    return jsonify({'error': str(e)}), 400
                 
                 rooms = []
-                for room in public_rooms + user_rooms:
+                for room in directory:
                     rooms.append({
                         'id': str(room['_id']),
                         'name': room['name'],
                         'description': room.get('description', ''),
                         'created_by': str(room['created_by']),
                         'is_private': room.get('is_private', False),
-                        'member_count': len(room.get('members', [])),
+                        'member_count': room.get('member_count', 0),
                         'last_activity': room.get('last_activity').isoformat() if room.get('last_activity') else None
                     })
                 
-                return jsonify(rooms)
+                response = self._with_validators(jsonify(rooms), version, last_modified)
+                if next_cursor:
+                    response.headers['Link'] = f'<{url_for("handle_rooms", limit=limit, cursor=next_cursor)}>; rel="next"'
+                return response
                 
             except Exception as e:
                 logger.error("Room fetch error: %s", e)
@@ -574,64 +4009,363 @@ class ChatApplication:
                 return jsonify({'error': 'Unauthorized'}), 401
             
             try:
-                page = int(request.args.get('page', 1))
+                page = max(int(request.args.get('page', 1)), 1)
                 per_page = min(int(request.args.get('per_page', 50)), 100)  # Max 100 messages
+                before = request.args.get('before')
+                after = request.args.get('after')
                 
                 # Check if user has access to this room
                 room = self.room_manager.get_room_by_id(room_id)
                 if not room:
                     return jsonify({'error': 'Room not found'}), 404
                 
-                if room['is_private'] and session['user_id'] not in room.get('members', []):
+                if room['is_private'] and not self.room_manager.is_member(room_id, session['user_id']):
                     return jsonify({'error': 'Access denied'}), 403
                 
-                messages = self.room_manager.get_room_messages(room_id, page, per_page)
+                # Any new message changes the newest cursor, so it validates every page
+                newest_cursor, last_modified = self.room_manager.get_history_version(room_id)
+                version = newest_cursor or 'empty'
+                if not self._is_modified(version, last_modified):
+                    return self._not_modified(version, last_modified)
                 
-                formatted_messages = []
-                for message in messages:
-                    formatted_messages.append({
-                        'id': str(message['_id']),
-                        'user_id': str(message['user_id']),
-                        'username': message['username'],
-                        'message': message['message'],
-                        'message_type': message.get('message_type', 'text'),
-                        'timestamp': message['timestamp'].isoformat(),
-                        'is_system': message.get('is_system', False),
-                        'is_edited': message.get('is_edited', False)
-                    })
+                # The newest page is usually served from the in-memory buffer
+                newest_page = page == 1 and not before and not after
+                recent = self.room_manager.get_recent_page(room_id, per_page) if newest_page else None
+                
+                if recent is None:
+                    try:
+                        messages = self.room_manager.get_room_messages(
+                            room_id, page, per_page, before=before, after=after
+                        )
+                    except ValueError as e:
+                        return jsonify({'error': str(e)}), 400
+                    
+                    if newest_page:
+                        recent = self.room_manager.remember_recent_page(room_id, messages, per_page)
+                    else:
+                        recent = [(self.room_manager.make_cursor(message),
+                                   self.room_manager.serializer.payload(message))
+                                  for message in messages]
+                
+                cursors = [cursor for cursor, _ in recent]
                 
-                return jsonify({
-                    'messages': formatted_messages,
+                # Cursor for continuing in the same direction: older for before/page, newer for after
+                next_cursor = None
+                if len(cursors) == per_page:
+                    next_cursor = cursors[0] if after else cursors[-1]
+                
+                # Splice the cached per-message encodings into the envelope
+                envelope = self.codec.dumps_bytes({
                     'page': page,
                     'per_page': per_page,
+                    'next_cursor': next_cursor,
                     'room_name': room['name']
                 })
+                body = (b'{"messages":' + self.room_manager.serializer.encode_list(payload for _, payload in recent)
+                        + b',' + envelope[1:])
+                response = self.app.response_class(body, mimetype='application/json')
+                return self._with_validators(response, version, last_modified)
                 
             except Exception as e:
                 logger.error("Messages fetch error: %s", e)
                 return jsonify({'error': 'Could not fetch messages'}), 500
 
+        @self.app.route('/api/users/bulk', methods=['POST'])
+        def bulk_provision_users():
+            if 'user_id' not in session:
+                return jsonify({'error': 'Unauthorized'}), 401
+            
+            if session['username'] not in self.app.config['ADMIN_USERS']:
+                return jsonify({'error': 'Access denied'}), 403
+            
+            try:
+                fmt = 'csv' if 'csv' in (request.content_type or '') else 'ndjson'
+                stream = io.TextIOWrapper(request.stream, encoding='utf-8', newline='')
+                
+                max_rows = self.app.config['BULK_MAX_ROWS']
+                max_failures = self.app.config['BULK_MAX_FAILURES']
+                rows = iter_user_rows(stream, fmt)
+                summary = {'created': 0, 'duplicate': 0, 'invalid': 0, 'error': 0}
+                failures = []
+                for result in self.bulk_user_manager.bulk_register(islice(rows, max_rows)):
+                    summary[result['status']] += 1
+                    if result['status'] != 'created' and len(failures) < max_failures:
+                        failures.append(result)
+                
+                response = {'summary': summary, 'failures': failures}
+                omitted = sum(summary.values()) - summary['created'] - len(failures)
+                if omitted:
+                    response['failures_omitted'] = omitted
+                if next(rows, None) is not None:
+                    # Larger imports belong on the CLI, which streams its failure report
+                    response['truncated'] = True
+                    response['message'] = (f"Stopped after {max_rows} rows; use "
+                                           f"'python app.py provision-users' for larger imports")
+                return jsonify(response)
+                
+            except Exception as e:
+                logger.error("Bulk provisioning error: %s", e)
+                return jsonify({'error': 'Could not provision users'}), 500
+
+        @self.app.route('/api/search')
+        def search_messages():
+            if 'user_id' not in session:
+                return jsonify({'error': 'Unauthorized'}), 401
+            
+            query = request.args.get('q', '').strip()
+            if not query:
+                return jsonify({'error': 'Search query is required'}), 400
+            
+            try:
+                limit = min(max(int(request.args.get('limit', 20)), 1), 100)
+                room_id = request.args.get('room_id')
+                if room_id:
+                    room = self.room_manager.get_room_by_id(room_id)
+                    if not room:
+                        return jsonify({'error': 'Room not found'}), 404
+                    if room['is_private'] and not self.room_manager.is_member(room_id, session['user_id']):
+                        return jsonify({'error': 'Access denied'}), 403
+                    room_ids = [room_id]
+                else:
+                    room_ids = self.room_manager.get_accessible_room_ids(session['user_id'])
+                
+                try:
+                    messages, terms, ignored, next_cursor = self.room_manager.search_messages(
+                        room_ids, query, limit=limit, before=request.args.get('before')
+                    )
+                except ValueError as e:
+                    return jsonify({'error': str(e)}), 400
+                
+                results = [dict(serialize_message(message),
+                                room_id=message['room_id'],
+                                highlights=highlight_offsets(message['message'], terms))
+                           for message in messages]
+                return jsonify({'results': results, 'terms': terms, 'ignored_terms': ignored,
+                                'next_cursor': next_cursor})
+                
+            except Exception as e:
+                logger.error("Search error: %s", e)
+                return jsonify({'error': 'Could not search messages'}), 500
+
+        @self.app.route('/api/rooms/<room_id>/export')
+        def export_room_messages(room_id):
+            if 'user_id' not in session:
+                return jsonify({'error': 'Unauthorized'}), 401
+            
+            room = self.room_manager.get_room_by_id(room_id)
+            if not room:
+                return jsonify({'error': 'Room not found'}), 404
+            
+            if room['is_private'] and not self.room_manager.is_member(room_id, session['user_id']):
+                return jsonify({'error': 'Access denied'}), 403
+            
+            try:
+                since = parse_timestamp(request.args['since']) if request.args.get('since') else None
+                until = parse_timestamp(request.args['until']) if request.args.get('until') else None
+            except ValueError:
+                return jsonify({'error': 'since and until must be ISO 8601 timestamps'}), 400
+            
+            compress = request.args.get('gzip', '').lower() in ('1', 'true', 'yes')
+            messages = self.room_manager.export_messages(
+                room_id, since, until, batch_size=self.app.config['EXPORT_BATCH_SIZE']
+            )
+            filename = f"{room['name']}-{room_id}.ndjson" + ('.gz' if compress else '')
+            return self.app.response_class(
+                iter_ndjson(messages, self.codec, compress=compress),
+                mimetype='application/gzip' if compress else 'application/x-ndjson',
+                headers={'Content-Disposition': f'attachment; filename="{filename}"'}
+            )
+
+        @self.app.route('/api/unread')
+        def get_unread_counts():
+            if 'user_id' not in session:
+                return jsonify({'error': 'Unauthorized'}), 401
+            
+            try:
+                limit = self.app.config['UNREAD_COUNT_LIMIT']
+                counts = self.room_manager.get_unread_counts(
+                    session['user_id'],
+                    pending=self.read_cursors.pending_for(session['user_id']),
+                    limit=limit
+                )
+                return jsonify({'counts': counts, 'limit': limit})
+                
+            except Exception as e:
+                logger.error("Unread counts error: %s", e)
+                return jsonify({'error': 'Could not load unread counts'}), 500
+
+        @self.app.route('/api/rooms/<room_id>/online')
+        def get_online_users(room_id):
+            if 'user_id' not in session:
+                return jsonify({'error': 'Unauthorized'}), 401
+            
+            if not self.presence:
+                return jsonify({'error': 'Presence tracking is disabled'}), 404
+            
+            room = self.room_manager.get_room_by_id(room_id)
+            if not room:
+                return jsonify({'error': 'Room not found'}), 404
+            
+            if room['is_private'] and not self.room_manager.is_member(room_id, session['user_id']):
+                return jsonify({'error': 'Access denied'}), 403
+            
+            users = [{'user_id': user_id, 'username': username}
+                     for user_id, username in self.presence.online_in_room(room_id)]
+            return jsonify({'room_id': room_id, 'users': users, 'count': len(users)})
+
+        @self.app.route('/metrics')
+        def metrics():
+            if not self.metrics:
+                return jsonify({'error': 'Metrics are disabled'}), 404
+            
+            # Without a token only scrapers on this host may read the metrics
+            token = self.app.config['METRICS_TOKEN']
+            if token:
+                if not hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {token}"):
+                    return jsonify({'error': 'Unauthorized'}), 401
+            elif not is_loopback(request.remote_addr):
+                return jsonify({'error': 'Access denied'}), 403
+            
+            return self.app.response_class(self.metrics.render(),
+                                           content_type='text/plain; version=0.0.4; charset=utf-8')
+
+        @self.app.route('/api/stats')
+        def stats():
+            if 'user_id' not in session:
+                return jsonify({'error': 'Unauthorized'}), 401
+            
+            if session['username'] not in self.app.config['ADMIN_USERS']:
+                return jsonify({'error': 'Access denied'}), 403
+            
+            return jsonify(self.get_stats())
+
+    def _compress_response(self, response):
+        """Gzip/deflate JSON responses above the size threshold when the client accepts it"""
+        min_size = self.app.config['HTTP_COMPRESSION_MIN_SIZE']
+        if (min_size <= 0 or response.status_code != 200 or response.direct_passthrough
+                or response.is_streamed or response.mimetype != 'application/json'
+                or 'Content-Encoding' in response.headers):
+            return response
+        
+        response.vary.add('Accept-Encoding')
+        encoding = request.accept_encodings.best_match(['gzip', 'deflate'])
+        data = response.get_data()
+        if not encoding or len(data) < min_size:
+            return response
+        
+        level = self.app.config['HTTP_COMPRESSION_LEVEL']
+        if encoding == 'gzip':
+            data = gzip.compress(data, compresslevel=level, mtime=0)
+        else:
+            data = zlib.compress(data, level)
+        response.set_data(data)
+        response.headers['Content-Encoding'] = encoding
+        return response
+
+    @staticmethod
+    def _is_modified(version, last_modified):
+        """Evaluate If-None-Match / If-Modified-Since against cheap validators"""
+        return is_resource_modified(request.environ, etag=version, last_modified=last_modified)
+
+    @staticmethod
+    def _with_validators(response, version, last_modified):
+        # Responses depend on the session, so shared caches must not store them
+        response.set_etag(version, weak=True)
+        if last_modified:
+            response.last_modified = last_modified
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response
+
+    def _not_modified(self, version, last_modified):
+        return self._with_validators(self.app.response_class(status=304), version, last_modified)
+
+    def get_stats(self):
+        """Collect internal counters from the optional performance components"""
+        stats = {
+            'password_hasher': self.user_manager.hasher.get_stats(),
+            'message_serializer': self.room_manager.serializer.get_stats(),
+            'read_cursors': self.read_cursors.get_stats(),
+            'mongo': self.mongo_manager.get_stats()
+        }
+        if self.room_manager.room_cache:
+            stats['room_cache'] = self.room_manager.room_cache.get_stats()
+        if self.room_manager.recent_messages:
+            stats['recent_messages'] = self.room_manager.recent_messages.get_stats()
+        if self.typing:
+            stats['typing'] = self.typing.get_stats()
+        if self.presence:
+            stats['presence'] = self.presence.get_stats()
+        if self.room_notices:
+            stats['room_notices'] = self.room_notices.get_stats()
+        if self.broadcast_batcher:
+            stats['broadcast_batcher'] = self.broadcast_batcher.get_stats()
+        if self.rate_limiter:
+            stats['rate_limiter'] = self.rate_limiter.get_stats()
+        if self.outbound_guard:
+            stats['outbound_queues'] = self.outbound_guard.get_stats()
+        if self.room_manager.write_behind:
+            stats['message_writer'] = dict(
+                self.room_manager.write_behind.stats,
+                pending=self.room_manager.write_behind.pending_count()
+            )
+        return stats
+
+    def _socket_event(self, event):
+        """Register a Socket.IO handler behind the event's rate limits, timed for /metrics"""
+        def register(handler):
+            @functools.wraps(handler)
+            def limited(*args):
+                if self.rate_limiter and 'user_id' in session:
+                    allowed, notify = self.rate_limiter.check(event, request.sid, session['user_id'])
+                    if not allowed:
+                        if notify:
+                            emit('error', {'message': 'Too many requests, please slow down', 'event': event})
+                        return
+                if not self.metrics:
+                    return handler(*args)
+                started = time.perf_counter()
+                try:
+                    return handler(*args)
+                finally:
+                    self.socket_latency.observe(time.perf_counter() - started, event)
+            return self.socketio.on(event)(limited)
+        return register
+
     def _register_socket_events(self):
         """Register all Socket.IO events with enhanced functionality"""
         
-        @self.socketio.on('connect')
-        def handle_connect():
+        @self._socket_event('connect')
+        def handle_connect(auth=None):
             if 'user_id' not in session:
                 logger.warning("Unauthorized connection attempt")
                 return False  # Reject connection
             
             # Update user status to online
-            self.user_manager.update_user_status(session['user_id'], 'online')
+            if self.presence:
+                self.presence.connect(request.sid, session['user_id'], session['username'])
+            else:
+                self.user_manager.update_user_status(session['user_id'], 'online')
             logger.info(f"User {session['username']} connected")
 
-        @self.socketio.on('disconnect')
+        @self._socket_event('disconnect')
         def handle_disconnect():
             if 'user_id' in session:
                 # Update user status to offline
-                self.user_manager.update_user_status(session['user_id'], 'offline')
+                if self.presence:
+                    self.presence.disconnect(request.sid)
+                else:
+                    self.user_manager.update_user_status(session['user_id'], 'offline')
+                
+                if self.rate_limiter:
+                    self.rate_limiter.forget(request.sid)
+                
+                # Other tabs of the same user may still be typing
+                if self.typing and not (self.presence and self.presence.is_online(session['user_id'])):
+                    self.typing.clear_user(session['username'])
                 logger.info(f"User {session['username']} disconnected")
 
-        @self.socketio.on('join_room')
+        @self._socket_event('join_room')
         def handle_join_room(data):
             if 'user_id' not in session:
                 return
@@ -648,31 +4382,30 @@ class ChatApplication:
                     return
                 
                 # Check access permissions
-                if room['is_private'] and session['user_id'] not in room.get('members', []):
+                if room['is_private'] and not self.room_manager.is_member(room_id, session['user_id']):
                     emit('error', {'message': 'Access denied to private room'})
                     return
                 
                 # Add user to room members if not already there
-                if session['user_id'] not in room.get('members', []):
+                try:
                     self.room_manager.join_room(room_id, session['user_id'])
+                except ValueError as e:
+                    emit('error', {'message': str(e)})
+                    return
                 
                 join_room(room_id)
+                if self.presence:
+                    self.presence.join(request.sid, room_id)
                 
-                # Add system message
-                system_message_id = self.room_manager.add_system_message(
-                    room_id, 
-                    f"{session['username']} joined the room"
-                )
-                
-                emit('message', {
-                    'id': system_message_id,
-                    'user_id': 'system',
-                    'username': 'System',
-                    'message': f"{session['username']} joined the room",
-                    'timestamp': datetime.utcnow().isoformat(),
-                    'is_system': True,
-                    'room_id': room_id
-                }, room=room_id)
+                # Announce the join (coalesced, or as a stored system message)
+                if self.room_notices:
+                    self.room_notices.joined(room_id, session['username'])
+                else:
+                    system_message = self.room_manager.create_system_message(
+                        room_id, 
+                        f"{session['username']} joined the room"
+                    )
+                    emit('message', dict(system_message, room_id=room_id), room=room_id)
                 
                 emit('join_success', {
                     'room_id': room_id,
@@ -683,7 +4416,7 @@ class ChatApplication:
                 logger.error("Join room error: %s", e)
                 emit('error', {'message': 'Could not join room'})
 
-        @self.socketio.on('leave_room')
+        @self._socket_event('leave_room')
         def handle_leave_room(data):
             if 'user_id' not in session:
                 return
@@ -694,27 +4427,23 @@ class ChatApplication:
             
             try:
                 leave_room(room_id)
+                if self.presence:
+                    self.presence.leave(request.sid, room_id)
                 
-                # Add system message
-                system_message_id = self.room_manager.add_system_message(
-                    room_id, 
-                    f"{session['username']} left the room"
-                )
-                
-                emit('message', {
-                    'id': system_message_id,
-                    'user_id': 'system',
-                    'username': 'System',
-                    'message': f"{session['username']} left the room",
-                    'timestamp': datetime.utcnow().isoformat(),
-                    'is_system': True,
-                    'room_id': room_id
-                }, room=room_id)
+                # Announce the leave (coalesced, or as a stored system message)
+                if self.room_notices:
+                    self.room_notices.left(room_id, session['username'])
+                else:
+                    system_message = self.room_manager.create_system_message(
+                        room_id, 
+                        f"{session['username']} left the room"
+                    )
+                    emit('message', dict(system_message, room_id=room_id), room=room_id)
                 
             except Exception as e:
                 logger.error("Leave room error: %s", e)
 
-        @self.socketio.on('send_message')
+        @self._socket_event('send_message')
         def handle_send_message(data):
             if 'user_id' not in session:
                 return
@@ -737,52 +4466,112 @@ class ChatApplication:
                     emit('error', {'message': 'Room not found'})
                     return
                 
-                if room['is_private'] and session['user_id'] not in room.get('members', []):
+                if room['is_private'] and not self.room_manager.is_member(room_id, session['user_id']):
                     emit('error', {'message': 'Access denied'})
                     return
                 
                 # Add message
-                message_id = self.room_manager.add_message(
+                payload = self.room_manager.create_message(
                     room_id,
                     session['user_id'],
                     session['username'],
                     message
                 )
                 
-                # Emit message to all room members
-                emit('message', {
-                    'id': message_id,
-                    'user_id': session['user_id'],
-                    'username': session['username'],
-                    'message': message,
-                    'timestamp': datetime.utcnow().isoformat(),
-                    'is_system': False,
-                    'room_id': room_id
-                }, room=room_id)
+                # Emit message to all room members (cached payloads are shared, so copy)
+                if self.broadcast_batcher:
+                    self.broadcast_batcher.send(room_id, payload)
+                else:
+                    emit('message', dict(payload, room_id=room_id), room=room_id)
+                
+                # Senders have read everything up to their own message
+                self.read_cursors.advance(session['user_id'], room_id,
+                                          parse_timestamp(payload['timestamp']), payload['id'])
                 
             except Exception as e:
                 logger.error("Send message error: %s", e)
                 emit('error', {'message': 'Could not send message'})
 
-        @self.socketio.on('typing_start')
+        @self._socket_event('sync')
+        def handle_sync(data):
+            # Reconnect: resubscribe quietly (no join notices) and acknowledge with the
+            # missed messages of every room at once; ``gap`` means reload history
+            if 'user_id' not in session:
+                return
+            
+            rooms = data.get('rooms') if isinstance(data, dict) else None
+            if not isinstance(rooms, dict):
+                return {'error': 'rooms must map room ids to message ids'}
+            
+            limit = self.app.config['SYNC_MESSAGE_LIMIT']
+            result = {}
+            try:
+                for room_id, last_seen in list(rooms.items())[:self.app.config['SYNC_MAX_ROOMS']]:
+                    room = self.room_manager.get_room_by_id(room_id) if ObjectId.is_valid(room_id) else None
+                    if not room:
+                        result[room_id] = {'error': 'Room not found'}
+                        continue
+                    if room['is_private'] and not self.room_manager.is_member(room_id, session['user_id']):
+                        result[room_id] = {'error': 'Access denied'}
+                        continue
+                    
+                    join_room(room_id)
+                    if self.presence:
+                        self.presence.join(request.sid, room_id)
+                    
+                    messages, complete = self.room_manager.get_missed_messages(room_id, last_seen, limit)
+                    result[room_id] = {
+                        'messages': [dict(payload, room_id=room_id) for payload in messages],
+                        'gap': not complete
+                    }
+                
+                return {'rooms': result, 'limit': limit}
+                
+            except Exception as e:
+                logger.error("Sync error: %s", e)
+                return {'error': 'Could not sync rooms'}
+
+        @self._socket_event('mark_read')
+        def handle_mark_read(data):
+            if 'user_id' not in session:
+                return
+            
+            room_id = data.get('room_id')
+            message_id = data.get('message_id')
+            if not room_id or not message_id or not ObjectId.is_valid(message_id):
+                return
+            
+            try:
+                timestamp = parse_timestamp(data.get('timestamp'))
+            except (TypeError, ValueError):
+                return
+            
+            if self.room_manager.is_member(room_id, session['user_id']):
+                self.read_cursors.advance(session['user_id'], room_id, timestamp, message_id)
+
+        @self._socket_event('typing_start')
         def handle_typing_start(data):
             if 'user_id' not in session:
                 return
             
             room_id = data.get('room_id')
-            if room_id:
+            if room_id and self.typing:
+                self.typing.typing_start(room_id, session['username'])
+            elif room_id:
                 emit('user_typing', {
                     'username': session['username'],
                     'room_id': room_id
                 }, room=room_id, include_self=False)
 
-        @self.socketio.on('typing_stop')
+        @self._socket_event('typing_stop')
         def handle_typing_stop(data):
             if 'user_id' not in session:
                 return
             
             room_id = data.get('room_id')
-            if room_id:
+            if room_id and self.typing:
+                self.typing.typing_stop(room_id, session['username'])
+            elif room_id:
                 emit('user_stopped_typing', {
                     'username': session['username'],
                     'room_id': room_id
@@ -810,35 +4599,288 @@ class ChatApplication:
         logger.info(f"MongoDB connection: {'✓ Connected' if self.mongo_manager.client else '✗ Failed'}")
         logger.info(f"Template folder: {self.app.template_folder}")
         logger.info(f"Static folder: {self.app.static_folder}")
+        logger.info(f"Async mode: {self.socketio.async_mode}")
         
-        self.socketio.run(
-            self.app,
-            host=host,
-            port=port,
-            debug=debug,
-            use_reloader=debug,
-            allow_unsafe_werkzeug=True
-        )
+        options = {}
+        if self.socketio.async_mode == 'threading':
+            # Only the threaded Werkzeug server needs this; gevent/eventlet serve directly
+            options['allow_unsafe_werkzeug'] = True
+        
+        self._exit_on_sigterm()
+        try:
+            self.socketio.run(
+                self.app,
+                host=host,
+                port=port,
+                debug=debug,
+                use_reloader=debug,
+                **options
+            )
+        finally:
+            self.shutdown()
+
+    def serve_dispatched(self, channel):
+        """Serve connections handed over by a StickyDispatcher instead of listening"""
+        mode = self.socketio.async_mode
+        if mode == 'threading':
+            from werkzeug.serving import make_server
+            server = make_server('127.0.0.1', 0, self.app, threaded=True)
+            handle = server.process_request
+        elif mode == 'gevent':
+            import gevent
+            from gevent import pywsgi
+            try:
+                from geventwebsocket.handler import WebSocketHandler
+                server = pywsgi.WSGIServer(('127.0.0.1', 0), self.app, handler_class=WebSocketHandler)
+            except ImportError:
+                server = pywsgi.WSGIServer(('127.0.0.1', 0), self.app)
+            server.init_socket()
+            handle = lambda conn, address: gevent.spawn(server.handle, conn, address)
+        else:
+            raise ValueError(f"Multi-worker mode does not support async mode '{mode}'")
+        
+        logger.info(f"Worker {os.getpid()} ready ({mode})")
+        self._exit_on_sigterm()
+        try:
+            while True:
+                data, fds, _, _ = socket.recv_fds(channel, 1024, 1)
+                if not data:
+                    break  # Dispatcher went away
+                for fd in fds:
+                    conn = socket.socket(fileno=fd)
+                    handle(conn, tuple(json.loads(data)))
+        finally:
+            self.shutdown()
+
+    @staticmethod
+    def _exit_on_sigterm():
+        """Turn SIGTERM into SystemExit so the ``finally: shutdown()`` drain runs"""
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    def shutdown(self):
+        """Drain buffered writes before the process exits"""
+        if self._shut_down:
+            return
+        self._shut_down = True
+        logger.info("Shutting down ChatPro server")
+        if self.typing:
+            self.typing.stop()
+        if self.room_notices:
+            self.room_notices.stop()
+            self.room_notices.flush()
+        if self.broadcast_batcher:
+            self.broadcast_batcher.stop()
+        if self.presence:
+            self.presence.close()
+        self.read_cursors.close()
+        self.user_manager.hasher.close()
+        self.bulk_user_manager.hasher.close()
+        self.room_manager.close()
+        self.mongo_manager.close()
+
+def _worker_main(channel, backplane):
+    """Entry point of a worker process started by run_cluster"""
+    os.environ['CHATPRO_BACKPLANE'] = backplane
+    chat_app = ChatApplication()
+    chat_app.serve_dispatched(channel)
+
+def run_cluster(workers, host='0.0.0.0', port=5000):
+    """Run ``workers`` server processes behind a sticky dispatcher and shared backplane"""
+    backplane = os.environ.get('CHATPRO_BACKPLANE', '')
+    hub = None
+    if not backplane or backplane == 'memory':
+        # Workers are separate processes, so they need a real broker
+        backplane = 'unix://' + os.path.join(tempfile.mkdtemp(prefix='chatpro-'), 'backplane.sock')
+    if backplane.startswith(('tcp://', 'unix://')) and not BackplaneHub.running(backplane):
+        hub = BackplaneHub(backplane)
+        hub.start()
+    
+    context = multiprocessing.get_context('spawn')
+    channels = []
+    processes = []
+    for index in range(workers):
+        parent, child = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        process = context.Process(target=_worker_main, args=(child, backplane),
+                                  name=f'chatpro-worker-{index}')
+        process.start()
+        child.close()
+        channels.append(parent)
+        processes.append(process)
+    
+    try:
+        StickyDispatcher(host, port, channels).serve_forever()
+    finally:
+        for channel in channels:
+            channel.close()
+        for process in processes:
+            process.join(30)
+        if hub:
+            hub.close()
+
+def provision_users_command(args):
+    """CLI: create users from a CSV or NDJSON file, printing failed rows as NDJSON"""
+    fmt = args.format or ('csv' if args.file.endswith('.csv') else 'ndjson')
+    hasher = PasswordHasher(
+        method=os.environ.get('CHATPRO_PASSWORD_HASH_METHOD', 'pbkdf2:sha256'),
+        workers=args.workers
+    )
+    user_manager = UserManager(MongoDBManager(), hasher)
+    
+    summary = {'created': 0, 'duplicate': 0, 'invalid': 0, 'error': 0}
+    started = time.monotonic()
+    stream = sys.stdin if args.file == '-' else open(args.file, newline='', encoding='utf-8')
+    try:
+        for result in user_manager.bulk_register(iter_user_rows(stream, fmt), batch_size=args.batch_size):
+            summary[result['status']] += 1
+            if result['status'] != 'created':
+                print(json.dumps(result))
+            processed = sum(summary.values())
+            if processed % 10000 == 0:
+                logger.info(f"Processed {processed} rows in {time.monotonic() - started:.0f}s")
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+        hasher.close()
+    
+    logger.info(f"Provisioning finished in {time.monotonic() - started:.1f}s: {summary}")
+    return 0 if not summary['error'] else 1
+
+def migrate_memberships_command(args):
+    """CLI: move embedded room members arrays into the memberships collection"""
+    mongo_manager = MongoDBManager()
+    started = time.monotonic()
+    migrated = RoomManager(mongo_manager).migrate_memberships(batch_size=args.batch_size)
+    logger.info(f"Migrated {migrated} rooms in {time.monotonic() - started:.1f}s")
+    return 0
+
+def export_messages_command(args):
+    """CLI: stream a room's messages as NDJSON to a file or stdout"""
+    try:
+        since = parse_timestamp(args.since) if args.since else None
+        until = parse_timestamp(args.until) if args.until else None
+    except ValueError:
+        logger.error("--since and --until must be ISO 8601 timestamps")
+        return 2
+    
+    mongo_manager = MongoDBManager()
+    room_manager = RoomManager(mongo_manager)
+    codec = JSONCodec(os.environ.get('CHATPRO_JSON_ENCODER', 'auto'))
+    compress = args.gzip or args.output.endswith('.gz')
+    
+    started = time.monotonic()
+    exported = 0
+    
+    def counted(messages):
+        nonlocal exported
+        for message in messages:
+            exported += 1
+            yield message
+    
+    output = sys.stdout.buffer if args.output == '-' else open(args.output, 'wb')
+    try:
+        messages = room_manager.export_messages(args.room_id, since, until, batch_size=args.batch_size)
+        for chunk in iter_ndjson(counted(messages), codec, compress=compress):
+            output.write(chunk)
+    finally:
+        if output is not sys.stdout.buffer:
+            output.close()
+    
+    logger.info(f"Exported {exported} messages in {time.monotonic() - started:.1f}s")
+    return 0
+
+def index_messages_command(args):
+    """CLI: add search terms to messages stored before search was enabled"""
+    started = time.monotonic()
+    indexed = RoomManager(MongoDBManager()).index_message_terms(batch_size=args.batch_size)
+    logger.info(f"Indexed {indexed} messages in {time.monotonic() - started:.1f}s")
+    return 0
+
+def message_buckets_command(args):
+    """CLI: pack per-message documents into buckets, or compact existing buckets"""
+    mongo_manager = MongoDBManager()
+    store = MessageBucketStore(mongo_manager.get_collection("message_buckets"), args.bucket_size)
+    started = time.monotonic()
+    if args.command == 'migrate-message-buckets':
+        count = store.migrate(mongo_manager.get_collection("messages"))
+        logger.info(f"Moved {count} messages into buckets in {time.monotonic() - started:.1f}s")
+    else:
+        count = store.compact(older_than=timedelta(hours=args.older_than_hours))
+        logger.info(f"Compacted {count} buckets in {time.monotonic() - started:.1f}s")
+    return 0
+
+def build_cli():
+    parser = argparse.ArgumentParser(description='ChatPro chat server')
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('serve', help='Run the chat server (default)')
+    
+    provision = commands.add_parser('provision-users', help='Create users from a CSV or NDJSON file')
+    provision.add_argument('file', help="CSV with username,password,email header or NDJSON; '-' reads stdin")
+    provision.add_argument('--format', choices=['csv', 'ndjson'], help='Defaults to the file extension')
+    provision.add_argument('--batch-size', type=int, default=1000)
+    provision.add_argument('--workers', type=int, default=os.cpu_count(), help='Hashing processes')
+    
+    export = commands.add_parser('export-messages', help="Stream a room's message history as NDJSON")
+    export.add_argument('room_id')
+    export.add_argument('--since', help='ISO 8601 start time (inclusive)')
+    export.add_argument('--until', help='ISO 8601 end time (exclusive)')
+    export.add_argument('--output', default='-', help="File to write; '-' writes stdout, *.gz implies --gzip")
+    export.add_argument('--gzip', action='store_true', help='Gzip the output')
+    export.add_argument('--batch-size', type=int, default=1000, help='Messages fetched per database round trip')
+    
+    index = commands.add_parser('index-messages', help='Backfill search terms on existing messages')
+    index.add_argument('--batch-size', type=int, default=1000)
+    
+    bucket_size = env_int('CHATPRO_MESSAGE_BUCKET_SIZE', 0) or 200
+    migrate_buckets = commands.add_parser('migrate-message-buckets',
+                                          help='Pack per-message documents into bucket documents')
+    migrate_buckets.add_argument('--bucket-size', type=int, default=bucket_size)
+    compact = commands.add_parser('compact-message-buckets',
+                                  help='Merge under-filled message buckets older than a cutoff')
+    compact.add_argument('--bucket-size', type=int, default=bucket_size)
+    compact.add_argument('--older-than-hours', type=float, default=1)
+    
+    migrate = commands.add_parser('migrate-memberships', help='Move room members arrays into the memberships collection')
+    migrate.add_argument('--batch-size', type=int, default=1000)
+    
+    return parser
 
 if __name__ == '__main__':
+    cli_args = build_cli().parse_args()
+    if cli_args.command == 'provision-users':
+        sys.exit(provision_users_command(cli_args))
+    if cli_args.command == 'export-messages':
+        sys.exit(export_messages_command(cli_args))
+    if cli_args.command == 'index-messages':
+        sys.exit(index_messages_command(cli_args))
+    if cli_args.command in ('migrate-message-buckets', 'compact-message-buckets'):
+        sys.exit(message_buckets_command(cli_args))
+    if cli_args.command == 'migrate-memberships':
+        sys.exit(migrate_memberships_command(cli_args))
+    
     try:
         print("🚀 Initializing ChatPro Professional Chat Application...")
         print("=" * 60)
         
-        chat_app = ChatApplication()
-        
-        print("✅ Application initialized successfully!")
-        print("🌐 MongoDB Atlas connected")
-        print("📁 Template folder: static/templates")
-        print("📦 Static folder: static")
-        print("=" * 60)
-        print("🔥 Starting server...")
-        
-        chat_app.run(
-            host='127.0.0.1',  # Use localhost for development
-            port=5000,
-            debug=True
-        )
+        workers = env_int('CHATPRO_WORKERS', 1)
+        if workers > 1:
+            print(f"🔀 Starting {workers} workers behind a sticky dispatcher...")
+            run_cluster(workers, host='127.0.0.1', port=5000)
+        else:
+            chat_app = ChatApplication()
+            
+            print("✅ Application initialized successfully!")
+            print("🌐 MongoDB Atlas connected")
+            print("📁 Template folder: static/templates")
+            print("📦 Static folder: static")
+            print("=" * 60)
+            print("🔥 Starting server...")
+            
+            chat_app.run(
+                host='127.0.0.1',  # Use localhost for development
+                port=5000,
+                debug=True
+            )
         
     except Exception as e:
         logger.critical("Application failed to start: %s", e)
@@ -0,0 +1,154 @@
+"""Measure the bytes and CPU trade-off of compressing ChatPro payloads.
+
+Builds representative payloads with the application's own serializer and
+encoder (history pages, a room list, single Socket.IO message frames), then
+compresses them the ways the server can:
+
+    python benchmarks/compression.py
+    python benchmarks/compression.py --messages 100 --rounds 500 --levels 1 6 9
+
+``gzip``/``deflate`` correspond to the HTTP Content-Encoding applied to API
+responses. ``ws-deflate`` compresses a stream of message frames with one
+raw-deflate context kept across frames, as websocket permessage-deflate
+with context takeover does. Runs offline; no server or database is needed.
+"""
+import argparse
+import gzip
+import json
+import os
+import random
+import sys
+import time
+import zlib
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bson.objectid import ObjectId
+
+from app import JSONCodec, serialize_message
+
+WORDS = ('hey team the build is green again can someone review my pull request '
+         'deploying to staging now lunch at noon? sounds good thanks I will check '
+         'the logs after the meeting latency looks better since yesterday').split()
+
+
+def make_messages(count, seed):
+    """Chat messages with realistic ids, timestamps and short varied text"""
+    rng = random.Random(seed)
+    users = [(str(ObjectId()), name) for name in ('alice', 'bob', 'carol', 'dave', 'erin')]
+    started = datetime(2024, 1, 1, 9, 0)
+    messages = []
+    for i in range(count):
+        user_id, username = rng.choice(users)
+        messages.append(serialize_message({
+            '_id': ObjectId(),
+            'user_id': user_id,
+            'username': username,
+            'message': ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 25))),
+            'message_type': 'text',
+            'timestamp': started + timedelta(seconds=i * rng.randint(1, 90)),
+            'is_system': False,
+            'is_edited': False
+        }))
+    return messages
+
+
+def make_rooms(count, seed):
+    rng = random.Random(seed)
+    return [{
+        'id': str(ObjectId()),
+        'name': f"{rng.choice(WORDS)}-{i}",
+        'description': ' '.join(rng.choice(WORDS) for _ in range(8)),
+        'created_by': str(ObjectId()),
+        'is_private': rng.random() < 0.2,
+        'member_count': rng.randint(1, 500),
+        'last_activity': datetime(2024, 1, 1, 9, i % 60).isoformat()
+    } for i in range(count)]
+
+
+def cpu_time(func, rounds):
+    """Mean CPU seconds per call"""
+    started = time.process_time()
+    for _ in range(rounds):
+        func()
+    return (time.process_time() - started) / rounds
+
+
+def measure_http(name, data, levels, rounds):
+    rows = []
+    for level in levels:
+        for encoding, compress in (('gzip', lambda d, l: gzip.compress(d, compresslevel=l, mtime=0)),
+                                   ('deflate', lambda d, l: zlib.compress(d, l))):
+            compressed = compress(data, level)
+            rows.append({
+                'payload': name,
+                'method': f"{encoding}-{level}",
+                'raw_bytes': len(data),
+                'wire_bytes': len(compressed),
+                'ratio': round(len(compressed) / len(data), 3),
+                'compress_us': round(cpu_time(lambda: compress(data, level), rounds) * 1e6, 1),
+                'decompress_us': round(cpu_time(
+                    lambda: gzip.decompress(compressed) if encoding == 'gzip' else zlib.decompress(compressed),
+                    rounds) * 1e6, 1)
+            })
+    return rows
+
+
+def measure_frames(frames, levels, rounds):
+    """Per-frame cost of compressing a message stream with a shared deflate context"""
+    raw = sum(len(frame) for frame in frames)
+    rows = [{
+        'payload': f"{len(frames)} message frames",
+        'method': 'none',
+        'raw_bytes': raw,
+        'wire_bytes': raw,
+        'ratio': 1.0
+    }]
+    for level in levels:
+        def run():
+            compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+            return [compressor.compress(frame) + compressor.flush(zlib.Z_SYNC_FLUSH) for frame in frames]
+
+        wire = sum(len(chunk) for chunk in run())
+        per_stream = cpu_time(run, max(rounds // 10, 1))
+        rows.append({
+            'payload': f"{len(frames)} message frames",
+            'method': f"ws-deflate-{level}",
+            'raw_bytes': raw,
+            'wire_bytes': wire,
+            'ratio': round(wire / raw, 3),
+            'compress_us': round(per_stream / len(frames) * 1e6, 1)
+        })
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=100, help='messages per history page')
+    parser.add_argument('--rooms', type=int, default=100, help='rooms in the room list')
+    parser.add_argument('--frames', type=int, default=200, help='socket message frames in the stream')
+    parser.add_argument('--levels', type=int, nargs='+', default=[1, 6, 9])
+    parser.add_argument('--rounds', type=int, default=200)
+    parser.add_argument('--encoder', default='auto', help='JSON encoder: auto, orjson or json')
+    parser.add_argument('--seed', type=int, default=7)
+    args = parser.parse_args()
+
+    codec = JSONCodec(args.encoder)
+    messages = make_messages(max(args.messages, args.frames), args.seed)
+    page = codec.dumps_bytes({'messages': messages[:args.messages], 'page': 1, 'per_page': args.messages,
+                              'next_cursor': None, 'room_name': 'general'})
+    rooms = codec.dumps_bytes(make_rooms(args.rooms, args.seed))
+    frames = [f'42["message",{codec.dumps(dict(message, room_id="general"))}]'.encode()
+              for message in messages[:args.frames]]
+
+    rows = []
+    rows += measure_http(f"history page ({args.messages} messages)", page, args.levels, args.rounds)
+    rows += measure_http(f"room list ({args.rooms} rooms)", rooms, args.levels, args.rounds)
+    rows += measure_http('single message frame', frames[0], args.levels, args.rounds)
+    rows += measure_frames(frames, args.levels, args.rounds)
+    print(json.dumps({'encoder': codec.name, 'results': rows}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
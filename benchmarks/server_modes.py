@@ -0,0 +1,185 @@
+"""Compare connection capacity and message latency of ChatPro server modes.
+
+Start the server once per mode and point this script at it:
+
+    CHATPRO_RATE_LIMITS=0 CHATPRO_ASYNC_MODE=threading python app.py
+    CHATPRO_RATE_LIMITS=0 CHATPRO_ASYNC_MODE=gevent python app.py
+
+    python benchmarks/server_modes.py --label threading --connections 2000 --server-pid <pid>
+    python benchmarks/server_modes.py --label gevent --connections 2000 --server-pid <pid>
+
+The script opens idle Socket.IO connections until the target count (or the
+first wave of failures), samples the server's memory and thread count, then
+measures send_message -> broadcast round trips while those connections stay
+open. Needs python-socketio with the asyncio client (pip install aiohttp).
+"""
+import argparse
+import asyncio
+import json
+import time
+import uuid
+
+import aiohttp
+import socketio
+
+
+async def login(url, username, password):
+    """Register (if needed) and log in; returns the session cookie header and a room id"""
+    jar = aiohttp.CookieJar(unsafe=True)
+    async with aiohttp.ClientSession(cookie_jar=jar) as http:
+        await http.post(f"{url}/register", data={
+            'username': username,
+            'password': password,
+            'email': f"{username}@bench.local"
+        }, allow_redirects=False)
+        async with http.post(f"{url}/login", data={'username': username, 'password': password},
+                             allow_redirects=False) as response:
+            if response.status != 302:
+                raise SystemExit(f"Login failed with HTTP {response.status}")
+
+        async with http.get(f"{url}/api/rooms") as response:
+            rooms = await response.json()
+        if not rooms:
+            raise SystemExit("No rooms available to benchmark against")
+
+        cookie = '; '.join(f"{c.key}={c.value}" for c in jar)
+        return cookie, rooms[0]['id']
+
+
+async def open_connections(url, cookie, count, concurrency):
+    """Open ``count`` idle connections; returns (clients, failures, seconds)"""
+    clients = []
+    failures = 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def connect_one():
+        nonlocal failures
+        client = socketio.AsyncClient(reconnection=False)
+        async with semaphore:
+            try:
+                await client.connect(url, headers={'Cookie': cookie},
+                                     transports=['websocket'], wait_timeout=15)
+                clients.append(client)
+            except Exception:
+                failures += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(connect_one() for _ in range(count)))
+    return clients, failures, time.perf_counter() - started
+
+
+async def measure_latency(url, cookie, room_id, messages, rate, timeout):
+    """Send ``messages`` chat messages at ``rate``/s and time each broadcast echo"""
+    client = socketio.AsyncClient(reconnection=False)
+    sent_at = {}
+    latencies = []
+    done = asyncio.Event()
+
+    @client.on('message')
+    async def on_message(data):
+        started = sent_at.pop(data.get('message'), None)
+        if started is not None:
+            latencies.append(time.perf_counter() - started)
+            if len(latencies) == messages:
+                done.set()
+
+    await client.connect(url, headers={'Cookie': cookie}, transports=['websocket'])
+    await client.emit('join_room', {'room_id': room_id})
+    await asyncio.sleep(0.5)
+
+    run_id = uuid.uuid4().hex[:8]
+    interval = 1.0 / rate if rate > 0 else 0
+    for i in range(messages):
+        text = f"bench-{run_id}-{i}"
+        sent_at[text] = time.perf_counter()
+        await client.emit('send_message', {'room_id': room_id, 'message': text})
+        if interval:
+            await asyncio.sleep(interval)
+
+    try:
+        await asyncio.wait_for(done.wait(), timeout)
+    except asyncio.TimeoutError:
+        pass
+    await client.disconnect()
+    return latencies, len(sent_at)
+
+
+def process_usage(pid):
+    """Resident memory (KiB) and thread count of the server process, from /proc"""
+    if not pid:
+        return None
+    usage = {}
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            key, _, value = line.partition(':')
+            if key == 'VmRSS':
+                usage['rss_kib'] = int(value.split()[0])
+            elif key == 'Threads':
+                usage['threads'] = int(value)
+    return usage
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+async def run(args):
+    cookie, room_id = await login(args.url, args.username, args.password)
+    baseline = process_usage(args.server_pid)
+
+    clients, failures, connect_seconds = await open_connections(
+        args.url, cookie, args.connections, args.concurrency
+    )
+    loaded = process_usage(args.server_pid)
+
+    latencies, lost = await measure_latency(
+        args.url, cookie, room_id, args.messages, args.rate, args.timeout
+    )
+
+    await asyncio.gather(*(client.disconnect() for client in clients), return_exceptions=True)
+
+    result = {
+        'label': args.label,
+        'connections_requested': args.connections,
+        'connections_open': len(clients),
+        'connection_failures': failures,
+        'connect_seconds': round(connect_seconds, 3),
+        'messages_sent': args.messages,
+        'messages_lost': lost,
+        'latency_ms': {
+            name: round(value * 1000, 2) if value is not None else None
+            for name, value in (('p50', percentile(latencies, 0.50)),
+                                ('p90', percentile(latencies, 0.90)),
+                                ('p99', percentile(latencies, 0.99)),
+                                ('max', max(latencies) if latencies else None))
+        }
+    }
+    if baseline and loaded:
+        result['server'] = {'idle': baseline, 'loaded': loaded}
+        if clients:
+            per_connection = (loaded['rss_kib'] - baseline['rss_kib']) / len(clients)
+            result['server']['rss_kib_per_connection'] = round(per_connection, 2)
+    print(json.dumps(result, indent=2))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', default='http://127.0.0.1:5000')
+    parser.add_argument('--label', default='server')
+    parser.add_argument('--username', default='benchuser')
+    parser.add_argument('--password', default='benchpassword')
+    parser.add_argument('--connections', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=100,
+                        help='connection attempts in flight at once')
+    parser.add_argument('--messages', type=int, default=500)
+    parser.add_argument('--rate', type=float, default=100, help='messages per second, 0 for unthrottled')
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--server-pid', type=int, help='server process id for /proc memory sampling')
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -11,7 +11,14 @@ class ChatApplication {
         this.typingUsers = new Set();
         this.typingTimeout = null;
         this.isTyping = false;
+        this.lastTypingSent = 0;
         this.unreadCounts = new Map();
+        this.unreadLimit = null;
+        this.lastSeenMessages = new Map();
+        this.historyCursors = new Map();
+        this.loadingHistory = false;
+        this.markReadTimers = new Map();
+        this.hasConnected = false;
         this.lastMessageTime = null;
         
         // DOM Elements
@@ -80,6 +87,9 @@ class ChatApplication {
             // Auto-resize textarea
             this.setupAutoResize();
             
+            // Unread badges from the server-side read positions
+            this.loadUnreadCounts();
+            
             // Auto-join first room after a delay
             setTimeout(() => {
                 this.autoJoinFirstRoom();
@@ -141,6 +151,12 @@ class ChatApplication {
             console.log('✅ Connected to server');
             this.updateConnectionStatus(true);
             this.hideErrorNotifications();
+            
+            // A repeat connect is a reconnect: catch up instead of rejoining
+            if (this.hasConnected) {
+                this.syncRooms();
+            }
+            this.hasConnected = true;
         });
 
         this.socket.on('disconnect', (reason) => {
@@ -148,18 +164,16 @@ class ChatApplication {
             this.updateConnectionStatus(false);
         });
 
-        this.socket.on('reconnect', () => {
-            console.log('🔄 Reconnected to server');
-            if (this.currentRoom) {
-                this.joinRoom(this.currentRoom, false);
-            }
-        });
-
         // Message events
         this.socket.on('message', (data) => {
             this.handleIncomingMessage(data);
         });
 
+        // Hot rooms send several messages per frame
+        this.socket.on('messages', (data) => {
+            this.handleIncomingBatch(data);
+        });
+
         // Typing events
         this.socket.on('user_typing', (data) => {
             this.handleUserTyping(data);
@@ -169,6 +183,11 @@ class ChatApplication {
             this.handleUserStoppedTyping(data);
         });
 
+        // Coalesced snapshot of everyone typing in a room
+        this.socket.on('typing_state', (data) => {
+            this.handleTypingState(data);
+        });
+
         // Room events
         this.socket.on('user_joined', (data) => {
             this.handleUserJoined(data);
@@ -178,6 +197,11 @@ class ChatApplication {
             this.handleUserLeft(data);
         });
 
+        // Coalesced join/leave summaries (not stored in history)
+        this.socket.on('room_notice', (data) => {
+            this.handleRoomNotice(data);
+        });
+
         // Error handling
         this.socket.on('error', (error) => {
             console.error('Socket error:', error);
@@ -436,16 +460,28 @@ class ChatApplication {
         }
     }
 
-    async loadRoomMessages(roomId, page = 1) {
+    async loadRoomMessages(roomId, before = null) {
         try {
             console.log('📨 Loading messages for room:', roomId);
-            const response = await fetch(`/api/messages/${roomId}?page=${page}&per_page=50`);
+            let url = `/api/messages/${roomId}?per_page=50`;
+            if (before) url += `&before=${encodeURIComponent(before)}`;
+            const response = await fetch(url);
             if (!response.ok) throw new Error('Failed to fetch messages');
             
             const data = await response.json();
             
-            if (page === 1) {
-                this.clearMessages();
+            // Older pages continue from the cursor of the oldest message shown
+            this.historyCursors.set(roomId, data.next_cursor);
+            
+            if (before) {
+                if (roomId !== this.currentRoom?._id) return; // Switched rooms meanwhile
+                this.prependMessages(data.messages); // Newest first, so each goes on top
+                return;
+            }
+            
+            this.clearMessages();
+            if (data.messages.length) {
+                this.lastSeenMessages.set(roomId, data.messages[0]); // Newest first
             }
             
             this.renderMessages(data.messages.reverse()); // Reverse to show oldest first
@@ -453,10 +489,52 @@ class ChatApplication {
             
         } catch (error) {
             console.error('Error loading messages:', error);
-            this.showEmptyState();
+            if (!before) this.showEmptyState();
+        }
+    }
+
+    async loadOlderMessages() {
+        const roomId = this.currentRoom?._id;
+        const before = roomId && this.historyCursors.get(roomId);
+        if (!before || this.loadingHistory) return;
+        
+        this.loadingHistory = true;
+        try {
+            await this.loadRoomMessages(roomId, before);
+        } finally {
+            this.loadingHistory = false;
         }
     }
 
+    syncRooms() {
+        if (!this.currentRoom) return;
+        
+        console.log('🔄 Reconnected, syncing missed messages');
+        const roomId = this.currentRoom._id;
+        const lastSeen = this.lastSeenMessages.get(roomId);
+        this.socket.emit('sync', { rooms: { [roomId]: lastSeen ? lastSeen.id : null } }, (response) => {
+            if (!response || response.error) {
+                console.error('Sync failed:', response?.error);
+                return;
+            }
+            
+            Object.entries(response.rooms).forEach(([id, result]) => {
+                if (result.error) return;
+                if (result.gap) {
+                    // Too much was missed for one batch: reload the newest page
+                    if (id === this.currentRoom?._id) {
+                        this.loadRoomMessages(id);
+                    }
+                    return;
+                }
+                result.messages.forEach(message => this.addMessageToUI(message, false));
+            });
+            
+            // Rooms we were not subscribed to are covered by the unread counts
+            this.loadUnreadCounts();
+        });
+    }
+
     clearMessages() {
         if (this.elements.messagesContainer) {
             this.elements.messagesContainer.innerHTML = '';
@@ -485,6 +563,18 @@ class ChatApplication {
         });
     }
 
+    prependMessages(messages) {
+        const container = this.elements.messagesContainer;
+        if (!messages || !container) return;
+        
+        // Keep the messages in view where they are while older ones go above
+        const previousHeight = container.scrollHeight;
+        messages.forEach(message => {
+            container.insertBefore(this.createMessageElement(message), container.firstChild);
+        });
+        container.scrollTop += container.scrollHeight - previousHeight;
+    }
+
     addMessageToUI(message, animate = true) {
         if (!this.elements.messagesContainer) return;
         
@@ -524,6 +614,14 @@ class ChatApplication {
         // Update last message time
         this.lastMessageTime = new Date(message.timestamp);
         
+        // Remember the newest message seen here; report it while the page is visible
+        if (message.id) {
+            this.lastSeenMessages.set(message.room_id || this.currentRoom?._id, message);
+            if (!document.hidden) {
+                this.markRead(message.room_id || this.currentRoom?._id);
+            }
+        }
+        
         // Auto-scroll if user is at bottom
         this.autoScrollToBottom();
         
@@ -669,9 +767,12 @@ class ChatApplication {
             clearTimeout(this.typingTimeout);
         }
 
-        // Send typing start if not already typing
-        if (!this.isTyping) {
+        // Send typing start if not already typing, and refresh it during long
+        // bursts so the server does not expire it
+        const now = Date.now();
+        if (!this.isTyping || now - this.lastTypingSent > 3000) {
             this.isTyping = true;
+            this.lastTypingSent = now;
             this.socket.emit('typing_start', {
                 room_id: this.currentRoom._id,
                 username: this.currentUser.username
@@ -711,6 +812,15 @@ class ChatApplication {
         this.updateTypingIndicator();
     }
 
+    handleTypingState(data) {
+        if (data.room_id !== this.currentRoom?._id) return;
+
+        this.typingUsers = new Set(
+            (data.typing || []).filter(username => username !== this.currentUser.username)
+        );
+        this.updateTypingIndicator();
+    }
+
     updateTypingIndicator() {
         if (!this.elements.typingIndicator) return;
         
@@ -751,12 +861,33 @@ class ChatApplication {
         }
     }
 
+    handleIncomingBatch(data) {
+        const messages = data.messages.map(message => ({ ...message, room_id: data.room_id }));
+        if (!messages.length) return;
+        
+        // Render every message, but notify once per batch
+        messages.slice(0, -1).forEach(message => this.addMessageToUI(message, false));
+        this.handleIncomingMessage(messages[messages.length - 1]);
+    }
+
     handleUserJoined(data) {
         if (data.room_id === this.currentRoom?._id) {
             console.log(`${data.username} joined the room`);
         }
     }
 
+    handleRoomNotice(data) {
+        if (data.room_id !== this.currentRoom?._id) return;
+        
+        this.addMessageToUI({
+            room_id: data.room_id,
+            username: 'System',
+            message: data.message,
+            timestamp: data.timestamp,
+            is_system: true
+        }, true);
+    }
+
     handleUserLeft(data) {
         if (data.room_id === this.currentRoom?._id) {
             console.log(`${data.username} left the room`);
@@ -787,6 +918,10 @@ class ChatApplication {
 
     handleMessagesScroll() {
         this.updateScrollToBottomButton();
+        
+        if (this.elements.messagesContainer.scrollTop < 100) {
+            this.loadOlderMessages();
+        }
     }
 
     updateScrollToBottomButton() {
@@ -922,6 +1057,49 @@ class ChatApplication {
     clearUnreadCount(roomId) {
         this.unreadCounts.set(roomId, 0);
         this.updateRoomUnreadCount(roomId, 0);
+        this.markRead(roomId);
+    }
+
+    updateRoomUnreadCount(roomId, count) {
+        const badge = document.querySelector(`[data-room-id="${roomId}"] .unread-count`);
+        if (!badge) return;
+        
+        badge.textContent = this.unreadLimit && count >= this.unreadLimit ? `${this.unreadLimit}+` : count;
+        badge.style.display = count > 0 ? '' : 'none';
+    }
+
+    async loadUnreadCounts() {
+        try {
+            const response = await fetch('/api/unread');
+            if (!response.ok) throw new Error('Failed to fetch unread counts');
+            
+            const data = await response.json();
+            this.unreadLimit = data.limit;
+            Object.entries(data.counts).forEach(([roomId, count]) => {
+                if (roomId === this.currentRoom?._id) return;
+                this.unreadCounts.set(roomId, count);
+                this.updateRoomUnreadCount(roomId, count);
+            });
+            
+        } catch (error) {
+            console.error('Error loading unread counts:', error);
+        }
+    }
+
+    markRead(roomId) {
+        // Debounced per room: the server keeps only the furthest position anyway
+        const message = this.lastSeenMessages.get(roomId);
+        if (!message || !this.socket || this.markReadTimers.has(roomId)) return;
+        
+        this.markReadTimers.set(roomId, setTimeout(() => {
+            this.markReadTimers.delete(roomId);
+            const latest = this.lastSeenMessages.get(roomId);
+            this.socket.emit('mark_read', {
+                room_id: roomId,
+                message_id: latest.id,
+                timestamp: latest.timestamp
+            });
+        }, 1000));
     }
 
     updateConnectionStatus(connected) {
@@ -0,0 +1,46 @@
+import mongomock
+import pytest
+
+import app
+
+
+@pytest.fixture
+def chat(monkeypatch):
+    client = mongomock.MongoClient()
+    monkeypatch.setattr(app, 'MongoClient', lambda *args, **kwargs: client)
+    monkeypatch.setenv('CHATPRO_ADMIN_USERS', 'root')
+    monkeypatch.setenv('CHATPRO_PASSWORD_HASH_WORKERS', '0')
+    chat = app.ChatApplication()
+    yield chat
+    chat.shutdown()
+
+
+def login(client, username):
+    with client.session_transaction() as session:
+        session['user_id'] = username
+        session['username'] = username
+
+
+def test_metrics_are_loopback_only_without_a_token(chat):
+    client = chat.app.test_client()
+
+    assert client.get('/metrics').status_code == 200
+    assert client.get('/metrics', environ_base={'REMOTE_ADDR': '10.0.0.5'}).status_code == 403
+
+
+def test_metrics_token_is_required_when_set(chat):
+    chat.app.config['METRICS_TOKEN'] = 'secret'
+    client = chat.app.test_client()
+
+    assert client.get('/metrics').status_code == 401
+    assert client.get('/metrics', headers={'Authorization': 'Bearer secret'},
+                      environ_base={'REMOTE_ADDR': '10.0.0.5'}).status_code == 200
+
+
+def test_stats_are_for_admins_only(chat):
+    client = chat.app.test_client()
+
+    login(client, 'bob')
+    assert client.get('/api/stats').status_code == 403
+    login(client, 'root')
+    assert client.get('/api/stats').status_code == 200
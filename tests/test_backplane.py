@@ -0,0 +1,113 @@
+import os
+import pickle
+import threading
+import time
+
+import pytest
+
+from app import BackplaneHub, LocalSocketPubSubManager, parse_backplane_address, write_frame
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError('condition not met in time')
+        time.sleep(0.01)
+
+
+def listen(manager, received):
+    """Collect what ``manager`` reads from the backplane on a daemon thread"""
+    def run():
+        for message in manager._listen():
+            received.append(message)
+    threading.Thread(target=run, daemon=True).start()
+
+
+@pytest.fixture
+def hub(tmp_path):
+    address = 'unix://' + os.path.join(str(tmp_path), 'backplane.sock')
+    hub = BackplaneHub(address)
+    hub.start()
+    yield address, hub
+    hub.close()
+
+
+def test_emit_crosses_between_managers(hub):
+    address, backplane = hub
+    sender = LocalSocketPubSubManager(address)
+    receiver = LocalSocketPubSubManager(address)
+    received = []
+    listen(receiver, received)
+    wait_for(lambda: len(backplane._subscribers) == 1)
+
+    sender.emit('new_message', {'id': 'abc', 'message': 'hello'}, namespace='/', room='general')
+
+    wait_for(lambda: received)
+    message = received[0]
+    assert message['method'] == 'emit'
+    assert message['event'] == 'new_message'
+    assert message['data'] == {'id': 'abc', 'message': 'hello'}
+    assert message['room'] == 'general'
+
+
+def test_cluster_events_reach_other_workers_only(hub):
+    address, backplane = hub
+    sender = LocalSocketPubSubManager(address)
+    receiver = LocalSocketPubSubManager(address)
+    events = {'sender': [], 'receiver': []}
+    sender.on_cluster_event(lambda event, payload: events['sender'].append((event, payload)))
+    receiver.on_cluster_event(lambda event, payload: events['receiver'].append((event, payload)))
+    listen(sender, [])
+    listen(receiver, [])
+    wait_for(lambda: len(backplane._subscribers) == 2)
+
+    sender.publish_cluster_event('member_added', {'room_id': 'r1', 'user_id': 'u1'})
+
+    wait_for(lambda: events['receiver'])
+    assert events['receiver'] == [('member_added', {'room_id': 'r1', 'user_id': 'u1'})]
+    time.sleep(0.1)
+    assert events['sender'] == []
+
+
+def test_publish_without_hub_fails_fast(tmp_path):
+    address = 'unix://' + os.path.join(str(tmp_path), 'missing.sock')
+    manager = LocalSocketPubSubManager(address, connect_timeout=0.2)
+
+    started = time.monotonic()
+    manager.emit('new_message', {'id': 'abc'}, namespace='/')
+    manager.emit('new_message', {'id': 'def'}, namespace='/')
+
+    assert time.monotonic() - started < 2
+    assert not BackplaneHub.running(address)
+
+
+def test_pickled_frames_are_not_loaded(hub):
+    address, backplane = hub
+    receiver = LocalSocketPubSubManager(address)
+    received = []
+    listen(receiver, received)
+    wait_for(lambda: len(backplane._subscribers) == 1)
+
+    class Exploit:
+        def __reduce__(self):
+            return (print, ('unpickled',))
+
+    publisher = receiver._connect(BackplaneHub.PUBLISHER)
+    write_frame(publisher, pickle.dumps({'method': 'chatpro', 'payload': Exploit()}))
+    receiver.emit('after', {'ok': True}, namespace='/')
+
+    wait_for(lambda: received)
+    assert [message['event'] for message in received] == ['after']
+    publisher.close()
+
+
+@pytest.mark.parametrize('address', ['tcp://0.0.0.0:7000', 'tcp://10.0.0.5:7000', 'tcp://example.com:7000'])
+def test_tcp_hub_must_be_loopback(address):
+    with pytest.raises(ValueError):
+        parse_backplane_address(address)
+
+
+def test_tcp_loopback_addresses_are_accepted():
+    assert parse_backplane_address('tcp://127.0.0.1:7000')[1] == ('127.0.0.1', 7000)
+    assert parse_backplane_address('tcp://:7000')[1] == ('127.0.0.1', 7000)
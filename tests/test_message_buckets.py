@@ -0,0 +1,84 @@
+from datetime import datetime, timedelta
+
+import mongomock
+import pytest
+from bson import ObjectId
+
+from app import MessageBucketStore
+
+
+def make_messages(count, start=datetime(2026, 1, 1)):
+    return [{'_id': ObjectId(), 'room_id': 'r1', 'user_id': 'u1', 'username': 'alice',
+             'message': f'm{index}', 'timestamp': start + timedelta(seconds=index)}
+            for index in range(count)]
+
+
+@pytest.fixture
+def store():
+    buckets = mongomock.MongoClient().db.message_buckets
+    # As created by MongoDBManager
+    buckets.create_index([('room_id', 1)], name='open_buckets', unique=True,
+                         partialFilterExpression={'open': True})
+    return MessageBucketStore(buckets, bucket_size=5)
+
+
+def texts(messages):
+    return [message['message'] for message in messages]
+
+
+def test_before_pages_walk_back_through_every_bucket(store):
+    messages = make_messages(23)
+    store.append('r1', messages)
+
+    seen = []
+    page = store.get_page('r1', per_page=4)
+    while page:
+        seen.extend(texts(page))
+        oldest = page[-1]
+        page = store.get_page('r1', per_page=4, before=(oldest['timestamp'], oldest['_id']))
+
+    assert seen == [f'm{index}' for index in range(22, -1, -1)]
+
+
+def test_before_cursor_inside_a_bucket(store):
+    messages = make_messages(12)
+    store.append('r1', messages)
+
+    cursor = messages[7]
+    page = store.get_page('r1', per_page=3, before=(cursor['timestamp'], cursor['_id']))
+
+    assert texts(page) == ['m6', 'm5', 'm4']
+
+
+def test_after_pages_and_counts(store):
+    messages = make_messages(12)
+    store.append('r1', messages)
+
+    cursor = messages[3]
+    after = (cursor['timestamp'], cursor['_id'])
+
+    assert texts(store.get_page('r1', per_page=3, after=after)) == ['m6', 'm5', 'm4']
+    assert store.count_after('r1', after, limit=100) == 8
+    assert store.count_after('r1', after, limit=5) == 5
+
+
+
+def test_append_fills_the_open_bucket_before_opening_another(store):
+    store.append('r1', make_messages(3))
+    store.append('r1', make_messages(4, start=datetime(2026, 1, 2)))
+
+    counts = sorted(bucket['count'] for bucket in store.buckets.find())
+    assert counts == [2, 5]
+    assert store.buckets.count_documents({'open': True}) == 1
+    assert store.latest('r1')['message'] == 'm3'
+
+
+def test_concurrent_writer_cannot_overfill_or_open_a_second_bucket(store):
+    store.append('r1', make_messages(3))
+    store.buckets.update_one({'open': True}, {'$inc': {'count': 1}})  # Another writer's push
+
+    store.append('r1', make_messages(3, start=datetime(2026, 1, 2)))
+
+    counts = sorted(bucket['count'] for bucket in store.buckets.find())
+    assert counts == [2, 5]
+    assert store.buckets.count_documents({'open': True}) == 1
@@ -0,0 +1,54 @@
+import queue
+import threading
+
+from app import OutboundQueueGuard
+
+
+class FakeSocket:
+    def __init__(self, backlog):
+        self.queue = queue.Queue()
+        for _ in range(backlog):
+            self.queue.put(None)
+
+
+class FakeEngineIO:
+    def __init__(self, sockets):
+        self.sockets = sockets
+        self.sent = []
+        self.disconnected = []
+
+    def send(self, sid, data):
+        self.sent.append((sid, data))
+
+    def disconnect(self, sid):
+        self.disconnected.append(sid)
+
+    def start_background_task(self, target, *args):
+        target(*args)
+
+
+def test_full_queue_drops_and_counts_under_concurrency():
+    eio = FakeEngineIO({'slow': FakeSocket(5)})
+    guard = OutboundQueueGuard(eio, max_queue=5, policy='drop').install()
+
+    threads = [threading.Thread(target=lambda: [guard.send('slow', 'x') for _ in range(100)]) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert eio.sent == []
+    assert guard.get_stats()['dropped'] == 800
+
+
+def test_slow_client_is_disconnected_once():
+    eio = FakeEngineIO({'slow': FakeSocket(3), 'fast': FakeSocket(1)})
+    guard = OutboundQueueGuard(eio, max_queue=3).install()
+
+    eio.send('fast', 'a')
+    eio.send('slow', 'b')
+
+    assert eio.sent == [('fast', 'a')]
+    assert eio.disconnected == ['slow']
+    assert guard.get_stats()['max_backlog'] == 1
+    assert guard.get_stats()['disconnected'] == 1
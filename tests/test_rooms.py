@@ -0,0 +1,75 @@
+import mongomock
+import pytest
+
+import app
+from app import MongoDBManager, RoomCache, RoomManager, RoomNoticeAggregator
+
+
+@pytest.fixture
+def rooms(monkeypatch):
+    client = mongomock.MongoClient()
+    monkeypatch.setattr(app, 'MongoClient', lambda *args, **kwargs: client)
+    return RoomManager(MongoDBManager(), room_cache=RoomCache())
+
+
+def set_cap(rooms, room_id, max_members):
+    rooms.rooms.update_one({'_id': app.ObjectId(room_id)}, {'$set': {'settings.max_members': max_members}})
+    rooms.room_cache.invalidate(room_id)
+
+
+def test_private_room_cap_is_enforced(rooms):
+    room_id = rooms.create_room('secret', 'owner', is_private=True)
+    set_cap(rooms, room_id, 2)
+
+    assert rooms.join_room(room_id, 'u1') is True
+    with pytest.raises(ValueError, match='Room is full'):
+        rooms.join_room(room_id, 'u2')
+    assert not rooms.is_member(room_id, 'u2')
+
+
+def test_public_room_is_never_full(rooms):
+    room_id = rooms.create_room('general', 'owner')
+    set_cap(rooms, room_id, 2)
+
+    assert rooms.join_room(room_id, 'u1') is True
+    assert rooms.join_room(room_id, 'u2') is True
+    assert rooms.is_member(room_id, 'u2')
+
+
+def test_rejoin_skips_the_membership_insert(rooms):
+    room_id = rooms.create_room('general', 'owner')
+    assert rooms.join_room(room_id, 'u1') is True
+
+    inserts = []
+    insert_one = rooms.memberships.insert_one
+    rooms.memberships.insert_one = lambda *args, **kwargs: inserts.append(args) or insert_one(*args, **kwargs)
+
+    assert rooms.join_room(room_id, 'u1') is False
+    assert inserts == []
+
+
+class FakeSocketIO:
+    def __init__(self):
+        self.emitted = []
+
+    def emit(self, event, data, to=None):
+        self.emitted.append((event, data, to))
+
+
+def test_notice_flush_survives_a_room_that_fails_to_persist():
+    socketio = FakeSocketIO()
+
+    def persist(room_id, text):
+        if room_id == 'broken':
+            raise RuntimeError('write failed')
+        return {'id': room_id, 'message': text}
+
+    notices = RoomNoticeAggregator(socketio, persist=persist)
+    notices.joined('broken', 'alice')
+    notices.joined('ok', 'bob')
+
+    notices.flush()
+
+    assert [(event, to) for event, _, to in socketio.emitted] == [('message', 'ok')]
+    assert notices.get_stats()['failed'] == 1
+    assert notices.get_stats()['persisted'] == 1
@@ -0,0 +1,103 @@
+import mongomock
+import pytest
+
+import app
+from app import MongoDBManager, RoomCache, RoomManager, highlight_offsets, tokenize
+
+
+@pytest.fixture
+def rooms(monkeypatch):
+    client = mongomock.MongoClient()
+    monkeypatch.setattr(app, 'MongoClient', lambda *args, **kwargs: client)
+    return RoomManager(MongoDBManager(), room_cache=RoomCache())
+
+
+def post(rooms, room_id, text):
+    return rooms.add_message(room_id, 'u1', 'alice', text)
+
+
+def test_tokenize_normalizes_and_dedupes():
+    assert tokenize('Deploy the API, then deploy again!') == ['deploy', 'the', 'api', 'then', 'again']
+    assert tokenize('a I x') == []
+
+
+def test_highlight_offsets_match_whole_words():
+    assert highlight_offsets('Deploy redeploy DEPLOY', ['deploy']) == [[0, 6], [16, 22]]
+
+
+def test_search_matches_every_term_newest_first(rooms):
+    room_id = rooms.create_room('ops', 'u1')
+    post(rooms, room_id, 'deploy staging now')
+    post(rooms, room_id, 'staging is down')
+    post(rooms, room_id, 'deploy staging done')
+
+    messages, terms, ignored, next_cursor = rooms.search_messages([room_id], 'Staging deploy')
+
+    assert [message['message'] for message in messages] == ['deploy staging done', 'deploy staging now']
+    assert sorted(terms) == ['deploy', 'staging']
+    assert ignored == []
+    assert next_cursor is None
+
+
+def test_search_pages_with_cursor(rooms):
+    room_id = rooms.create_room('ops', 'u1')
+    for index in range(5):
+        post(rooms, room_id, f'release {index}')
+
+    first, _, _, cursor = rooms.search_messages([room_id], 'release', limit=3)
+    second, _, _, last_cursor = rooms.search_messages([room_id], 'release', limit=3, before=cursor)
+
+    assert [message['message'] for message in first] == ['release 4', 'release 3', 'release 2']
+    assert [message['message'] for message in second] == ['release 1', 'release 0']
+    assert last_cursor is None
+
+
+def test_search_reports_ignored_short_terms(rooms):
+    room_id = rooms.create_room('langs', 'u1')
+    post(rooms, room_id, 'C programming tips')
+
+    messages, terms, ignored, _ = rooms.search_messages([room_id], 'C programming')
+
+    assert terms == ['programming']
+    assert ignored == ['c']
+    assert len(messages) == 1
+
+
+def test_search_rejects_query_of_only_short_terms(rooms):
+    room_id = rooms.create_room('langs', 'u1')
+
+    with pytest.raises(ValueError, match='2 to 64 characters'):
+        rooms.search_messages([room_id], 'C 5')
+
+
+def test_accessible_rooms_reuse_the_cached_public_set(rooms):
+    public_id = rooms.create_room('general', 'u1')
+    private_id = rooms.create_room('secret', 'u2', is_private=True)
+    assert rooms.get_accessible_room_ids('u1') == [public_id]
+
+    reads = []
+    find = rooms.rooms.find
+    rooms.rooms.find = lambda *args, **kwargs: reads.append(args) or find(*args, **kwargs)
+
+    assert rooms.get_accessible_room_ids('u1') == [public_id]
+    assert rooms.get_accessible_room_ids('u2') == sorted([public_id, private_id])
+    assert reads == []
+
+
+def test_new_public_room_refreshes_the_cached_set(rooms):
+    first_id = rooms.create_room('general', 'u1')
+    assert rooms.get_accessible_room_ids('u1') == [first_id]
+
+    second_id = rooms.create_room('random', 'u2')
+
+    assert rooms.get_accessible_room_ids('u1') == sorted([first_id, second_id])
+
+
+def test_remote_public_room_refreshes_the_cached_set(rooms):
+    first_id = rooms.create_room('general', 'u1')
+    assert rooms.get_accessible_room_ids('u1') == [first_id]
+    other_id = str(rooms.rooms.insert_one({'name': 'elsewhere', 'is_active': True, 'is_private': False}).inserted_id)
+
+    rooms.apply_remote_change('public_room_created', {'room_id': other_id})
+
+    assert rooms.get_accessible_room_ids('u1') == sorted([first_id, other_id])